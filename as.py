@@ -1,132 +1,511 @@
 #!/usr/bin/env python3
 
 import argparse
+from cfg import Graph, StackCheck
+from ir import NO_REF, Program
+from isa import OPCODE_SHIFT, cycle_costs, decode_instruction, opcode_names
+from layout import layout, overflow
+import mif
+from mif import comment
+import mmap
+import os
+from obj import LinkError, link, write_object
 from parser import Parser
+from peephole import optimize
+from sim import NO_ADDRESS, NO_REGISTER, Machine, SimulationError, Trace
 import sys
+import time
+from vcd import VcdWriter
 
-opcode_map = {
-    "add": 0b0000,
-    "sub": 0b0001,
-    "slt": 0b0010,
-    "li": 0b0011,
-    "lw": 0b0100,
-    "sw": 0b0101,
-    "beq": 0b0110,
-    "bne": 0b0111,
-    "push": 0b1000,
-    "pop": 0b1001,
-    "j": 0b1010,
-    "jal": 0b1011,
-    "jr": 0b1100,
-    "nop": 0b1101,
-}
-
-
-def regnum(r):
-    return int(r[1])
-
-
-def encode_instruction(instr):
-    op = instr[0]
-    opcode = opcode_map.get(op)
-    if opcode is None:
-        raise ValueError(f"Unknown opcode: {op}")
-
-    if op == "li":
-        dsel = regnum(instr[1])
-        imm = instr[2] & 0b11111
-        return (opcode << 7) | (dsel << 5) | imm
-
-    elif op in ("add", "sub", "slt"):
-        dsel = regnum(instr[1])
-        r1 = regnum(instr[2])
-        r2 = regnum(instr[3])
-        operand = (r1 << 2) | r2
-        return (opcode << 7) | (dsel << 5) | operand
-
-    elif op in ("lw", "sw", "push", "pop"):
-        dsel = regnum(instr[1])
-        addr = instr[2] if len(instr) > 2 else 0
-        return (opcode << 7) | (dsel << 5) | (addr & 0b11111)
-
-    elif op in ("beq", "bne"):
-        dsel = regnum(instr[1])
-        addr = instr[2] & 0b11111
-        return (opcode << 7) | (dsel << 5) | addr
-
-    elif op in ("j", "jal"):
-        addr = instr[1] & 0b11111
-        return (opcode << 7) | (0 << 5) | addr
-
-    elif op == "jr":
-        return opcode << 7
-
-    elif op == "nop":
-        return opcode << 7
 
+def error(message, outfile=None):
+    RED = "\033[31m"
+    BOLD = "\033[1m"
+    RESET = "\033[0m"
+
+    print(f"{RED}{BOLD}{outfile + ': ' if outfile else ''}error: {message}{RESET}")
+    sys.exit(1)
+
+
+def to_mif(program, outfile=None, depth=32):
+    if program.size > depth:
+        error(f"out of RAM. Used {program.size} of {depth} words", outfile)
+
+    content = mif.render(program, depth)
+
+    if outfile:
+        with open(outfile, "w") as file:
+            file.write(content)
     else:
-        raise ValueError(f"Unhandled instruction: {instr}")
+        print(content)
 
 
-def to_mif(instructions, outfile=None):
-    if len(instructions) > 32:
-        RED = "\033[31m"
-        BOLD = "\033[1m"
-        RESET = "\033[0m"
+def to_object(program, outfile):
+    # Label references are encoded as address 0 and recorded as relocations
+    relocations = []
+    address = 0
+    for ref, count in zip(program.ref, program.count):
+        if ref != NO_REF:
+            relocations.append((address, program.refs[ref][0]))
+        address += count
+    try:
+        write_object(outfile, program.encode(), program.labels, relocations)
+    except (LinkError, OSError) as e:
+        error(e, outfile)
+
+
+def instruction_text(word):
+    op, *operands = decode_instruction(word)
+    return " ".join([op, ", ".join(str(operand) for operand in operands)]).rstrip()
+
+
+def simulate(program, name, depth=32, limit=1000000, profile=False, trace=None, vcd=None, until=None, state=None):
+    # vcd is a VcdWriter fed from the trace, which is drained every time it
+    # fills up. state is a snapshot to start from instead of address 0.
+    if vcd is not None and trace is None:
+        trace = Trace(65536)
+    machine = Machine(program.encode(), depth, profile, trace)
+    if state is not None:
+        try:
+            machine.restore(state)
+        except ValueError as e:
+            error(f"{name}: cannot resume: {e}")
+    done = 0
+    try:
+        while done < limit and not machine.halted:
+            chunk = limit - done if vcd is None else min(limit - done, trace.capacity)
+            ran = machine.run(chunk, until)
+            done += ran
+            if vcd is not None:
+                vcd.write(trace.records(vcd.next))
+            if ran < chunk:
+                break
+    except SimulationError as e:
+        error(f"{name}: {e} after {machine.steps} instructions")
+    finally:
+        # The trace and waveform are most useful when the program failed
+        if trace is not None:
+            trace.flush()
+        if vcd is not None:
+            vcd.write(trace.records(vcd.next))
+            vcd.close()
+
+    instr = instruction_text(machine.memory[machine.pc])
+    if machine.halted:
+        print(f"{name}: halted at address {machine.pc} ({instr}) after {machine.steps} instructions")
+    elif done and machine.pc == until:
+        print(f"{name}: stopped at address {machine.pc} ({instr}) after {machine.steps} instructions")
+    else:
+        print(f"{name}: still running at address {machine.pc} after {machine.steps} instructions")
+    print("  ".join(f"D{i} = {value}" for i, value in enumerate(machine.regs)))
+    print(f"stack: {machine.stack}")
+    return machine
+
+
+def cycle_table(text):
+    # "lw=2,sw=2" on top of the default costs
+    costs = dict(cycle_costs)
+    for item in filter(None, text.split(",")):
+        op, _, cycles = item.partition("=")
+        if op.strip() not in costs or not cycles.strip().isdigit():
+            raise argparse.ArgumentTypeError(f"invalid cycle cost '{item}'")
+        costs[op.strip()] = int(cycles)
+    return costs
+
+
+def print_profile(program, machine, costs, source=None):
+    # One row per instruction or data directive, with the source line it
+    # came from when the source is at hand
+    profile = machine.profile
+    memory = machine.memory
+    cycles = [
+        count * costs.get(opcode_names.get(word >> OPCODE_SHIFT), 0) for count, word in zip(profile.counts, memory)
+    ]
+    total = sum(cycles)
+    print(f"{total} cycles")
+    print()
+    print(f"{'count':>10} {'cycles':>10} {'%':>6}  addr    source")
+
+    def row(first, last, text):
+        count = sum(profile.counts[first:last])
+        address = f"{first:02}" if last - first == 1 else f"{first:02}..{last - 1:02}"
+        if not count:
+            print(f"{'-':>10} {'':>10} {'':>6}  {address:<6}  {text}")
+            return
+        spent = sum(cycles[first:last])
+        if last - first == 1 and opcode_names.get(memory[first] >> OPCODE_SHIFT) in ("beq", "bne"):
+            text += f"  [taken {profile.taken[first]}, not taken {profile.not_taken[first]}]"
+        # Nothing to take a share of when every instruction run costs 0
+        percent = f"{100 * spent / total:5.1f}%" if total else f"{'':>6}"
+        print(f"{count:>10} {spent:>10} {percent}  {address:<6}  {text}")
+
+    address = 0
+    for i in range(len(program)):
+        line = program.line[i]
+        if source and 0 < line <= len(source):
+            text = f"{line:>4} | {source[line - 1].rstrip()}"
+        else:
+            text = comment(program.instruction(i))[3:].rstrip()
+        row(address, address + program.count[i], text)
+        address += program.count[i]
+
+    if any(profile.counts[address:]):
+        row(address, len(memory), "(past the end of the program)")
+
+
+def print_trace(trace, program=None, name=None, source=None):
+    # One line per record, ending with the source position of the
+    # instruction when the program it came from is given
+    positions = {}
+    if program is not None:
+        address = 0
+        for i in range(len(program)):
+            line, offset = program.line[i], program.offset[i]
+            if line:
+                if source is not None:
+                    column = offset - source.rfind("\n", 0, offset)
+                    positions[address] = f"{name}:{line}:{column}"
+                else:
+                    positions[address] = f"{name}:{line}"
+            address += program.count[i]
+
+    for index, (pc, word, reg, depth, value, address, data) in trace.records():
+        effects = []
+        if reg != NO_REGISTER:
+            effects.append(f"D{reg} = {value}")
+        if address != NO_ADDRESS:
+            effects.append(f"[{address}] = {data}")
+        effects.append(f"sp = {depth}")
+        text = f"{index:>8}  {pc:02}  {word:011b}  {instruction_text(word):<16}  {', '.join(effects):<24}"
+        print(f"{text}  {positions.get(pc, '')}".rstrip())
+
+
+def parse_file(parser, infile, use_mmap=False, relocatable=False):
+    if infile == "-":
+        return parser.parse(sys.stdin, file_name="<stdin>", relocatable=relocatable)
+
+    if use_mmap and os.path.getsize(infile) > 0:
+        with open(infile, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as code:
+                return parser.parse(code, file_name=infile, relocatable=relocatable)
+
+    with open(infile) as f:
+        code = f.read()
+    return parser.parse(code, file_name=infile, relocatable=relocatable)
+
+
+def check(program, name):
+    # Rejects programs that overflow or underflow the stack on some path
+    # and warns about code that cannot run
+    analysis = StackCheck(Graph(program))
+
+    def position(entry):
+        if program.line[entry]:
+            return f"{name}:{program.line[entry]}"
+        return f"{name}: address {analysis.graph.address[entry]}"
+
+    for entry, message in analysis.warnings:
+        print(f"{position(entry)}: warning: {message}", file=sys.stderr)
+    for first, last in analysis.unreachable:
+        first_address, last_address = analysis.graph.address[first], analysis.graph.address[last]
+        where = f"address {first_address}" if first == last else f"addresses {first_address}..{last_address}"
+        print(f"{position(first)}: warning: unreachable code at {where}", file=sys.stderr)
+    if analysis.errors:
+        entry, message = analysis.errors[0]
+        error(message, position(entry))
+
+
+def movable(program, name, what):
+    # Rejects moving code around when li loads a value computed from label
+    # addresses, which would not follow the code
+    if program.label_values:
+        entry = program.label_values[0]
+        error(
+            f"li loads a value computed from label addresses, which {what} would leave stale",
+            f"{name}:{program.line[entry]}",
+        )
+
 
+def fit(program, depth, name):
+    # Lays out programs that are too big again, or reports what does not fit
+    if program.size <= depth:
+        return program
+    movable(program, name, "laying the program out to fit")
+    fitted, saved = layout(program)
+    if fitted.size <= depth:
+        print(f"{name}: {program.size} words laid out in {fitted.size} to fit in {depth}", file=sys.stderr)
+        return fitted
+
+    graph, ranges = overflow(fitted, depth)
+    lines = [f"out of RAM. Used {fitted.size} of {depth} words after layout, past the end:"]
+    for first, end in ranges:
+        lines_used = sorted({fitted.line[i] for i in range(first, end) if fitted.line[i]})
+        where = f"{name}:{lines_used[0]}" if lines_used else name
+        if len(lines_used) > 1:
+            where += f"-{lines_used[-1]}"
+        instr = fitted.instruction(first)
+        text = f"{instr[0]} {', '.join(str(operand) for operand in instr[1:])}".rstrip()
+        first_address, last_address = graph.address[first], graph.address[end] - 1
+        span = f"address {first_address}" if first_address == last_address else f"addresses {first_address}..{last_address}"
+        lines.append(f"  {where}: {span}, starting with {text}")
+    error("\n".join(lines))
+
+
+def assemble(parser, args, checked=True):
+    program = parse_file(parser, args.infile, args.mmap)
+    if checked and not args.no_check:
+        check(program, args.infile)
+
+    if args.O:
+        movable(program, args.infile, "-O")
+        instructions, (words, cycles), (origins, addresses) = optimize(program.instructions(), args.cycles)
+        program = program.moved(instructions, origins, addresses)
         print(
-            f"{RED}{BOLD}{outfile + ': ' if outfile else ''}error: out of RAM. Used {len(instructions)} of 32 words{RESET}"
+            f"{args.o or args.infile}: optimizer saved {words} words, {cycles} cycles",
+            file=sys.stderr,
         )
-        sys.exit(1)
 
-    content = """-- Auto generated by https://github.com/nicholasnloehrke/as
+    return fit(program, args.depth, args.infile)
 
-WIDTH=11;
-DEPTH=32;
 
-ADDRESS_RADIX=UNS;
-DATA_RADIX=BIN;
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        # Editors that save by renaming briefly remove the file
+        return None
 
-CONTENT BEGIN
-"""
-    for i, instr in enumerate(instructions):
-        encoding = encode_instruction(instr)
-        op = instr[0]
-        comment = f"-- {op}{' ' * (4 - len(op))}"
-        operands = instr[1:]
 
-        if len(operands) >= 1:
-            comment += f" {operands[0]}"
-            for operand in operands[1:]:
-                comment += f", {operand}"
+def watch(parser, args, interval=0.25, debounce=0.1):
+    # Rebuilds when the input or a file it pulls in with .incbin changes.
+    # The included files are the ones of the last build that got as far as a
+    # program, so they are still watched while the input has errors.
+    last_mtimes = {}
+    last_words = None
+    includes = []
 
-        content += f"{i:02} : {encoding:011b}; {comment}\n"
+    while True:
+        current = {path: mtime(path) for path in [args.infile] + includes}
+        if current[args.infile] is not None and current != last_mtimes:
+            # Wait for the files to settle so a burst of writes triggers one rebuild
+            time.sleep(debounce)
+            if {path: mtime(path) for path in current} != current:
+                continue
 
-    for j in range(i + 1, 32):
-        content += f"{j:02} : 00000000000;\n"
+            # Errors have already been reported; keep watching for the fix
+            try:
+                program = assemble(parser, args)
+                directory = os.path.dirname(args.infile)
+                includes = sorted({os.path.join(directory, path) for path, _ in program.blobs})
+                words = program.encode()
+                if words != last_words:
+                    to_mif(program, args.o, args.depth)
+                    last_words = words
+            except SystemExit:
+                pass
 
-    content += "END;"
+            last_mtimes = current
+            last_mtimes.update((path, mtime(path)) for path in includes if path not in current)
 
-    if outfile:
-        with open(outfile, "w") as file:
-            file.write(content)
-    else:
-        print(content)
+        time.sleep(interval)
 
 
 def main():
     argparser = argparse.ArgumentParser()
-    argparser.add_argument("infile", help="Input file")
+    argparser.add_argument("infile", nargs="?", help="Input file, or - to read from stdin")
     argparser.add_argument("-o", help="Output file")
+    argparser.add_argument(
+        "-c",
+        action="store_true",
+        help="Assemble to a relocatable object file instead of a memory image",
+    )
+    argparser.add_argument(
+        "--link",
+        nargs="+",
+        metavar="OBJECT",
+        help="Link object files produced with -c into a memory image",
+    )
+    argparser.add_argument(
+        "-O",
+        action="store_true",
+        help="Run the peephole optimizer before encoding",
+    )
+    argparser.add_argument(
+        "--no-check",
+        action="store_true",
+        help="Skip the static check for stack overflow, stack underflow and unreachable code",
+    )
+    argparser.add_argument("--depth", type=int, default=32, help="RAM size in words (default: 32)")
+    argparser.add_argument(
+        "--mmap",
+        action="store_true",
+        help="Memory-map the input and scan it as bytes instead of reading it into a string",
+    )
+    argparser.add_argument(
+        "--generated-parser",
+        action="store_true",
+        help="Parse with the LALR automaton generated as Python code (see genparser.py)",
+    )
+    argparser.add_argument(
+        "--run",
+        action="store_true",
+        help="Simulate the program until it halts and print the final registers instead of writing a memory image",
+    )
+    argparser.add_argument(
+        "--profile-run",
+        action="store_true",
+        help="Like --run, then print how often each instruction ran and the cycles spent in it",
+    )
+    argparser.add_argument(
+        "--cycles",
+        type=cycle_table,
+        default="",
+        metavar="OP=N,...",
+        help="Cycle cost of instructions for --profile-run and -O (default: 1 each)",
+    )
+    argparser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="With --run or --profile-run, record the instructions executed in this binary trace file",
+    )
+    argparser.add_argument(
+        "--trace-size",
+        type=int,
+        default=65536,
+        metavar="N",
+        help="Number of instructions a trace holds; older ones are overwritten (default: 65536)",
+    )
+    argparser.add_argument(
+        "--vcd",
+        metavar="FILE",
+        help="With --run or --profile-run, write the registers, pc, stack depth and memory writes as a VCD waveform",
+    )
+    argparser.add_argument(
+        "--until",
+        metavar="ADDRESS",
+        help="Stop --run or --profile-run when the program gets to this address or label",
+    )
+    argparser.add_argument(
+        "--snapshot",
+        metavar="FILE",
+        help="Save the state of the machine at the end of --run or --profile-run to this file",
+    )
+    argparser.add_argument(
+        "--resume",
+        metavar="FILE",
+        help="Start --run or --profile-run from a state saved with --snapshot",
+    )
+    argparser.add_argument(
+        "--show-trace",
+        metavar="FILE",
+        help="Print a trace file as text, with source positions if the input file is given",
+    )
+    argparser.add_argument(
+        "--steps",
+        type=int,
+        default=1000000,
+        help="Instruction limit for --run (default: 1000000)",
+    )
+    argparser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Reassemble whenever the input changes, rewriting the output only if the encoding changed",
+    )
     args = argparser.parse_args()
 
-    with open(args.infile) as f:
-        code = f.read()
-
-    parser = Parser()
-    parsed = parser.parse(code, file_name=args.infile)
-
-    to_mif(parsed, args.o)
+    if args.show_trace:
+        try:
+            trace = Trace.open(args.show_trace)
+        except (OSError, ValueError) as e:
+            error(e)
+        program = source = None
+        if args.infile:
+            program = assemble(Parser(args.cycles, args.generated_parser), args, checked=False)
+            if args.infile != "-":
+                with open(args.infile, errors="replace") as f:
+                    source = f.read()
+        print_trace(trace, program, args.infile, source)
+        return
+
+    if args.link:
+        if args.infile:
+            argparser.error("--link takes object files instead of an input file")
+        try:
+            image = link(args.link, args.depth)
+        except (LinkError, OSError) as e:
+            error(e, args.o)
+        to_mif(Program.from_words(image), args.o, args.depth)
+        return
+
+    if not args.infile:
+        argparser.error("an input file is required")
+
+    parser = Parser(args.cycles, args.generated_parser)
+
+    if args.c:
+        program = parse_file(parser, args.infile, args.mmap, relocatable=True)
+        if args.o:
+            outfile = args.o
+        elif args.infile == "-":
+            outfile = "a.o"
+        else:
+            outfile = os.path.splitext(args.infile)[0] + ".o"
+        to_object(program, outfile)
+        return
+
+    if args.watch:
+        if args.infile == "-":
+            argparser.error("--watch needs an input file")
+        try:
+            watch(parser, args)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    program = assemble(parser, args)
+
+    if args.run or args.profile_run:
+        if program.size > args.depth:
+            error(f"out of RAM. Used {program.size} of {args.depth} words")
+        until = state = None
+        if args.until is not None:
+            until = program.labels.get(args.until)
+            if until is None:
+                if not args.until.isdigit():
+                    error(f"Unknown label: '{args.until}'")
+                until = int(args.until)
+            if until >= max(args.depth, 32):
+                error(f"address {until} is past the end of memory")
+        if args.resume:
+            try:
+                with open(args.resume, "rb") as f:
+                    state = f.read()
+            except OSError as e:
+                error(e)
+        trace = Trace(args.trace_size, args.trace) if args.trace else None
+        vcd = None
+        if args.vcd:
+            vcd_file = open(args.vcd, "w", buffering=1 << 20)
+            vcd = VcdWriter(vcd_file, max(args.depth, 32), args.cycles)
+        try:
+            machine = simulate(
+                program, args.infile, args.depth, args.steps, args.profile_run, trace, vcd, until, state
+            )
+        finally:
+            if vcd is not None:
+                vcd_file.close()
+        if args.snapshot:
+            with open(args.snapshot, "wb") as f:
+                f.write(machine.snapshot())
+        if args.profile_run:
+            source = None
+            if args.infile != "-":
+                with open(args.infile, errors="replace") as f:
+                    source = f.read().splitlines()
+            print_profile(program, machine, args.cycles, source)
+        return
+
+    to_mif(program, args.o, args.depth)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Times the parsing engines on the assembler grammar: parsedebug(), the
+# general loop, parseopt_notrack(), the loop on dense tables that parse()
+# uses when debugging and tracking are off, and the generated parser (see
+# ply/codegen.py). The source is lexed once beforehand and the grammar
+# rules are replaced with ones that do nothing, so only the loop is timed.
+
+import argparse
+import copy
+from parser import Parser
+from ply import codegen
+import time
+
+BLOCK = """\
+start{n}:
+        li   D1, 5
+        li   D2, data{n}+1
+        add  D3, D1, D2
+        jal  func{n}
+        lw   D3, data{n}
+        beq  D1, end{n}
+        j    end{n}
+func{n}:
+        push D1
+        li   D1, (end{n}-1)&31
+        sub  D2, D1, D3
+        sw   D2, data{n}
+        pop  D1
+        jr
+data{n}: .word 1, 2, 3
+        .fill 4, 0
+end{n}:  j    end{n}
+"""
+
+
+class Tokens:
+    # Replays tokens that were lexed once, in place of the lexer. The
+    # engines call input() at the start of each parse.
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def input(self, data):
+        self.next = iter(self.tokens).__next__
+
+    def token(self):
+        try:
+            return self.next()
+        except StopIteration:
+            return None
+
+
+def best(run, repeat):
+    result = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        result = min(result, time.perf_counter() - start)
+    return result
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--lines", type=int, default=3000, help="Lines of source to parse (default: 3000)")
+    argparser.add_argument("--repeat", type=int, default=60, help="Runs of each engine, the best is kept (default: 60)")
+    args = argparser.parse_args()
+
+    lines = BLOCK.count("\n")
+    source = "".join(BLOCK.format(n=n) for n in range(max(1, args.lines // lines)))
+    parser = Parser()
+    parser._lexer.input(source)
+    tokens = Tokens(list(iter(parser._lexer.token, None)))
+
+    tables = copy.copy(parser._parser)
+    tables.productions = [copy.copy(p) for p in tables.productions]
+    for p in tables.productions:
+        p.callable = lambda p: None
+    generated = codegen.load(tables)
+
+    engines = [
+        ("parsedebug", lambda: tables.parsedebug(source, tokens)),
+        ("parseopt_notrack", lambda: tables.parseopt_notrack(source, tokens)),
+        ("generated", lambda: generated.parse(source, tokens)),
+    ]
+    print(f"{source.count(chr(10))} lines, {len(tokens.tokens)} tokens, best of {args.repeat}")
+    for name, run in engines:
+        print(f"{name:<18} {best(run, args.repeat) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+from array import array
+from bisect import bisect_right
+from ir import WORD
+from isa import BEQ, BNE, J, JAL, JR, LW, POP, PUSH, STACK_DEPTH, SW, control
+
+# Control-flow graph of a resolved program (the ir.Program that Parser.parse
+# returns) and a static check of the hardware stack.
+#
+# A basic block starts at the first instruction, at every target of
+# j/jal/beq/bne and after every j/jal/beq/bne/jr, and ends before the next
+# start or a data entry. Execution that falls into data or past the end of
+# the program, or jumps there, is not followed.
+#
+# push/pop and jal/jr share the stack. Every jal target is taken to be a
+# function that returns with jr once it has popped what it pushed, so each
+# function is walked once with depths relative to its entry, and a call adds
+# the deepest the callee gets to the depth at the jal. This finds
+#
+#   - the deepest the stack can get when the program starts at address 0,
+#     and where;
+#   - pop and jr with nothing on the stack outside of functions;
+#   - instructions that nothing leads to from address 0.
+#
+# Where the depth cannot be bounded this way, as with paths reaching an
+# instruction with different depths or recursion, a warning says so.
+#
+# It takes time linear in the size of the program as long as functions
+# share little code. Blocks are visited at most WALK_LIMIT times over on
+# average; past that the check gives up with a warning rather than take
+# quadratic time.
+
+WALK_LIMIT = 4
+
+
+class Graph:
+    def __init__(self, program):
+        self.program = program
+        op = program.op
+        n = len(program)
+
+        # Address of every entry
+        self.address = array("I", [0]) * (n + 1)
+        for i in range(n):
+            self.address[i + 1] = self.address[i] + program.count[i]
+
+        # Blocks as [first, end) ranges of entries, indexed by their first
+        # entry in block_at
+        starts = {0} if n and op[0] < WORD else set()
+        for i in range(n):
+            if op[i] in control:
+                starts.add(i + 1)
+                if op[i] != JR:
+                    target = self.entry(program.imm[i])
+                    if target is not None:
+                        starts.add(target)
+        self.blocks = []
+        self.block_at = {}
+        first = None
+        for i in range(n + 1):
+            if first is not None and (i == n or i in starts or op[i] >= WORD):
+                self.block_at[first] = len(self.blocks)
+                self.blocks.append((first, i))
+                first = None
+            if i < n and first is None and op[i] < WORD:
+                first = i
+
+        # Blocks each block can continue in, and the block a jal at its end
+        # calls
+        self.successors = []
+        self.calls = []
+        for first, end in self.blocks:
+            last = end - 1
+            target = self.block_at.get(self.entry(program.imm[last]))
+            after = self.block_at.get(end)
+            callee = None
+            if op[last] == J:
+                following = [target]
+            elif op[last] in (BEQ, BNE):
+                following = [target, after]
+            elif op[last] == JAL:
+                following = [after]
+                callee = target
+            elif op[last] == JR:
+                following = []
+            else:
+                following = [after]
+            self.successors.append([block for block in following if block is not None])
+            self.calls.append(callee)
+
+    def entry(self, address):
+        # Index of the instruction at address, or None if there is data or
+        # nothing there
+        i = bisect_right(self.address, address) - 1
+        if i < len(self.program) and self.address[i] == address and self.program.op[i] < WORD:
+            return i
+        return None
+
+
+class StackCheck:
+    def __init__(self, graph):
+        # depth and deepest are how deep the stack can get and the entry
+        # where it does. errors and warnings are (entry, message) pairs, and
+        # unreachable holds [first, last] ranges of entries.
+        self.graph = graph
+        self.errors = []
+        self.warnings = []
+        program = graph.program
+        op = program.op
+
+        # Change in depth over each block, and the highest and lowest it
+        # gets relative to the block's start, with their entries. jal at the
+        # end of a block is left to the call.
+        self.effects = []
+        for first, end in graph.blocks:
+            depth = high = low = 0
+            high_at = low_at = first
+            for i in range(first, end):
+                if op[i] == PUSH:
+                    depth += 1
+                    if depth > high:
+                        high, high_at = depth, i
+                elif op[i] == POP:
+                    depth -= 1
+                    if depth < low:
+                        low, low_at = depth, i
+            self.effects.append((depth, high, high_at, low, low_at))
+
+        # Functions by entry block, as (deepest local point, calls made as
+        # (depth at the jal, callee, jal entry)), walked from address 0 on
+        self.visited = set()
+        self.functions = {}
+        self.budget = WALK_LIMIT * len(graph.blocks)
+        if graph.blocks and graph.blocks[0][0] == 0:
+            pending = [(0, True)]
+            while pending and self.budget >= 0:
+                block, main = pending.pop()
+                if block not in self.functions:
+                    self.functions[block] = self.walk(block, main)
+                    pending.extend((callee, False) for _, callee, _ in self.functions[block][1])
+            self.depth, self.deepest = self.combine(0)
+        else:
+            self.depth, self.deepest = 0, None
+
+        if self.depth > STACK_DEPTH:
+            self.errors.append(
+                (self.deepest, f"stack overflow: the stack can be {self.depth} words deep here, it holds {STACK_DEPTH}")
+            )
+
+        self.unreachable = []
+        if self.budget < 0:
+            self.warnings.append((0, "too much code shared between functions to check the stack fully"))
+            return
+
+        # Instructions outside the blocks walked, except the ones lw/sw treat
+        # as data
+        data = {program.imm[i] for i in range(len(program)) if op[i] in (LW, SW)}
+        covered = array("B", [0]) * len(program)
+        for block in self.visited:
+            first, end = graph.blocks[block]
+            covered[first:end] = array("B", [1]) * (end - first)
+        for i in range(len(program)):
+            if covered[i] or op[i] >= WORD or graph.address[i] in data:
+                continue
+            if self.unreachable and self.unreachable[-1][1] == i - 1:
+                self.unreachable[-1][1] = i
+            else:
+                self.unreachable.append([i, i])
+
+    def walk(self, start, main):
+        # Visits the blocks of the function entered at block start, or of
+        # the program itself if main. Depths are relative to the entry, where
+        # a function's return address is just below.
+        graph = self.graph
+        op = graph.program.op
+        floor = 0 if main else -1
+        depths = {start: 0}
+        deepest = (0, graph.blocks[start][0])
+        calls = []
+        mismatched = set()
+        pending = [start]
+        while pending and self.budget >= 0:
+            block = pending.pop()
+            self.budget -= 1
+            self.visited.add(block)
+            depth = depths[block]
+            first, end = graph.blocks[block]
+            delta, high, high_at, low, low_at = self.effects[block]
+
+            if depth + high > deepest[0]:
+                deepest = (depth + high, high_at)
+            if depth + low < floor:
+                if main:
+                    self.errors.append((low_at, "stack underflow: pop with nothing on the stack"))
+                else:
+                    self.warnings.append((low_at, "pop below the return address of the function"))
+                # Go on as if the stack had been at the floor there, so the
+                # code that follows is still walked
+                depth = floor - low
+
+            after = depth + delta
+            last = end - 1
+            if op[last] == JR:
+                if main and after == 0:
+                    self.errors.append((last, "stack underflow: jr with nothing on the stack"))
+                elif main:
+                    self.warnings.append((last, "jr outside of a function is not followed"))
+                elif after < 0:
+                    self.warnings.append((last, "jr after popping the return address of the function"))
+                elif after > 0:
+                    self.warnings.append((last, f"jr with {after} words pushed in the function"))
+            elif op[last] == JAL and graph.calls[block] is not None:
+                calls.append((after, graph.calls[block], last))
+
+            for successor in graph.successors[block]:
+                if successor not in depths:
+                    depths[successor] = after
+                    pending.append(successor)
+                elif depths[successor] != after and successor not in mismatched:
+                    mismatched.add(successor)
+                    low, high = sorted((depths[successor], after))
+                    self.warnings.append(
+                        (graph.blocks[successor][0], f"stack depth is {low} or {high} here depending on the path")
+                    )
+        return deepest, calls
+
+    def combine(self, root):
+        # Deepest point of every function including its calls, callees
+        # first. Recursive calls are left out.
+        result = {}
+        active = {root}
+        stack = [(root, iter(self.functions[root][1]))]
+        while stack:
+            function, calls = stack[-1]
+            for _, callee, at in calls:
+                if callee in active:
+                    self.warnings.append((at, "recursive call, the stack depth is not bounded"))
+                elif callee not in result and callee in self.functions:
+                    active.add(callee)
+                    stack.append((callee, iter(self.functions[callee][1])))
+                    break
+            else:
+                stack.pop()
+                active.discard(function)
+                deepest, calls = self.functions[function]
+                for depth, callee, at in calls:
+                    if callee in result:
+                        total, where = result[callee]
+                        if depth + 1 + total > deepest[0]:
+                            deepest = (depth + 1 + total, where)
+                result[function] = deepest
+        return result[root]
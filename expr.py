@@ -0,0 +1,86 @@
+import operator
+
+# Constant expressions in operands, such as "data+1" or "(N-1)&31".
+#
+# The parser compiles every expression into a postfix program, a tuple of
+#
+#   (CONST, value)
+#   (LABEL, name, line, offset)        the address of a label
+#   (UNARY, symbol)                    applied to the top of the stack
+#   (BINARY, symbol, line, offset)     applied to the top two
+#
+# which is run once the labels are known. Values are Python integers while
+# the expression is evaluated; only the result has to fit the operand.
+# Positions are kept for the steps that can fail, to point errors at them.
+
+CONST = 0
+LABEL = 1
+UNARY = 2
+BINARY = 3
+
+
+def divide(a, b):
+    # Division rounding toward zero, as in C
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+def remainder(a, b):
+    # Remainder with the sign of a, as in C
+    return a - b * divide(a, b)
+
+
+unary = {
+    "-": operator.neg,
+    "+": operator.pos,
+    "~": operator.invert,
+}
+
+binary = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": divide,
+    "%": remainder,
+    "<<": operator.lshift,
+    ">>": operator.rshift,
+    "&": operator.and_,
+    "|": operator.or_,
+    "^": operator.xor,
+}
+
+
+class ExpressionError(Exception):
+    # args are the reason, the text of the token it is about and the
+    # token's line and offset
+    pass
+
+
+def labels(code):
+    # (name, line, offset) of every label the expression uses
+    return [step[1:] for step in code if step[0] == LABEL]
+
+
+def evaluate(code, addresses):
+    # Value of an expression, with label addresses from addresses
+    stack = []
+    for step in code:
+        kind = step[0]
+        if kind == CONST:
+            stack.append(step[1])
+        elif kind == LABEL:
+            address = addresses.get(step[1])
+            if address is None:
+                raise ExpressionError(f"Unknown label: '{step[1]}'", *step[1:])
+            stack.append(address)
+        elif kind == UNARY:
+            stack[-1] = unary[step[1]](stack[-1])
+        else:
+            symbol = step[1]
+            right = stack.pop()
+            if symbol in ("/", "%") and right == 0:
+                raise ExpressionError("division by zero", *step[1:])
+            if symbol in ("<<", ">>") and not 0 <= right <= 31:
+                raise ExpressionError(f"shift by {right} is out of range.", *step[1:])
+            stack[-1] = binary[symbol](stack[-1], right)
+    return stack[0]
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Writes the generated parser module (see ply/codegen.py) and checks that it
+# behaves exactly like the table-driven LRParser.
+
+import argparse
+import contextlib
+import io
+from parser import Parser
+from ply import codegen
+import sys
+
+
+def variants(code):
+    # The source itself, every prefix of its lines and the source with each
+    # single line deleted, so that both accepted and rejected inputs are seen
+    lines = code.splitlines(keepends=True)
+    yield code
+    for i in range(len(lines)):
+        yield "".join(lines[:i])
+        yield "".join(lines[:i] + lines[i + 1 :])
+
+
+def run(parser, automaton, code):
+    parser._failed = False
+    parser._lexer.lineno = 1
+    parser._lexer.begin("INITIAL")
+    parser._lexer.input(code)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            result = automaton.parse(lexer=parser._lexer)
+        except Exception as e:
+            result = repr(e)
+    return result, parser._failed, output.getvalue()
+
+
+def check(files):
+    parser = Parser()
+    tables = parser._parser
+    generated = codegen.load(tables)
+
+    checked = 0
+    mismatches = 0
+    for name in files:
+        with open(name) as f:
+            code = f.read()
+        parser._file_name = name
+        for variant in variants(code):
+            checked += 1
+            expected = run(parser, tables, variant)
+            actual = run(parser, generated, variant)
+            if actual != expected:
+                mismatches += 1
+                print(f"{name}: generated parser differs on input:\n{variant}", file=sys.stderr)
+
+    print(f"checked {checked} inputs, {mismatches} mismatches")
+    return mismatches == 0
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-o", default="parsetab.py", help="Output file (default: parsetab.py)")
+    argparser.add_argument(
+        "--check",
+        nargs="+",
+        metavar="FILE",
+        help="Compare the generated parser against the table-driven one on these sources instead",
+    )
+    args = argparser.parse_args()
+
+    if args.check:
+        sys.exit(0 if check(args.check) else 1)
+
+    parser = Parser()
+    with open(args.o, "w") as file:
+        file.write(codegen.generate(parser._parser))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+from array import array
+from isa import (
+    DSEL_SHIFT,
+    OPCODE_SHIFT,
+    OPERAND_MASK,
+    WORD_BITS,
+    decode_instruction,
+    opcode_map,
+    opcode_names,
+    r_type,
+    regnum,
+)
+import sys
+
+# Struct-of-arrays form of a program, one entry per instruction or data
+# directive in each column:
+#
+#   op      opcode (see isa.opcode_map), or one of the data opcodes below
+#   rd      register selected by the instruction (Dsel)
+#   rs1     first source register of add/sub/slt
+#   rs2     second source register of add/sub/slt
+#   imm     immediate or address operand
+#   ref     index into refs of an unresolved label reference, or NO_REF
+#   count   number of words the entry occupies
+#   line    source line of the instruction
+#   offset  source offset of the instruction
+#
+# Fields an instruction does not use are 0. refs holds (label, line, offset)
+# for every label reference, or (code, line, offset, end) for an expression
+# using labels (see expr.py), and labels maps the labels defined in the
+# program to their addresses. size is the number of words in the program.
+# label_values lists the entries whose immediate was computed from label
+# addresses without being an address operand (li), which moving code around
+# would leave stale.
+NO_REF = 0xFFFFFFFF
+
+# Data entries use opcodes past the 4-bit ISA opcodes. .fill and .space are
+# stored as a single run and .incbin keeps the file's memory mapped, so bulk
+# data takes no memory per word.
+WORD = 16  # .word: imm is the word
+FILL = 17  # .fill/.space: count copies of imm
+INCBIN = 18  # .incbin: blobs[imm] is (path, data)
+
+WORD_MASK = (1 << WORD_BITS) - 1
+
+
+def encode(op, rd, rs1, rs2, imm):
+    # Word of an instruction from its columns. Only add/sub/slt use rs1/rs2
+    # and only the other instructions use imm, so the operand field is the
+    # same expression for every instruction. Works the same on numbers and on
+    # numpy arrays of whole columns.
+    return (op << OPCODE_SHIFT) | (rd << DSEL_SHIFT) | (((rs1 << 2) | rs2 | imm) & OPERAND_MASK)
+
+
+def blob_words(data):
+    # .incbin data is little-endian 16-bit words, like object files
+    words = memoryview(data).cast("H")
+    if sys.byteorder == "big":
+        words = array("H", words)
+        words.byteswap()
+    return words
+
+
+class Program:
+    def __init__(self):
+        self.op = array("B")
+        self.rd = array("B")
+        self.rs1 = array("B")
+        self.rs2 = array("B")
+        self.imm = array("H")
+        self.ref = array("I")
+        self.count = array("I")
+        self.line = array("I")
+        self.offset = array("I")
+        self.refs = []
+        self.blobs = []
+        self.labels = {}
+        self.size = 0
+        self.has_data = False
+        self.label_values = []
+
+    def __len__(self):
+        return len(self.op)
+
+    def add(self, op, rd=0, rs1=0, rs2=0, imm=0, ref=NO_REF, count=1, line=0, offset=0):
+        self.op.append(op)
+        self.rd.append(rd)
+        self.rs1.append(rs1)
+        self.rs2.append(rs2)
+        self.imm.append(imm)
+        self.ref.append(ref)
+        self.count.append(count)
+        self.line.append(line)
+        self.offset.append(offset)
+        self.size += count
+        if op >= WORD:
+            self.has_data = True
+
+    def append(self, instr, line=0, offset=0):
+        # instr is an instruction tuple such as ("add", "D3", "D1", "D2").
+        # Address operands may be ("label_ref", name, line, offset) or
+        # ("expr", code, line, offset, end) tuples.
+        # Data is given as (".word", value, ...), (".fill", count, value),
+        # (".space", count) or (".incbin", path, data).
+        op = instr[0]
+
+        if op == ".word":
+            for value in instr[1:]:
+                self.add(WORD, imm=value & WORD_MASK, line=line, offset=offset)
+            return
+        elif op in (".fill", ".space"):
+            value = instr[2] & WORD_MASK if op == ".fill" else 0
+            if instr[1]:
+                self.add(FILL, imm=value, count=instr[1], line=line, offset=offset)
+            return
+        elif op == ".incbin":
+            count = len(instr[2]) // 2
+            if count:
+                self.blobs.append(instr[1:])
+                self.add(INCBIN, imm=len(self.blobs) - 1, count=count, line=line, offset=offset)
+            return
+
+        rd = rs1 = rs2 = imm = 0
+        ref = NO_REF
+
+        if op in r_type:
+            rd, rs1, rs2 = (regnum(r) for r in instr[1:])
+        else:
+            for part in instr[1:]:
+                if isinstance(part, str):
+                    rd = regnum(part)
+                elif isinstance(part, tuple):
+                    ref = len(self.refs)
+                    self.refs.append(part[1:])
+                else:
+                    imm = part
+
+        self.add(opcode_map[op], rd, rs1, rs2, imm, ref, line=line, offset=offset)
+
+    def instruction(self, i):
+        op = self.op[i]
+        if op == WORD:
+            return (".word", self.imm[i])
+        elif op == FILL:
+            return (".fill", self.count[i], self.imm[i])
+        elif op == INCBIN:
+            return (".incbin", self.blobs[self.imm[i]][0])
+
+        op = opcode_names[op]
+        rd = f"D{self.rd[i]}"
+        if self.ref[i] != NO_REF:
+            addr = ("label_ref", self.refs[self.ref[i]][0])
+        else:
+            addr = self.imm[i]
+
+        if op in r_type:
+            return (op, rd, f"D{self.rs1[i]}", f"D{self.rs2[i]}")
+        elif op in ("li", "lw", "sw", "beq", "bne"):
+            return (op, rd, addr)
+        elif op in ("push", "pop"):
+            return (op, rd)
+        elif op in ("j", "jal"):
+            return (op, addr)
+        else:
+            return (op,)
+
+    def word(self, i):
+        # Encoding of an entry that occupies one word
+        op = self.op[i]
+        if op >= WORD:
+            return self.imm[i]
+        return encode(op, self.rd[i], self.rs1[i], self.rs2[i], self.imm[i])
+
+    def instructions(self):
+        # One tuple per word, with runs and included files expanded to .word
+        result = []
+        for i in range(len(self)):
+            op = self.op[i]
+            if op == FILL:
+                result.extend([(".word", self.imm[i])] * self.count[i])
+            elif op == INCBIN:
+                result.extend((".word", word) for word in blob_words(self.blobs[self.imm[i]][1]))
+            else:
+                result.append(self.instruction(i))
+        return result
+
+    def encode(self):
+        # Every word of the program
+        columns = zip(self.op, self.rd, self.rs1, self.rs2, self.imm)
+        if not self.has_data:
+            return array("H", [encode(*fields) for fields in columns])
+
+        words = array("H")
+        for i, (op, rd, rs1, rs2, imm) in enumerate(columns):
+            if op == WORD:
+                words.append(imm)
+            elif op == FILL:
+                words.extend(array("H", (imm,)) * self.count[i])
+            elif op == INCBIN:
+                words.extend(blob_words(self.blobs[imm][1]))
+            else:
+                words.append(encode(op, rd, rs1, rs2, imm))
+        return words
+
+    def moved(self, instructions, origins, addresses):
+        # The program of instructions, one tuple per word as from
+        # instructions(), where word k was word origins[k] of this program
+        # and addresses maps the words of this program, and its end, to their
+        # new addresses. Source positions and labels follow the words, and
+        # .fill/.incbin runs that are still whole stay runs.
+        entry = array("I")
+        first = []
+        for i in range(len(self)):
+            first.append(len(entry))
+            entry.extend(array("I", (i,)) * self.count[i])
+
+        result = Program()
+        k = 0
+        while k < len(instructions):
+            i = entry[origins[k]]
+            count = self.count[i]
+            start = first[i]
+            if count > 1 and origins[k : k + count] == list(range(start, start + count)):
+                imm = self.imm[i]
+                if self.op[i] == INCBIN:
+                    result.blobs.append(self.blobs[imm])
+                    imm = len(result.blobs) - 1
+                result.add(self.op[i], imm=imm, count=count, line=self.line[i], offset=self.offset[i])
+                k += count
+                continue
+            result.append(instructions[k], self.line[i], self.offset[i])
+            k += 1
+        result.labels = {name: addresses[address] for name, address in self.labels.items()}
+        return result
+
+    @classmethod
+    def from_words(cls, words):
+        # Words that are not instructions come from data directives
+        program = cls()
+        for word in words:
+            if (word >> OPCODE_SHIFT) in opcode_names:
+                program.append(decode_instruction(word))
+            else:
+                program.add(WORD, imm=word)
+        return program
@@ -0,0 +1,86 @@
+opcode_map = {
+    "add": 0b0000,
+    "sub": 0b0001,
+    "slt": 0b0010,
+    "li": 0b0011,
+    "lw": 0b0100,
+    "sw": 0b0101,
+    "beq": 0b0110,
+    "bne": 0b0111,
+    "push": 0b1000,
+    "pop": 0b1001,
+    "j": 0b1010,
+    "jal": 0b1011,
+    "jr": 0b1100,
+    "nop": 0b1101,
+}
+
+opcode_names = {opcode: op for op, opcode in opcode_map.items()}
+
+ADD = opcode_map["add"]
+SUB = opcode_map["sub"]
+SLT = opcode_map["slt"]
+LI = opcode_map["li"]
+LW = opcode_map["lw"]
+SW = opcode_map["sw"]
+BEQ = opcode_map["beq"]
+BNE = opcode_map["bne"]
+PUSH = opcode_map["push"]
+POP = opcode_map["pop"]
+J = opcode_map["j"]
+JAL = opcode_map["jal"]
+JR = opcode_map["jr"]
+NOP = opcode_map["nop"]
+
+# Instructions that end a basic block
+control = (BEQ, BNE, J, JAL, JR)
+
+# Words the hardware stack shared by push/pop and jal/jr holds
+STACK_DEPTH = 8
+
+r_type = ("add", "sub", "slt")
+
+# Instruction word layout, from the most significant bits down: opcode, Dsel
+# and an operand holding an immediate, an address or, for add/sub/slt, the
+# two source registers
+OPCODE_BITS = 4
+DSEL_BITS = 2
+OPERAND_BITS = 5
+WORD_BITS = OPCODE_BITS + DSEL_BITS + OPERAND_BITS
+
+DSEL_SHIFT = OPERAND_BITS
+OPCODE_SHIFT = OPERAND_BITS + DSEL_BITS
+DSEL_MASK = (1 << DSEL_BITS) - 1
+OPERAND_MASK = (1 << OPERAND_BITS) - 1
+
+# Cycles each instruction takes, for cycle estimates (as.py --cycles
+# overrides them)
+cycle_costs = {op: 1 for op in opcode_map}
+
+
+def regnum(r):
+    return int(r[1])
+
+
+def decode_instruction(word):
+    op = opcode_names.get(word >> OPCODE_SHIFT)
+    if op is None:
+        raise ValueError(f"Unknown opcode in word: {word:011b}")
+
+    dsel = f"D{(word >> DSEL_SHIFT) & DSEL_MASK}"
+    operand = word & OPERAND_MASK
+
+    if op in r_type:
+        return (op, dsel, f"D{(operand >> 2) & 0b11}", f"D{operand & 0b11}")
+
+    elif op in ("li", "lw", "sw", "beq", "bne"):
+        return (op, dsel, operand)
+
+    elif op in ("push", "pop"):
+        return (op, dsel)
+
+    elif op in ("j", "jal"):
+        return (op, operand)
+
+    else:
+        return (op,)
@@ -0,0 +1,141 @@
+from cfg import Graph
+from ir import WORD
+from peephole import address_operand, references, retarget
+
+# Layout pass for programs that do not fit in memory, over resolved
+# programs like the peephole optimizer.
+#
+# The program is cut into units after every j and jr: nothing falls into the
+# start of a unit, so units can be moved around as long as every address
+# operand is moved with them. jal returns to the word after it, and beq/bne
+# and everything else fall through, within a unit. Then
+#
+#   - units ending with the same instructions share them: all but the first
+#     of one copy are removed and the first becomes a j to the other copy,
+#     or the whole unit goes if all of it is shared;
+#   - a unit ending with "j X", where X starts another unit, is followed by
+#     that unit and the j is dropped.
+#
+# Address 0 stays where it is, as does a last unit that runs off the end of
+# the program. Words that lw/sw refer to and data words are never removed or
+# shared. Like the stack check, this assumes jr only returns from jal.
+
+
+def units(instructions):
+    # Lists of word addresses, cut after every j and jr
+    result = [[]]
+    for i, instr in enumerate(instructions):
+        result[-1].append(i)
+        if instr[0] in ("j", "jr") and i + 1 < len(instructions):
+            result.append([])
+    return result
+
+
+def layout(program):
+    # Returns the program laid out again and the number of words saved
+    instructions = program.instructions()
+    n = len(instructions)
+    _, data = references(instructions)
+    parts = units(instructions)
+
+    # Words removed, and the word that now stands in for each
+    moved = {}
+
+    def ends(part):
+        return instructions[part[-1]][0] in ("j", "jr")
+
+    # The last unit may run off the end
+    open_end = len(parts) - 1 if not ends(parts[-1]) else None
+
+    # Shared tails
+    kept = []
+    for u, part in enumerate(parts):
+        if not ends(part):
+            continue
+        best, shared = None, 0
+        for v in kept:
+            other = parts[v]
+            length = 0
+            while length < min(len(part), len(other)):
+                a, b = part[-1 - length], other[-1 - length]
+                if a in data or b in data or b in moved or instructions[a] != instructions[b]:
+                    break
+                length += 1
+            if length > shared:
+                best, shared = v, length
+        whole = shared == len(part) and u != 0
+        if shared >= 2 or whole:
+            other = parts[best]
+            for k in range(1, shared + 1):
+                moved[part[-k]] = other[-k]
+            if whole:
+                parts[u] = []
+                continue
+            first = part[-shared]
+            del moved[first]
+            instructions[first] = ("j", other[-shared])
+            parts[u] = part[: len(part) - shared + 1]
+        kept.append(u)
+
+    # Fall through instead of jumping to the next unit
+    starts = {part[0]: u for u, part in enumerate(parts) if part}
+    follows = {}
+    pulled = set()
+    for u, part in enumerate(parts):
+        if not part or instructions[part[-1]][0] != "j" or part[-1] in data:
+            continue
+        v = starts.get(instructions[part[-1]][1])
+        if v is None or v in (0, u, open_end) or v in pulled:
+            continue
+        w = v
+        while w in follows:
+            w = follows[w]
+        if w == u:
+            continue
+        follows[u] = v
+        pulled.add(v)
+        moved[part[-1]] = instructions[part[-1]][1]
+        parts[u] = part[:-1]
+
+    # Chains of units from address 0 on, and anything that runs off the end
+    # last
+    order = []
+    heads = [u for u in range(len(parts)) if u not in pulled and (parts[u] or u in follows)]
+    last = [u for u in heads if u == open_end]
+    for head in [u for u in heads if u not in last] + last:
+        u = head
+        while True:
+            order.extend(parts[u])
+            if u not in follows:
+                break
+            u = follows[u]
+
+    new_address = {}
+    for address, i in enumerate(order):
+        new_address[i] = address
+    for i in moved:
+        j = i
+        while j in moved:
+            j = moved[j]
+        new_address[i] = new_address[j]
+
+    words = []
+    for i in order:
+        instr = instructions[i]
+        index = address_operand.get(instr[0])
+        # Addresses past the end of the program point at free RAM
+        if index is not None and instr[index] < n:
+            instr = retarget(instr, new_address[instr[index]])
+        words.append(instr)
+    addresses = [new_address[i] for i in range(n)] + [len(words)]
+    result = program.moved(words, order, addresses)
+    return result, n - result.size
+
+
+def overflow(program, depth):
+    # [first, end) entry ranges of the blocks and data entries that reach
+    # past depth words, in address order
+    graph = Graph(program)
+    ranges = [(first, end) for first, end in graph.blocks if graph.address[end] > depth]
+    ranges += [(i, i + 1) for i in range(len(program)) if program.op[i] >= WORD and graph.address[i + 1] > depth]
+    return graph, sorted(ranges)
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+
+# Language server for assembly sources, speaking the Language Server
+# Protocol on stdin/stdout. It answers go to definition, find references and
+# completion of labels from an index of every .s file in the workspace:
+#
+#   definitions  label -> {path: [(line, column), ...]}
+#   uses         label -> {path: [(line, column), ...]}
+#
+# The entries come from Parser.symbols, so files with errors are indexed
+# too. All of a file's entries are replaced when it changes, in the editor or
+# on disk, so an update takes time proportional to that file and a query
+# only looks at the label it is about.
+#
+# The entries of the files on disk are saved to a cache file (.as-index.json
+# in the workspace root by default) on shutdown, with each file's size and
+# modification time. On the next start only files that have changed since
+# are read and lexed again.
+#
+# Lines and columns are 0-based as in the protocol. Columns count UTF-16
+# code units, the protocol's default, or characters when the client offers
+# the "utf-32" position encoding. Label names are ASCII, one unit per
+# character either way, so only the text before a label needs converting.
+#
+# A handler that fails answers its request with an internal error; the
+# server keeps running. Clients that support it are asked to watch the .s
+# files of the workspace once initialized.
+
+import argparse
+import json
+import os
+from parser import Parser
+import sys
+from urllib.parse import quote, unquote, urlparse
+
+CACHE_NAME = ".as-index.json"
+CACHE_VERSION = 2
+
+EXTENSIONS = (".s",)
+
+# Protocol constants
+SYNC_INCREMENTAL = 2
+COMPLETION_REFERENCE = 18
+FILE_DELETED = 3
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+UTF16 = "utf-16"
+UTF32 = "utf-32"
+
+
+def path_of(uri):
+    return os.path.abspath(unquote(urlparse(uri).path))
+
+
+def uri_of(path):
+    return "file://" + quote(path)
+
+
+def line_starts(text):
+    starts = [0]
+    i = text.find("\n")
+    while i >= 0:
+        starts.append(i + 1)
+        i = text.find("\n", i + 1)
+    return starts
+
+
+def units(text, encoding):
+    # Length of text in the units of the position encoding
+    if encoding == UTF32 or text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def index_of(line, column, encoding):
+    # Index in line of a column in the units of the position encoding
+    if encoding == UTF32 or line.isascii():
+        return min(column, len(line))
+    count = 0
+    for i, c in enumerate(line):
+        if count >= column:
+            return i
+        count += 2 if ord(c) > 0xFFFF else 1
+    return len(line)
+
+
+def apply_change(text, change, encoding=UTF16):
+    # A change without a range replaces the whole document
+    if "range" not in change:
+        return change["text"]
+    starts = line_starts(text)
+
+    def offset(position):
+        line = position["line"]
+        if line >= len(starts):
+            return len(text)
+        end = starts[line + 1] - 1 if line + 1 < len(starts) else len(text)
+        return starts[line] + index_of(text[starts[line] : end], position["character"], encoding)
+
+    start, end = offset(change["range"]["start"]), offset(change["range"]["end"])
+    return text[:start] + change["text"] + text[end:]
+
+
+def stamp(path):
+    # (modification time, size) of a file, or None if it cannot be read
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def read(path):
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class Index:
+    def __init__(self, parser, encoding=UTF16):
+        self.parser = parser
+        self.encoding = encoding
+        # path -> (stamp, definitions, uses), each a list of (name, line,
+        # column). stamp is None for text that is not what is on disk.
+        self.files = {}
+        # path -> {line: [(column, name), ...]}, to find the label at a
+        # position
+        self.lines = {}
+        self.definitions = {}
+        self.uses = {}
+
+    def update(self, path, text, file_stamp=None):
+        starts = line_starts(text)
+        definitions, uses = self.parser.symbols(text)
+
+        def column(line, offset):
+            return units(text[starts[line - 1] : offset], self.encoding)
+
+        self.add(
+            path,
+            file_stamp,
+            [(name, line - 1, column(line, offset)) for name, line, offset in definitions],
+            [(name, line - 1, column(line, offset)) for name, line, offset in uses],
+        )
+
+    def add(self, path, file_stamp, definitions, uses):
+        self.remove(path)
+        self.files[path] = (file_stamp, definitions, uses)
+        lines = self.lines[path] = {}
+        for table, entries in ((self.definitions, definitions), (self.uses, uses)):
+            for name, line, column in entries:
+                table.setdefault(name, {}).setdefault(path, []).append((line, column))
+                lines.setdefault(line, []).append((column, name))
+
+    def remove(self, path):
+        entry = self.files.pop(path, None)
+        if entry is None:
+            return
+        del self.lines[path]
+        for table, entries in ((self.definitions, entry[1]), (self.uses, entry[2])):
+            for name, _, _ in entries:
+                paths = table.get(name)
+                if paths is not None and path in paths:
+                    del paths[path]
+                    if not paths:
+                        del table[name]
+
+    def at(self, path, line, column):
+        # Label defined or used at a position, or None
+        for start, name in self.lines.get(path, {}).get(line, ()):
+            if start <= column <= start + len(name):
+                return name
+        return None
+
+    def locations(self, table, name):
+        return [(path, line, column) for path, places in table.get(name, {}).items() for line, column in places]
+
+    def scan(self, root, cache=None):
+        # Indexes every source file under root, taking the entries of files
+        # that have not changed from the cache file
+        cached = {}
+        if cache is not None:
+            try:
+                with open(cache) as f:
+                    data = json.load(f)
+                # Columns are only valid in the encoding they were counted in
+                if data.get("version") == CACHE_VERSION and data.get("encoding") == self.encoding:
+                    cached = data["files"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        for directory, subdirectories, names in os.walk(root):
+            subdirectories[:] = [name for name in subdirectories if not name.startswith(".")]
+            for name in names:
+                if not name.endswith(EXTENSIONS):
+                    continue
+                path = os.path.join(directory, name)
+                file_stamp = stamp(path)
+                entry = cached.get(path)
+                if entry is not None and entry["stamp"] == file_stamp:
+                    self.add(
+                        path,
+                        file_stamp,
+                        [tuple(d) for d in entry["definitions"]],
+                        [tuple(u) for u in entry["uses"]],
+                    )
+                    continue
+                text = read(path)
+                if text is not None:
+                    self.update(path, text, file_stamp)
+
+    def save(self, cache):
+        files = {
+            path: {"stamp": file_stamp, "definitions": definitions, "uses": uses}
+            for path, (file_stamp, definitions, uses) in self.files.items()
+            if file_stamp is not None
+        }
+        # Written next to the cache and renamed, so a reader never sees half
+        # of it
+        temporary = cache + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"version": CACHE_VERSION, "encoding": self.encoding, "files": files}, f, separators=(",", ":"))
+        os.replace(temporary, cache)
+
+
+def location(path, line, column, name):
+    return {
+        "uri": uri_of(path),
+        "range": {
+            "start": {"line": line, "character": column},
+            "end": {"line": line, "character": column + len(name)},
+        },
+    }
+
+
+class Server:
+    def __init__(self, parser, cache=None, output=None):
+        self.index = Index(parser)
+        self.cache = cache
+        self.output = output or sys.stdout.buffer
+        # Text of the documents open in the editor, which take the place of
+        # the files on disk
+        self.documents = {}
+        self.running = True
+        # Client capabilities from initialize, and the id of the next
+        # request sent to the client
+        self.capabilities = {}
+        self.next_id = 1
+        self.handlers = {
+            "initialize": self.initialize,
+            "initialized": self.initialized,
+            "shutdown": self.shutdown,
+            "exit": self.exit,
+            "textDocument/didOpen": self.did_open,
+            "textDocument/didChange": self.did_change,
+            "textDocument/didSave": self.did_save,
+            "textDocument/didClose": self.did_close,
+            "workspace/didChangeWatchedFiles": self.did_change_watched_files,
+            "textDocument/definition": self.definition,
+            "textDocument/references": self.references,
+            "textDocument/completion": self.completion,
+        }
+
+    def send(self, message):
+        message["jsonrpc"] = "2.0"
+        body = json.dumps(message).encode()
+        self.output.write(f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        self.output.flush()
+
+    def request(self, method, params):
+        self.send({"id": self.next_id, "method": method, "params": params})
+        self.next_id += 1
+
+    def handle(self, message):
+        # Responses to the server's own requests need nothing done
+        if "method" not in message:
+            return
+        method = message["method"]
+        handler = self.handlers.get(method)
+        # Requests have an id and get a response, notifications do not
+        if "id" not in message:
+            if handler is not None:
+                try:
+                    handler(message.get("params") or {})
+                except Exception as e:
+                    print(f"{method}: {e!r}", file=sys.stderr)
+            return
+        if handler is None:
+            self.send({"id": message["id"], "error": {"code": METHOD_NOT_FOUND, "message": f"unknown method '{method}'"}})
+            return
+        try:
+            result = handler(message.get("params") or {})
+        except Exception as e:
+            print(f"{method}: {e!r}", file=sys.stderr)
+            self.send({"id": message["id"], "error": {"code": INTERNAL_ERROR, "message": f"{method}: {e!r}"}})
+            return
+        self.send({"id": message["id"], "result": result})
+
+    def initialize(self, params):
+        self.capabilities = params.get("capabilities") or {}
+        encodings = self.capabilities.get("general", {}).get("positionEncodings", ())
+        self.index.encoding = UTF32 if UTF32 in encodings else UTF16
+        root = None
+        if params.get("rootUri"):
+            root = path_of(params["rootUri"])
+        elif params.get("rootPath"):
+            root = os.path.abspath(params["rootPath"])
+        elif params.get("workspaceFolders"):
+            root = path_of(params["workspaceFolders"][0]["uri"])
+        if root is not None:
+            if self.cache is None:
+                self.cache = os.path.join(root, CACHE_NAME)
+            self.index.scan(root, self.cache)
+        return {
+            "capabilities": {
+                "textDocumentSync": {"openClose": True, "change": SYNC_INCREMENTAL, "save": True},
+                "definitionProvider": True,
+                "referencesProvider": True,
+                "completionProvider": {},
+                "positionEncoding": self.index.encoding,
+            },
+            "serverInfo": {"name": "as"},
+        }
+
+    def initialized(self, params):
+        # Files changed outside the editor are only reported if asked for
+        watched = self.capabilities.get("workspace", {}).get("didChangeWatchedFiles", {})
+        if watched.get("dynamicRegistration"):
+            watchers = [{"globPattern": f"**/*{extension}"} for extension in EXTENSIONS]
+            registration = {
+                "id": "watched-files",
+                "method": "workspace/didChangeWatchedFiles",
+                "registerOptions": {"watchers": watchers},
+            }
+            self.request("client/registerCapability", {"registrations": [registration]})
+
+    def shutdown(self, params):
+        if self.cache is not None:
+            try:
+                self.index.save(self.cache)
+            except OSError as e:
+                print(f"cannot write {self.cache}: {e.strerror}", file=sys.stderr)
+        return None
+
+    def exit(self, params):
+        self.running = False
+
+    def reload(self, path):
+        # Indexes a file as it is on disk
+        text = read(path)
+        if text is None:
+            self.index.remove(path)
+        else:
+            self.index.update(path, text, stamp(path))
+
+    def did_open(self, params):
+        document = params["textDocument"]
+        path = path_of(document["uri"])
+        self.documents[path] = document["text"]
+        self.index.update(path, document["text"])
+
+    def did_change(self, params):
+        path = path_of(params["textDocument"]["uri"])
+        text = self.documents.get(path, "")
+        for change in params["contentChanges"]:
+            text = apply_change(text, change, self.index.encoding)
+        self.documents[path] = text
+        self.index.update(path, text)
+
+    def did_save(self, params):
+        path = path_of(params["textDocument"]["uri"])
+        if path in self.documents:
+            self.reload(path)
+
+    def did_close(self, params):
+        path = path_of(params["textDocument"]["uri"])
+        self.documents.pop(path, None)
+        if path.endswith(EXTENSIONS):
+            self.reload(path)
+        else:
+            self.index.remove(path)
+
+    def did_change_watched_files(self, params):
+        for change in params["changes"]:
+            path = path_of(change["uri"])
+            if path in self.documents:
+                continue
+            if change["type"] == FILE_DELETED:
+                self.index.remove(path)
+            elif path.endswith(EXTENSIONS):
+                self.reload(path)
+
+    def name_at(self, params):
+        position = params["position"]
+        return self.index.at(path_of(params["textDocument"]["uri"]), position["line"], position["character"])
+
+    def definition(self, params):
+        name = self.name_at(params)
+        if name is None:
+            return []
+        return [location(*place, name) for place in self.index.locations(self.index.definitions, name)]
+
+    def references(self, params):
+        name = self.name_at(params)
+        if name is None:
+            return []
+        places = self.index.locations(self.index.uses, name)
+        if params.get("context", {}).get("includeDeclaration"):
+            places = self.index.locations(self.index.definitions, name) + places
+        return [location(*place, name) for place in places]
+
+    def completion(self, params):
+        return [{"label": name, "kind": COMPLETION_REFERENCE} for name in self.index.definitions]
+
+
+def read_message(stream):
+    # One message from a stream of Content-Length framed JSON, or None at
+    # the end
+    length = None
+    while True:
+        line = stream.readline()
+        if not line:
+            return None
+        line = line.strip()
+        if not line:
+            break
+        name, _, value = line.decode("ascii").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    if length is None:
+        return None
+    return json.loads(stream.read(length))
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--cache", metavar="FILE", help=f"Index cache file (default: {CACHE_NAME} in the workspace root)"
+    )
+    # Editors commonly pass --stdio; it is the only transport
+    argparser.add_argument("--stdio", action="store_true", help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    server = Server(Parser(), args.cache)
+    while server.running:
+        message = read_message(sys.stdin.buffer)
+        if message is None:
+            break
+        server.handle(message)
+
+
+if __name__ == "__main__":
+    main()
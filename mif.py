@@ -0,0 +1,172 @@
+from ir import FILL, INCBIN, WORD, blob_words, encode
+
+# numpy is optional. Large images are formatted with it when it is installed;
+# the result is byte for byte the same as the scalar formatter's.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Smallest depth worth handing to numpy
+VECTOR_DEPTH = 1024
+
+
+def header(depth):
+    return f"""-- Auto generated by https://github.com/nicholasnloehrke/as
+
+WIDTH=11;
+DEPTH={depth};
+
+ADDRESS_RADIX=UNS;
+DATA_RADIX=BIN;
+
+CONTENT BEGIN
+"""
+
+
+def comment(instr):
+    op = instr[0]
+    text = f"-- {op}{' ' * (4 - len(op))}"
+    operands = instr[1:]
+
+    if len(operands) >= 1:
+        text += f" {operands[0]}"
+        for operand in operands[1:]:
+            text += f", {operand}"
+
+    return text
+
+
+def render(program, depth=32):
+    if numpy is not None and depth >= VECTOR_DEPTH:
+        body = render_vectorized(program, depth)
+    else:
+        body = render_scalar(program, depth)
+    return header(depth) + body + "END;"
+
+
+def run_line(address, count, value, text):
+    # .fill and .space runs take one line for the whole address range
+    return f"[{address:02}..{address + count - 1:02}] : {value:011b}; {text}\n"
+
+
+def render_scalar(program, depth):
+    lines = []
+    address = 0
+    for i in range(len(program)):
+        op = program.op[i]
+        count = program.count[i]
+        text = comment(program.instruction(i))
+
+        if op == FILL and count > 1:
+            lines.append(run_line(address, count, program.imm[i], text))
+        elif op == INCBIN:
+            words = blob_words(program.blobs[program.imm[i]][1])
+            lines.append(f"{address:02} : {words[0]:011b}; {text}\n")
+            for j in range(1, count):
+                lines.append(f"{address + j:02} : {words[j]:011b};\n")
+        else:
+            lines.append(f"{address:02} : {program.word(i):011b}; {text}\n")
+        address += count
+
+    for j in range(address, depth):
+        lines.append(f"{j:02} : 00000000000;\n")
+
+    return "".join(lines)
+
+
+def render_vectorized(program, depth):
+    # Entries of one word each are formatted a stretch at a time by
+    # format_lines(); .fill/.space runs and included files break the
+    # stretches up.
+    np = numpy
+    n = len(program)
+
+    op = np.frombuffer(program.op, dtype=np.uint8).astype(np.uint32)
+    rd = np.frombuffer(program.rd, dtype=np.uint8).astype(np.uint32)
+    rs1 = np.frombuffer(program.rs1, dtype=np.uint8).astype(np.uint32)
+    rs2 = np.frombuffer(program.rs2, dtype=np.uint8).astype(np.uint32)
+    imm = np.frombuffer(program.imm, dtype=np.uint16).astype(np.uint32)
+    count = np.frombuffer(program.count, dtype=np.uint32)
+
+    words = np.where(op >= WORD, imm, encode(op, rd, rs1, rs2, imm))
+    # Comments show imm in full, so distinct entries are told apart by all of
+    # their fields rather than by the encoded word
+    key = op | (rd << 5) | (rs1 << 7) | (rs2 << 9) | (imm << 11)
+    bulk = np.flatnonzero((op == INCBIN) | ((op == FILL) & (count > 1)))
+    starts = np.concatenate(([0], np.cumsum(count, dtype=np.int64)))
+
+    parts = []
+    first = 0
+    for last in list(bulk) + [n]:
+        if last > first:
+            _, index, inverse = np.unique(key[first:last], return_index=True, return_inverse=True)
+            tails = [f"; {comment(program.instruction(first + int(i)))}\n".encode() for i in index]
+            parts.append(format_lines(int(starts[first]), words[first:last], inverse.reshape(-1), tails))
+
+        if last < n:
+            address = int(starts[last])
+            text = comment(program.instruction(last))
+            if op[last] == FILL:
+                parts.append(run_line(address, int(count[last]), int(imm[last]), text))
+            else:
+                data = np.frombuffer(program.blobs[imm[last]][1], dtype="<u2")
+                tail = np.ones(len(data), dtype=np.int64)
+                tail[0] = 0
+                parts.append(format_lines(address, data, tail, [f"; {text}\n".encode(), b";\n"]))
+        first = last + 1
+
+    size = int(starts[-1])
+    if size < depth:
+        parts.append(
+            format_lines(size, np.zeros(depth - size, dtype=np.uint16), np.zeros(depth - size, dtype=np.int64), [b";\n"])
+        )
+
+    return "".join(parts)
+
+
+def format_lines(first_address, words, tail, tails):
+    # Line k is "<first_address + k> : <words[k] in binary><tails[tail[k]]>".
+    # The lines are laid out in one byte buffer: addresses and bits are
+    # written digit by digit for all lines at once, and tails are copied from
+    # the table.
+    np = numpy
+    n = len(words)
+
+    tail_lengths = np.array([len(t) for t in tails], dtype=np.int64)
+    tail_offsets = np.concatenate(([0], np.cumsum(tail_lengths)[:-1]))
+    tail_bytes = np.frombuffer(b"".join(tails), dtype=np.uint8)
+
+    # Addresses are at least two digits wide
+    address = np.arange(first_address, first_address + n, dtype=np.int64)
+    width = np.full(n, 2, dtype=np.int64)
+    power = 100
+    while power < first_address + n:
+        width[address >= power] += 1
+        power *= 10
+
+    lengths = tail_lengths[tail]
+    length = width + 3 + 11 + lengths
+    start = np.concatenate(([0], np.cumsum(length)[:-1]))
+    buffer = np.empty(int(length.sum()), dtype=np.uint8)
+
+    for k in range(int(width.max(initial=0))):
+        digit = k < width
+        buffer[(start + width - 1 - k)[digit]] = (address[digit] // 10**k) % 10 + ord("0")
+
+    separator = start + width
+    buffer[separator[:, None] + np.arange(3)] = np.frombuffer(b" : ", dtype=np.uint8)
+
+    shifts = np.arange(10, -1, -1, dtype=np.uint16)
+    bits = (words.astype(np.uint16)[:, None] >> shifts) & 1
+    buffer[(separator + 3)[:, None] + np.arange(11)] = bits + ord("0")
+
+    # Copy each line's tail: byte m of the tail of line l goes from
+    # tail_offsets[tail[l]] + m to separator[l] + 14 + m
+    copied = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    index = np.arange(int(lengths.sum()), dtype=np.int64)
+    buffer[np.repeat(separator + 14 - copied, lengths) + index] = tail_bytes[
+        np.repeat(tail_offsets[tail] - copied, lengths) + index
+    ]
+
+    return buffer.tobytes().decode()
@@ -0,0 +1,139 @@
+from array import array
+from isa import OPERAND_MASK
+import struct
+import sys
+
+# Relocatable object format (all integers little-endian):
+#
+#   header       magic, word count, name count, symbol count, relocation count
+#   words        encoded instructions, one uint16 each
+#   names        UTF-8 strings of up to MAX_NAME bytes, each after a length byte
+#   symbols      (name index, address) pairs for the labels defined here
+#   relocations  (word index, name index) pairs; the low 5 bits of the word
+#                receive the final address of the named label
+MAGIC = b"ASO1"
+HEADER = struct.Struct("<4sHHHH")
+PAIR = struct.Struct("<HH")
+
+ADDRESS_MASK = OPERAND_MASK
+MAX_NAME = 255
+
+
+class LinkError(Exception):
+    pass
+
+
+def write_object(path, words, symbols, relocations):
+    names = list(symbols)
+    index = {name: i for i, name in enumerate(names)}
+    for _, name in relocations:
+        if name not in index:
+            index[name] = len(names)
+            names.append(name)
+    encoded = [name.encode() for name in names]
+    for name, text in zip(names, encoded):
+        if len(text) > MAX_NAME:
+            raise LinkError(f"label '{name}' is {len(text)} bytes long, object files hold at most {MAX_NAME}")
+
+    packed = array("H", words)
+    if sys.byteorder == "big":
+        packed.byteswap()
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(packed), len(names), len(symbols), len(relocations)))
+        f.write(packed.tobytes())
+        for text in encoded:
+            f.write(bytes((len(text),)) + text)
+        for name, addr in symbols.items():
+            f.write(PAIR.pack(index[name], addr))
+        for word_index, name in relocations:
+            f.write(PAIR.pack(word_index, index[name]))
+
+
+def read_object(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if len(data) < HEADER.size:
+        raise LinkError(f"{path}: not an object file")
+    magic, nwords, nnames, nsymbols, nrelocs = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise LinkError(f"{path}: not an object file")
+    corrupt = LinkError(f"{path}: truncated/corrupt object")
+    offset = HEADER.size
+
+    if offset + 2 * nwords > len(data):
+        raise corrupt
+    words = array("H")
+    words.frombytes(data[offset : offset + 2 * nwords])
+    if sys.byteorder == "big":
+        words.byteswap()
+    offset += 2 * nwords
+
+    names = []
+    for _ in range(nnames):
+        if offset >= len(data) or offset + 1 + data[offset] > len(data):
+            raise corrupt
+        length = data[offset]
+        try:
+            names.append(data[offset + 1 : offset + 1 + length].decode())
+        except UnicodeDecodeError:
+            raise corrupt from None
+        offset += 1 + length
+
+    if offset + PAIR.size * (nsymbols + nrelocs) != len(data):
+        raise corrupt
+
+    symbols = {}
+    for _ in range(nsymbols):
+        name_index, addr = PAIR.unpack_from(data, offset)
+        if name_index >= nnames or addr > nwords:
+            raise corrupt
+        symbols[names[name_index]] = addr
+        offset += PAIR.size
+
+    relocations = []
+    for _ in range(nrelocs):
+        word_index, name_index = PAIR.unpack_from(data, offset)
+        if word_index >= nwords or name_index >= nnames:
+            raise corrupt
+        relocations.append((word_index, names[name_index]))
+        offset += PAIR.size
+
+    return words, symbols, relocations
+
+
+def link(paths, depth=32):
+    # Lay the modules out back to back in the order given
+    modules = []
+    symbols = {}
+    defined_in = {}
+    base = 0
+
+    for path in paths:
+        words, local_symbols, relocations = read_object(path)
+        for name, addr in local_symbols.items():
+            if name in symbols:
+                raise LinkError(f"{path}: duplicate label '{name}', first defined in {defined_in[name]}")
+            symbols[name] = base + addr
+            defined_in[name] = path
+        modules.append((path, base, words, relocations))
+        base += len(words)
+
+    if base > depth:
+        layout = ", ".join(f"{path} {len(words)}" for path, _, words, _ in modules)
+        raise LinkError(f"out of RAM. Used {base} of {depth} words ({layout})")
+
+    image = []
+    for path, module_base, words, relocations in modules:
+        words = list(words)
+        for word_index, name in relocations:
+            addr = symbols.get(name)
+            if addr is None:
+                raise LinkError(f"{path}: Unknown label: '{name}'")
+            if addr > ADDRESS_MASK:
+                raise LinkError(f"{path}: address {addr} of '{name}' does not fit in an instruction")
+            words[word_index] = (words[word_index] & ~ADDRESS_MASK) | addr
+        image.extend(words)
+
+    return image
@@ -1,8 +1,22 @@
+import copy
+import expr
+from expr import BINARY, CONST, LABEL, UNARY, ExpressionError
+from ir import NO_REF, Program, WORD_MASK, blob_words
+from isa import OPERAND_MASK, opcode_map
+from ply import codegen
 from ply.lex import lex
 from ply.yacc import yacc
+import mmap
+import os
+import pseudo
 import sys
 
 
+def _text(value):
+    # Token values are bytes when the source is scanned as bytes (e.g. mmap)
+    return value.decode() if isinstance(value, (bytes, bytearray)) else value
+
+
 class Parser:
     opcodes = {
         "add": "ADD",
@@ -21,43 +35,173 @@ class Parser:
         "nop": "NOP",
     }
 
+    # Expanded into real instructions by pseudo.py
+    pseudos = {
+        "mov": "MOV",
+        "clr": "CLR",
+        "inc": "INC",
+        "dec": "DEC",
+        "ldi": "LDI",
+        "call": "CALL",
+        "ret": "RET",
+    }
+
+    directives = {
+        ".word": "WORD",
+        ".fill": "FILL",
+        ".space": "SPACE",
+        ".incbin": "INCBIN",
+    }
+
     tokens = (
-        "REGISTER",
-        "NUMBER",
-        "COMMA",
-        "LABEL",
-        "ID",
-    ) + tuple(opcodes.values())
-
-    def __init__(self):
+        (
+            "REGISTER",
+            "NUMBER",
+            "COMMA",
+            "LABEL",
+            "ID",
+            "STRING",
+            "PLUS",
+            "MINUS",
+            "TIMES",
+            "DIVIDE",
+            "MOD",
+            "LSHIFT",
+            "RSHIFT",
+            "AND",
+            "OR",
+            "XOR",
+            "NOT",
+            "LPAREN",
+            "RPAREN",
+        )
+        + tuple(opcodes.values())
+        + tuple(pseudos.values())
+        + tuple(directives.values())
+    )
+
+    # Numbers after a directive or ldi are data words or counts rather than
+    # 5-bit operands, so they are lexed without a range check up to the end of
+    # the line and checked by the parser. Names are only instructions where a
+    # statement starts: in the operands of an instruction, up to the end of
+    # the line, and in data they are labels, so a label may be named like an
+    # instruction (mov: ... j mov).
+    states = (("data", "inclusive"), ("operands", "inclusive"))
+
+    # Instructions without operands, after which a statement can follow on
+    # the same line
+    no_operands = ("NOP", "JR", "RET")
+
+    # Operators in operand expressions, loosest first, as in C
+    precedence = (
+        ("left", "OR"),
+        ("left", "XOR"),
+        ("left", "AND"),
+        ("left", "LSHIFT", "RSHIFT"),
+        ("left", "PLUS", "MINUS"),
+        ("left", "TIMES", "DIVIDE", "MOD"),
+        ("right", "UNARY"),
+    )
+
+    def __init__(self, costs=None, generated=False):
+        # costs are the cycle costs pseudo-instructions are expanded for
+        # (isa.cycle_costs by default). With generated, the LALR automaton
+        # runs as generated Python instead of interpreting the tables;
+        # genparser.py writes it to parsetab.py, otherwise it is generated
+        # here.
+        self.costs = costs
         self._lexer = lex(module=self)
         self._parser = yacc(module=self)
+        if generated:
+            try:
+                import parsetab
+
+                self._parser = codegen.load(self._parser, parsetab)
+            except (ImportError, ValueError):
+                self._parser = codegen.load(self._parser)
         self._failed = False
         self._file_name = ""
 
     def t_REGISTER(self, t):
         r"D[0-3]"
+        t.value = _text(t.value)
         return t
 
     def t_NUMBER(self, t):
-        r"[-+]?[0-9]+"
-        value = int(t.value)
-        if value > 31 or value < 0:
-            self.t_error(t, reason=f"value of '{value}' is out of range.")
-        t.value = value
+        r"[0-9]+"
+        # Operands are expressions, so the range is checked on their value.
+        # length is kept for pointing at the number in errors.
+        t.length = len(t.value)
+        t.value = int(t.value)
         return t
 
     def t_LABEL(self, t):
         r"[a-zA-Z_][a-zA-Z0-9_]*:"
-        t.value = t.value[:-1]
+        t.value = _text(t.value[:-1])
         return t
 
     def t_ID(self, t):
         r"[a-zA-Z_][a-zA-Z0-9_]*"
-        t.type = self.opcodes.get(t.value, "ID")
+        t.value = _text(t.value)
+        if t.lexer.lexstate != "INITIAL":
+            t.type = "ID"
+            return t
+        t.type = self.opcodes.get(t.value) or self.pseudos.get(t.value, "ID")
+        if t.type == "LDI":
+            t.lexer.begin("data")
+        elif t.type != "ID" and t.type not in self.no_operands:
+            t.lexer.begin("operands")
+        return t
+
+    def t_directive(self, t):
+        r"\.[a-zA-Z_]+"
+        t.value = _text(t.value)
+        t.type = self.directives.get(t.value)
+        if t.type is None:
+            self.t_error(t, reason=f"unknown directive '{t.value}'")
+            # Its operands would only be reported as invalid tokens, so the
+            # rest of the line is skipped. Streamed chunks end at a newline.
+            data = t.lexer.lexdata
+            end = data.find("\n" if isinstance(data, str) else b"\n", t.lexer.lexpos)
+            t.lexer.lexpos = len(data) if end < 0 else end
+            return None
+        t.lexer.begin("data")
+        return t
+
+    def t_data_NUMBER(self, t):
+        r"[-+]?[0-9]+"
+        t.value = int(t.value)
+        return t
+
+    def t_data_newline(self, t):
+        r"\n+"
+        t.lexer.lineno += len(t.value)
+        t.lexer.begin("INITIAL")
+
+    def t_operands_newline(self, t):
+        r"\n+"
+        t.lexer.lineno += len(t.value)
+        t.lexer.begin("INITIAL")
+
+    def t_STRING(self, t):
+        r'"[^"\n]*"'
+        t.value = _text(t.value[1:-1])
         return t
 
     t_COMMA = r","
+    t_PLUS = r"\+"
+    t_MINUS = r"-"
+    t_TIMES = r"\*"
+    t_DIVIDE = r"/"
+    t_MOD = r"%"
+    t_LSHIFT = r"<<"
+    t_RSHIFT = r">>"
+    t_AND = r"&"
+    t_OR = r"\|"
+    t_XOR = r"\^"
+    t_NOT = r"~"
+    t_LPAREN = r"\("
+    t_RPAREN = r"\)"
     t_ignore = " \t"
 
     def t_COMMENT(self, _):
@@ -73,33 +217,44 @@ class Parser:
         BOLD = "\033[1m"
         RESET = "\033[0m"
 
+        data = t.lexer.lexdata
+        # Streaming lexers only hold the current chunk of the source
+        pos = t.lexpos - getattr(t.lexer, "lexoffset", 0)
         line = t.lineno
-        column = self.find_column(t.lexer.lexdata, t)
-        line_start = t.lexer.lexdata.rfind("\n", 0, t.lexpos) + 1
-        line_end = t.lexer.lexdata.find("\n", t.lexpos)
-        if line_end == -1:
-            line_end = len(t.lexer.lexdata)
-        error_line = t.lexer.lexdata[line_start:line_end]
-        pointer = f"{' ' * (column - 1)}{BOLD}{RED}^{'~' * (len(t.value) - 1)}{RESET}"
-
-        reason = kwargs.get("reason", f"invalid token '{t.value}'")
-
-        print(
-            f"{BOLD}{self._file_name}:{line}:{column + 1}:{RESET} {RED}error:{RESET} {reason}\n"
-            f"    {line} | {error_line}\n"
-            f"    {' ' * len(str(line))} | {pointer}"
-        )
+        reason = kwargs.get("reason", f"invalid token '{_text(t.value)}'")
+
+        if not 0 <= pos < len(data):
+            print(f"{BOLD}{self._file_name}:{line}:{RESET} {RED}error:{RESET} {reason}")
+        else:
+            newline = "\n" if isinstance(data, str) else b"\n"
+            column = self.find_column(data, pos)
+            line_start = data.rfind(newline, 0, pos) + 1
+            line_end = data.find(newline, pos)
+            if line_end == -1:
+                line_end = len(data)
+            error_line = _text(data[line_start:line_end])
+            # Numbers and registers have int values; numbers keep the length
+            # of their source text
+            length = getattr(t, "length", len(str(_text(t.value))))
+            pointer = f"{' ' * (column - 1)}{BOLD}{RED}^{'~' * (length - 1)}{RESET}"
+
+            print(
+                f"{BOLD}{self._file_name}:{line}:{column + 1}:{RESET} {RED}error:{RESET} {reason}\n"
+                f"    {line} | {error_line}\n"
+                f"    {' ' * len(str(line))} | {pointer}"
+            )
         self._failed = True
         if hasattr(t.lexer, "skip"):
             t.lexer.skip(1)
 
     def p_program(self, p):
         """program : instruction
-        | instruction program"""
+        | program instruction"""
         if len(p) == 2:
             p[0] = [p[1]]
         else:
-            p[0] = [p[1]] + p[2]
+            p[0] = p[1]
+            p[0].append(p[2])
 
     def p_instruction(self, p):
         """instruction : r_type
@@ -109,56 +264,167 @@ class Parser:
         | LABEL r_type
         | LABEL i_type
         | LABEL j_type
-        | LABEL nop_type"""
-        pos = (p.lineno(1), p.lexpos(1))
+        | LABEL nop_type
+        | pseudo
+        | LABEL pseudo
+        | data
+        | LABEL data"""
+        # Position of the opcode, see set_position
+        pos = (p.lineno(len(p) - 1), p.lexpos(len(p) - 1))
         if len(p) == 2:
             p[0] = ("instr", p[1], pos)
         else:
             p[0] = ("label", p[1], ("instr", p[2], pos))
 
+    def set_position(self, p):
+        # Instruction rules take the position of their opcode token
+        p.set_lineno(0, p.lineno(1))
+        p.set_lexpos(0, p.lexpos(1))
+
+    def operand(self, node):
+        # A lone label stays a label reference, which can be relocated. Other
+        # expressions are evaluated by _operands and once labels are resolved.
+        code, line, start, end = node
+        if len(code) == 1 and code[0][0] == LABEL:
+            return ("label_ref",) + code[0][1:]
+        return ("expr", code, line, start, end)
+
     def p_nop_type(self, p):
         "nop_type : NOP"
         p[0] = (p[1],)
+        self.set_position(p)
 
     def p_r_type(self, p):
         """r_type : ADD REGISTER COMMA REGISTER COMMA REGISTER
         | SUB REGISTER COMMA REGISTER COMMA REGISTER
         | SLT REGISTER COMMA REGISTER COMMA REGISTER"""
         p[0] = (p[1], p[2], p[4], p[6])
+        self.set_position(p)
 
     def p_i_type(self, p):
-        """i_type : LI REGISTER COMMA NUMBER
-        | LW REGISTER COMMA NUMBER
-        | LW REGISTER COMMA ID
-        | SW REGISTER COMMA NUMBER
-        | SW REGISTER COMMA ID
-        | BEQ REGISTER COMMA NUMBER
-        | BEQ REGISTER COMMA ID
-        | BNE REGISTER COMMA NUMBER
-        | BNE REGISTER COMMA ID"""
-        if isinstance(p[4], int):
-            p[0] = (p[1], p[2], p[4])
-        else:
-            p[0] = (p[1], p[2], ("label_ref", p[4]))
+        """i_type : LI REGISTER COMMA expr
+        | LW REGISTER COMMA expr
+        | SW REGISTER COMMA expr
+        | BEQ REGISTER COMMA expr
+        | BNE REGISTER COMMA expr"""
+        p[0] = (p[1], p[2], self.operand(p[4]))
+        self.set_position(p)
 
     def p_i_type_stack(self, p):
         """i_type : PUSH REGISTER
         | POP REGISTER"""
         p[0] = (p[1], p[2])
+        self.set_position(p)
 
     def p_j_type(self, p):
-        """j_type : J NUMBER
-        | J ID
-        | JAL NUMBER
-        | JAL ID"""
-        if isinstance(p[2], int):
-            p[0] = (p[1], p[2])  # resolved address
-        else:
-            p[0] = (p[1], ("label_ref", p[2]))  # mark as needing label resolution
+        """j_type : J expr
+        | JAL expr"""
+        p[0] = (p[1], self.operand(p[2]))
+        self.set_position(p)
 
     def p_j_type_jr(self, p):
         "j_type : JR"
         p[0] = (p[1],)
+        self.set_position(p)
+
+    # Registers that pseudo-instructions may overwrite and ldi values keep
+    # their position, (operand, line, offset), for the checks in _pseudo
+
+    def p_pseudo_register(self, p):
+        """pseudo : MOV REGISTER COMMA REGISTER
+        | CLR REGISTER
+        | INC REGISTER
+        | DEC REGISTER"""
+        p[0] = (p[1],) + tuple(p[n] for n in range(2, len(p), 2))
+        self.set_position(p)
+
+    def p_pseudo_scratch(self, p):
+        """pseudo : INC REGISTER COMMA REGISTER
+        | DEC REGISTER COMMA REGISTER
+        | LDI REGISTER COMMA NUMBER
+        | LDI REGISTER COMMA NUMBER COMMA REGISTER"""
+        operands = tuple((p[n], p.lineno(n), p.lexpos(n)) for n in range(4, len(p), 2))
+        p[0] = (p[1], p[2]) + operands
+        self.set_position(p)
+
+    def p_pseudo_call(self, p):
+        "pseudo : CALL expr"
+        p[0] = (p[1], self.operand(p[2]))
+        self.set_position(p)
+
+    def p_pseudo_ret(self, p):
+        "pseudo : RET"
+        p[0] = (p[1],)
+        self.set_position(p)
+
+    # Expressions are (postfix code, line, start offset, end offset) while
+    # they are parsed, see expr.py
+
+    def p_expr_binary(self, p):
+        """expr : expr PLUS expr
+        | expr MINUS expr
+        | expr TIMES expr
+        | expr DIVIDE expr
+        | expr MOD expr
+        | expr LSHIFT expr
+        | expr RSHIFT expr
+        | expr AND expr
+        | expr OR expr
+        | expr XOR expr"""
+        step = (BINARY, _text(p[2]), p.lineno(2), p.lexpos(2))
+        p[0] = (p[1][0] + p[3][0] + (step,), p[1][1], p[1][2], p[3][3])
+
+    def p_expr_unary(self, p):
+        """expr : MINUS expr %prec UNARY
+        | PLUS expr %prec UNARY
+        | NOT expr %prec UNARY"""
+        p[0] = (p[2][0] + ((UNARY, _text(p[1])),), p.lineno(1), p.lexpos(1), p[2][3])
+
+    def p_expr_group(self, p):
+        "expr : LPAREN expr RPAREN"
+        p[0] = (p[2][0], p.lineno(1), p.lexpos(1), p.lexpos(3) + 1)
+
+    def p_expr_number(self, p):
+        "expr : NUMBER"
+        # Every operand is an expression, so the atoms read their token
+        # directly rather than through p.lineno/p.lexpos
+        token = p.slice[1]
+        p[0] = (((CONST, token.value),), token.lineno, token.lexpos, token.lexpos + token.length)
+
+    def p_expr_label(self, p):
+        "expr : ID"
+        token = p.slice[1]
+        p[0] = (((LABEL, token.value, token.lineno, token.lexpos),), token.lineno, token.lexpos, token.lexpos + len(token.value))
+
+    # Operands of data directives keep their position, (value, line, offset),
+    # for the checks in _data
+
+    def p_data_word(self, p):
+        "data : WORD numbers"
+        p[0] = (p[1],) + tuple(p[2])
+        self.set_position(p)
+
+    def p_numbers(self, p):
+        """numbers : NUMBER
+        | numbers COMMA NUMBER"""
+        n = len(p) - 1
+        operand = (p[n], p.lineno(n), p.lexpos(n))
+        if len(p) == 2:
+            p[0] = [operand]
+        else:
+            p[0] = p[1]
+            p[0].append(operand)
+
+    def p_data_fill(self, p):
+        """data : FILL NUMBER COMMA NUMBER
+        | SPACE NUMBER"""
+        p[0] = (p[1],) + tuple((p[n], p.lineno(n), p.lexpos(n)) for n in range(2, len(p), 2))
+        self.set_position(p)
+
+    def p_data_incbin(self, p):
+        "data : INCBIN STRING"
+        p[0] = (p[1], (p[2], p.lineno(2), p.lexpos(2)))
+        self.set_position(p)
 
     def p_error(self, p):
         self._failed = True
@@ -167,64 +433,237 @@ class Parser:
         else:
             print("Syntax error: Unexpected EOF")
 
-    def find_column(self, input, token):
-        last_cr = input.rfind("\n", 0, token.lexpos)
+    def error_at(self, value, line, offset, reason):
+        # Reports an error at a position recorded while parsing
+        fake_token = type(
+            "Token",
+            (),
+            {
+                "value": value,
+                "lineno": line,
+                "lexpos": offset,
+                "lexer": type("Lexer", (), {"lexdata": self._source_code})(),
+            },
+        )()
+        self.t_error(fake_token, reason=reason)
+
+    def _data(self, directive):
+        # Checks the operands of a data directive and returns the tuple that
+        # Program.append takes. The first operand of .fill and .space is a
+        # count; the rest are 11-bit words, which may be given as negative
+        # numbers.
+        op = directive[0]
+        if op == ".incbin":
+            return (op,) + self._incbin(*directive[1])
+
+        values = []
+        for n, (value, line, offset) in enumerate(directive[1:]):
+            if n == 0 and op != ".word":
+                valid = value >= 0
+            else:
+                valid = -(WORD_MASK + 1) // 2 <= value <= WORD_MASK
+            if not valid:
+                self.error_at(str(value), line, offset, f"value of '{value}' is out of range.")
+                raise Exception()
+            values.append(value)
+        return (op,) + tuple(values)
+
+    def _operands(self, instr, relocatable):
+        # Evaluates an operand expression that uses no labels and checks its
+        # value. Others are left for when the labels are known, except in
+        # relocatable programs, whose objects can only patch in the address
+        # of a label. Expressions are always the last operand.
+        operand = instr[-1]
+        if not isinstance(operand, tuple) or operand[0] != "expr":
+            return instr
+        code, line, start, end = operand[1:]
+        if not expr.labels(code):
+            return instr[:-1] + (self._evaluate(code, {}, line, start, end),)
+        if relocatable:
+            self.error_at(self._source_text(start, end), line, start, "only a lone label can be relocated")
+            raise Exception()
+        return instr
+
+    def _source_text(self, start, end):
+        # Source between two offsets, if the source is held
+        return _text(self._source_code[start:end])
+
+    def _evaluate(self, code, addresses, line, start, end):
+        # Value of an operand expression, which has to fit in the operand
+        try:
+            value = expr.evaluate(code, addresses)
+        except ExpressionError as e:
+            reason, text, error_line, offset = e.args
+            self.error_at(text, error_line, offset, reason)
+            raise Exception()
+        if not 0 <= value <= OPERAND_MASK:
+            text = self._source_text(start, end) or str(value)
+            shown = f"'{text}'" if text == str(value) else f"'{text}' ({value})"
+            self.error_at(text, line, start, f"value of {shown} is out of range.")
+            raise Exception()
+        return value
+
+    def _pseudo(self, instr):
+        # Checks the operands of a pseudo-instruction and returns the real
+        # instructions it expands into. An ldi value is an 11-bit word like
+        # those of .word, and a register the expansion may overwrite cannot
+        # be the one it writes.
+        operands = []
+        for operand in instr[2:]:
+            if not isinstance(operand, tuple) or operand[0] == "label_ref":
+                operands.append(operand)
+                continue
+            value, line, offset = operand
+            if isinstance(value, int):
+                if not -(WORD_MASK + 1) // 2 <= value <= WORD_MASK:
+                    self.error_at(str(value), line, offset, f"value of '{value}' is out of range.")
+                    raise Exception()
+                value &= WORD_MASK
+            elif value == instr[1]:
+                self.error_at(value, line, offset, f"{instr[0]} cannot use {value} as a scratch register as well")
+                raise Exception()
+            operands.append(value)
+        return pseudo.expand(instr[:2] + tuple(operands), self.costs)
+
+    def _incbin(self, path, line, offset):
+        # The file is mapped rather than read, and is relative to the source
+        if self._file_name and not self._file_name.startswith("<"):
+            full_path = os.path.join(os.path.dirname(self._file_name), path)
+        else:
+            full_path = path
+
+        reason = None
+        try:
+            with open(full_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data = b""
+        except OSError as e:
+            reason = f"cannot read '{path}': {e.strerror}"
+        else:
+            if len(data) % 2:
+                reason = f"'{path}' is not a whole number of 16-bit words"
+            elif data and max(blob_words(data)) > WORD_MASK:
+                reason = f"'{path}' has words wider than 11 bits"
+
+        if reason:
+            self.error_at(f'"{path}"', line, offset, reason)
+            raise Exception()
+        return (path, data)
+
+    def find_column(self, input, lexpos):
+        last_cr = input.rfind("\n" if isinstance(input, str) else b"\n", 0, lexpos)
         if last_cr < 0:
             last_cr = -1
-        return token.lexpos - last_cr
-
-    def parse(self, code, file_name=""):
+        return lexpos - last_cr
+
+    def parse(self, code, file_name="", relocatable=False):
+        # Each call gets its own context, so one Parser can serve several
+        # threads at once
+        return self._context()._parse(code, file_name, relocatable)
+
+    def symbols(self, code):
+        # Label definitions and label uses in code, as two lists of (name,
+        # line, offset). They come from the tokens alone, so code that does
+        # not parse still has them; invalid tokens are skipped silently.
+        def skip(t, **kwargs):
+            # Errors with a reason come from rules that have consumed their
+            # token already
+            if "reason" not in kwargs:
+                t.lexer.skip(1)
+
+        ctx = copy.copy(self)
+        ctx.t_error = skip
+        lexer = self._lexer.clone(ctx)
+        lexer.lineno = 1
+        lexer.begin("INITIAL")
+        lexer.input(code)
+        definitions = []
+        uses = []
+        for token in iter(lexer.token, None):
+            if token.type == "LABEL":
+                definitions.append((token.value, token.lineno, token.lexpos))
+            elif token.type == "ID":
+                uses.append((token.value, token.lineno, token.lexpos))
+        return definitions, uses
+
+    def _context(self):
+        # A shallow copy holding the per-parse state (_failed, _file_name,
+        # _source_code) with a lexer and LR parser bound to it. The tables and
+        # compiled regexes are shared, read-only.
+        ctx = copy.copy(self)
+        ctx._lexer = self._lexer.clone(ctx)
+        ctx._parser = self._parser.clone(ctx.p_error)
+        return ctx
+
+    def _parse(self, code, file_name, relocatable):
+        # code is the source text (str, or bytes-like such as an mmap), or a
+        # file object / iterable of lines that is lexed while it is read.
+        # Returns an ir.Program. With relocatable=True, label references are
+        # left unresolved for separate assembly.
         try:
             self._file_name = file_name
-            self._source_code = code
             self._failed = False
-
-            raw_instructions = self._parser.parse(code, lexer=self._lexer)
+            self._lexer.lineno = 1
+            self._lexer.begin("INITIAL")
+
+            if isinstance(code, (str, bytes, bytearray, mmap.mmap)):
+                self._source_code = code
+                self._lexer.input(code)
+            else:
+                # The source is never held in full when streaming
+                self._source_code = ""
+                self._lexer.input_stream(code)
+
+            raw_instructions = self._parser.parse(lexer=self._lexer)
             if self._failed:
                 raise Exception()
 
-            # Flatten labels and collect instructions
-            instructions = []
-            labels = {}
-            pc = 0
-
+            # Flatten labels into the instruction columns
+            program = Program()
             for instr in raw_instructions:
                 if instr[0] == "label":
-                    labels[instr[1]] = pc
+                    program.labels[instr[1]] = program.size
                     instr = instr[2]
-                if instr and instr[0] == "instr":
-                    instructions.append(instr)
-                    pc += 1
-
-            # Resolve label references
-            resolved = []
-            for op, pos in [(i[1], i[2]) for i in instructions]:
-                resolved_instr = []
-                for part in op:
-                    if isinstance(part, tuple) and part[0] == "label_ref":
-                        label = part[1]
-                        addr = labels.get(label)
-                        if addr is None:
-                            fake_token = type(
-                                "Token",
-                                (),
-                                {
-                                    "value": label,
-                                    "lineno": pos[0],
-                                    "lexpos": pos[1],
-                                    "lexer": type(
-                                        "Lexer", (), {"lexdata": self._source_code}
-                                    )(),
-                                },
-                            )()
-                            self.t_error(fake_token, reason=f"Unknown label: '{label}'")
-                            raise Exception()
-                        resolved_instr.append(addr)
-                    else:
-                        resolved_instr.append(part)
-                resolved.append(tuple(resolved_instr))
-
-            return resolved
+                op, pos = instr[1], instr[2]
+                if op[0] in self.directives:
+                    op = self._data(op)
+                else:
+                    op = self._operands(op, relocatable)
+                if op[0] in self.pseudos:
+                    for real in self._pseudo(op):
+                        program.append(real, *pos)
+                    continue
+                program.append(op, *pos)
+
+            if relocatable:
+                return program
+
+            # Resolve label references and evaluate the expressions using
+            # labels
+            for i, ref in enumerate(program.ref):
+                if ref == NO_REF:
+                    continue
+                if program.op[i] == opcode_map["li"]:
+                    program.label_values.append(i)
+                target, line, offset = program.refs[ref][:3]
+                if not isinstance(target, str):
+                    program.imm[i] = self._evaluate(target, program.labels, line, offset, program.refs[ref][3])
+                    program.ref[i] = NO_REF
+                    continue
+                addr = program.labels.get(target)
+                if addr is None:
+                    self.error_at(target, line, offset, f"Unknown label: '{target}'")
+                    raise Exception()
+                if addr > OPERAND_MASK:
+                    self.error_at(target, line, offset, f"address {addr} of '{target}' does not fit in an instruction")
+                    raise Exception()
+                program.imm[i] = addr
+                program.ref[i] = NO_REF
+            program.refs = []
+
+            return program
 
         except Exception as e:
             print(e)
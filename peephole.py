@@ -0,0 +1,174 @@
+# Peephole optimizer over resolved instructions, i.e. the output of
+# Parser.parse: tuples such as ("add", "D3", "D1", "D2") or ("j", 16) with all
+# label references already turned into addresses.
+#
+# Addresses that lw/sw refer to are treated as data, as are the (".word", v)
+# words of data directives: those words are never removed or rewritten and
+# jumps are never threaded through them, since the program may overwrite them
+# at run time.
+
+# Index of the address operand of each instruction that has one
+address_operand = {"j": 1, "jal": 1, "beq": 2, "bne": 2, "lw": 2, "sw": 2}
+
+jumps = ("j", "jal", "beq", "bne")
+writes_register = ("add", "sub", "slt", "li", "lw", "pop")
+
+
+def references(instructions):
+    targets = set()
+    data = set()
+    for i, instr in enumerate(instructions):
+        if instr[0] == ".word":
+            # Words from data directives are data wherever they are
+            data.add(i)
+            continue
+        index = address_operand.get(instr[0])
+        if index is not None:
+            if instr[0] in jumps:
+                targets.add(instr[index])
+            else:
+                data.add(instr[index])
+    return targets, data
+
+
+def retarget(instr, addr):
+    index = address_operand[instr[0]]
+    return instr[:index] + (addr,) + instr[index + 1 :]
+
+
+def remove(instructions, removed):
+    # Addresses of removed instructions move to the next surviving one.
+    # Removed instructions with nothing surviving after them have nowhere to
+    # move to, so the last of them that is referenced stays. Returns the
+    # remaining instructions and the new address of every old one, up to and
+    # including the end of the program.
+    targets, data = references(instructions)
+    n = len(instructions)
+    for i in range(n - 1, -1, -1):
+        if i not in removed:
+            break
+        if i in targets or i in data:
+            removed.discard(i)
+            break
+
+    new_address = []
+    kept = 0
+    for i in range(n):
+        new_address.append(kept)
+        if i not in removed:
+            kept += 1
+    new_address.append(kept)
+
+    result = []
+    for i, instr in enumerate(instructions):
+        if i in removed:
+            continue
+        index = address_operand.get(instr[0])
+        # Addresses past the end of the program point at free RAM and data
+        # words keep their value; neither is rewritten
+        if index is not None and instr[index] < n and i not in data:
+            instr = retarget(instr, new_address[instr[index]])
+        result.append(instr)
+    return result, new_address
+
+
+def thread_jumps(instructions, data):
+    # A jump to "j X" can go to X directly
+    threaded = 0
+    result = []
+    for i, instr in enumerate(instructions):
+        if instr[0] in jumps and i not in data:
+            target = instr[address_operand[instr[0]]]
+            seen = set()
+            while (
+                target < len(instructions)
+                and target not in data
+                and target not in seen
+                and instructions[target][0] == "j"
+                and instructions[target][1] != target
+            ):
+                seen.add(target)
+                target = instructions[target][1]
+            if target != instr[address_operand[instr[0]]]:
+                instr = retarget(instr, target)
+                threaded += 1
+        result.append(instr)
+    return result, threaded
+
+
+def unreachable(instructions, targets, data):
+    # Everything after a j or jr that nothing jumps to or loads from is dead
+    removed = set()
+    dead = False
+    for i, instr in enumerate(instructions):
+        if i in targets or i in data:
+            dead = False
+        if dead:
+            removed.add(i)
+        elif instr[0] in ("j", "jr"):
+            dead = True
+    return removed
+
+
+def redundant(instructions, targets, data):
+    removed = set()
+    known = {}
+    referenced = targets | data
+    for i, instr in enumerate(instructions):
+        op = instr[0]
+        if i in referenced:
+            known.clear()
+        if i in data:
+            continue
+
+        if op == "nop":
+            removed.add(i)
+        elif op == "li":
+            if known.get(instr[1]) == instr[2]:
+                removed.add(i)
+            known[instr[1]] = instr[2]
+        elif op == "j" and instr[1] == i + 1:
+            removed.add(i)
+        elif op == "push" and i + 1 < len(instructions) and i + 1 not in referenced:
+            if instructions[i + 1] == ("pop", instr[1]):
+                removed.update((i, i + 1))
+        elif op in writes_register:
+            known.pop(instr[1], None)
+        elif op in ("j", "jal", "jr"):
+            # A call may change any register
+            known.clear()
+    return removed
+
+
+def optimize(instructions, cycle_costs=None):
+    # Returns the optimized instructions along with (words saved, cycles
+    # saved) and (origins, addresses): the index each instruction had before
+    # and the new address of every old one, up to and including the end of
+    # the program, which labels and source positions follow. Cycles are
+    # counted statically: each removed instruction once, and one "j" for
+    # every jump threaded past it.
+    def cost(op):
+        return 1 if cycle_costs is None else cycle_costs[op]
+
+    words = len(instructions)
+    cycles = 0
+    origins = list(range(words))
+    addresses = list(range(words + 1))
+
+    while True:
+        targets, data = references(instructions)
+        instructions, threaded = thread_jumps(instructions, data)
+        cycles += threaded * cost("j")
+
+        targets, data = references(instructions)
+        removed = redundant(instructions, targets, data) | unreachable(instructions, targets, data)
+        original = instructions
+        instructions, new_address = remove(original, removed)
+        cycles += sum(cost(original[i][0]) for i in removed)
+        origins = [origin for i, origin in enumerate(origins) if i not in removed]
+        addresses = [new_address[address] for address in addresses]
+
+        if not threaded and not removed:
+            break
+
+    return instructions, (words - len(instructions), cycles), (origins, addresses)
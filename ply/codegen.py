@@ -0,0 +1,246 @@
+# -----------------------------------------------------------------------------
+# ply: codegen.py
+#
+# Generates Python code for the LALR automaton of a parser built by yacc().
+# Instead of interpreting the action and goto tables, the generated parse()
+# function has the table entries of every state unrolled into if-statements
+# and calls the grammar rule functions directly.
+#
+# The generated code only implements the error-free path.  It keeps the same
+# state and symbol stacks as the table-driven LRParser, so when it hits a
+# syntax error (or a grammar rule raises SyntaxError) it hands the stacks and
+# the lookahead over and LRParser carries on from there with PLY's normal
+# error reporting and recovery.  No grammar rule runs twice.
+#
+#    generate()   -  Return the source of a module implementing the automaton
+#    signature()  -  Return a fingerprint of the parsing tables
+#    load()       -  Build a GeneratedParser from generated source or a module
+# -----------------------------------------------------------------------------
+
+import copy
+import hashlib
+
+from .yacc import YaccProduction
+
+# -----------------------------------------------------------------------------
+# signature()
+#
+# Fingerprint of the productions and tables.  It is stored in generated
+# modules so that a module generated for a different grammar is never used.
+# -----------------------------------------------------------------------------
+def signature(parser):
+    parts = [p.str for p in parser.productions]
+    for state in range(len(parser.action)):
+        parts.append(repr(sorted(parser.action[state].items())))
+        parts.append(repr(sorted(parser.goto.get(state, {}).items())))
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+# -----------------------------------------------------------------------------
+# generate()
+#
+# Returns the source code of a module for the automaton of parser (an LRParser).
+# The module defines bind(callables), which returns a function
+# parse(get_token, pslice, resume) that runs the automaton.  On a syntax error
+# it returns resume(statestack, symstack, lookahead, targ), where targ is the
+# slice of the grammar rule that raised SyntaxError or None.
+# -----------------------------------------------------------------------------
+def generate(parser):
+    prods = parser.productions
+    out = []
+    emit = out.append
+
+    emit('# Generated by ply.codegen. Do not edit.')
+    emit('')
+    emit('from ply.yacc import YaccSymbol')
+    emit('')
+    emit(f'signature = {signature(parser)!r}')
+    emit('')
+
+    # Goto table, one dictionary per nonterminal keyed by the exposed state
+    nonterminals = {}
+    for state in range(len(parser.action)):
+        for name, j in parser.goto.get(state, {}).items():
+            nonterminals.setdefault(name, {})[state] = j
+    gotoname = {}
+    for i, name in enumerate(sorted(nonterminals)):
+        gotoname[name] = f'_goto{i}'
+        emit(f'{gotoname[name]} = {nonterminals[name]!r}    # {name}')
+    emit('')
+    emit('')
+
+    used = sorted({-t for row in parser.action.values() for t in row.values() if t is not None and t < 0})
+
+    emit('def bind(callables):')
+    for n in used:
+        emit(f'    _rule{n} = callables[{n}]    # {prods[n].str}')
+    emit('')
+    emit('    def parse(get_token, pslice, resume):')
+    emit('        statestack = [0]')
+    emit('        sym = YaccSymbol()')
+    emit("        sym.type = '$end'")
+    emit('        symstack = [sym]')
+    emit('        pslice.stack = symstack')
+    emit('        state = 0')
+    emit('        lookahead = None')
+    emit('        push_state = statestack.append')
+    emit('        push_symbol = symstack.append')
+    emit('')
+    emit('        while True:')
+
+    def reduce(n, indent):
+        p = prods[n]
+        pad = ' ' * indent
+        emit(f'{pad}# reduce using rule {n} ({p.str})')
+        emit(f'{pad}sym = YaccSymbol()')
+        emit(f'{pad}sym.type = {p.name!r}')
+        emit(f'{pad}sym.value = None')
+        if p.len:
+            emit(f'{pad}targ = symstack[-{p.len + 1}:]')
+            emit(f'{pad}targ[0] = sym')
+            emit(f'{pad}pslice.slice = targ')
+            emit(f'{pad}del symstack[-{p.len}:]')
+        else:
+            emit(f'{pad}targ = [sym]')
+            emit(f'{pad}pslice.slice = targ')
+        emit(f'{pad}try:')
+        emit(f'{pad}    _rule{n}(pslice)')
+        emit(f'{pad}except SyntaxError:')
+        emit(f'{pad}    return resume(statestack, symstack, lookahead, targ)')
+        if p.len:
+            emit(f'{pad}del statestack[-{p.len}:]')
+        emit(f'{pad}push_symbol(sym)')
+        emit(f'{pad}state = {gotoname[p.name]}[statestack[-1]]')
+        emit(f'{pad}push_state(state)')
+        emit(f'{pad}continue')
+
+    # After a shift the next state is known, so its code is inlined there
+    # (except along cycles) and only reductions go back through the dispatch.
+    # The lookahead is always consumed by a shift.  Each state is inlined
+    # after one shift at most, since inlining along every path grows
+    # exponentially with grammars like expressions that can shift in many
+    # orders.
+    inlined = set()
+
+    def state_code(state, indent, chain=()):
+        pad = ' ' * indent
+        emit(f'{pad}# state {state}')
+        default = parser.defaulted_states.get(state)
+        if default is not None:
+            reduce(-default, indent)
+            return
+
+        if chain:
+            emit(f'{pad}lookahead = get_token()')
+        else:
+            emit(f'{pad}if lookahead is None:')
+            emit(f'{pad}    lookahead = get_token()')
+            pad += '    '
+        emit(f'{pad}if lookahead is None:')
+        emit(f'{pad}    lookahead = YaccSymbol()')
+        emit(f"{pad}    lookahead.type = '$end'")
+        pad = ' ' * indent
+        emit(f'{pad}ltype = lookahead.type')
+
+        # Group the lookaheads that lead to the same action
+        groups = {}
+        for a, t in parser.action[state].items():
+            if t is not None:
+                groups.setdefault(t, []).append(a)
+        # Test the most common lookaheads first
+        keyword = 'if'
+        for t, names in sorted(groups.items(), key=lambda item: -len(item[1])):
+            if len(names) == 1:
+                emit(f'{pad}{keyword} ltype == {names[0]!r}:')
+            else:
+                emit(f'{pad}{keyword} ltype in {{{", ".join(repr(a) for a in sorted(names))}}}:')
+            keyword = 'elif'
+            if t > 0:
+                emit(f'{pad}    push_state({t})')
+                emit(f'{pad}    push_symbol(lookahead)')
+                if t in chain or t == state or t in inlined:
+                    emit(f'{pad}    lookahead = None')
+                    emit(f'{pad}    state = {t}')
+                    emit(f'{pad}    continue')
+                else:
+                    inlined.add(t)
+                    state_code(t, indent + 4, chain + (state,))
+            elif t < 0:
+                reduce(-t, indent + 4)
+            else:
+                emit(f'{pad}    return symstack[-1].value')
+        emit(f'{pad}return resume(statestack, symstack, lookahead, None)')
+
+    # Dispatch on the state number with a balanced tree of comparisons
+    def dispatch(states, indent):
+        if len(states) == 1:
+            state_code(states[0], indent)
+            return
+        mid = len(states) // 2
+        pad = ' ' * indent
+        emit(f'{pad}if state < {states[mid]}:')
+        dispatch(states[:mid], indent + 4)
+        emit(f'{pad}else:')
+        dispatch(states[mid:], indent + 4)
+
+    dispatch(list(range(len(parser.action))), 12)
+    emit('')
+    emit('    return parse')
+    emit('')
+    return '\n'.join(out)
+
+# -----------------------------------------------------------------------------
+# GeneratedParser
+#
+# Drop-in replacement for an LRParser that runs the generated automaton.
+# Debugging and position tracking are handled by the wrapped LRParser.
+# -----------------------------------------------------------------------------
+class GeneratedParser:
+    def __init__(self, parser, module):
+        self.parser = parser
+        self.automaton = module['bind']([p.callable for p in parser.productions])
+
+    # The generated automaton keeps all of its state in local variables, so
+    # only the wrapped LRParser needs to be copied
+    def clone(self, errorfunc=None):
+        c = copy.copy(self)
+        c.parser = self.parser.clone(errorfunc)
+        return c
+
+    def parse(self, input=None, lexer=None, debug=False, tracking=False):
+        if debug or tracking:
+            return self.parser.parse(input, lexer, debug, tracking)
+
+        if not lexer:
+            from . import lex
+            lexer = lex.lexer
+        if input is not None:
+            lexer.input(input)
+
+        pslice = YaccProduction(None)
+        pslice.lexer = lexer
+        pslice.parser = self.parser
+
+        def resume(statestack, symstack, lookahead, targ):
+            return self.parser.parseopt_notrack(lexer=lexer, resume=(statestack, symstack, lookahead, targ))
+
+        return self.automaton(lexer.token, pslice, resume)
+
+# -----------------------------------------------------------------------------
+# load()
+#
+# Returns a GeneratedParser for parser.  source may be a module generated
+# earlier (a module object or the text written by generate()); by default the
+# code is generated on the fly.  A module generated for different tables is
+# rejected with a ValueError.
+# -----------------------------------------------------------------------------
+def load(parser, source=None):
+    if source is None:
+        source = generate(parser)
+    if isinstance(source, str):
+        namespace = {}
+        exec(compile(source, '<ply.codegen>', 'exec'), namespace)
+    else:
+        namespace = vars(source)
+    if namespace.get('signature') != signature(parser):
+        raise ValueError('generated parser does not match the grammar')
+    return GeneratedParser(parser, namespace)
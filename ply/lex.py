@@ -84,11 +84,13 @@ class PlyLogger(object):
 # a few public methods and attributes:
 #
 #    input()          -  Store a new string in the lexer
+#    input_stream()   -  Lex text pulled lazily from an iterable
 #    token()          -  Get the next token
 #    clone()          -  Clone the lexer
 #
 #    lineno           -  Current line number
 #    lexpos           -  Current position in the input string
+#    lexoffset        -  Position of the current chunk when streaming
 # -----------------------------------------------------------------------------
 
 class Lexer:
@@ -109,7 +111,11 @@ class Lexer:
         self.lexstateeoff = {}        # Dictionary of eof functions for each state
         self.lexreflags = 0           # Optional re compile flags
         self.lexdata = None           # Actual input data (as a string)
+        self.lexbytes = False         # True if lexdata is a bytes-like object
+        self.lexstatebytesre = {}     # Master regexs recompiled as bytes patterns, built on demand
         self.lexpos = 0               # Current position in input text
+        self.lexoffset = 0            # Position of lexdata[0] in the whole input (streaming)
+        self.lexstream = None         # Iterator over remaining input chunks (streaming)
         self.lexlen = 0               # Length of the input text
         self.lexerrorf = None         # Error rule (if any)
         self.lexeoff = None           # EOF rule (if any)
@@ -124,7 +130,7 @@ class Lexer:
 
         # If the object parameter has been supplied, it means we are attaching the
         # lexer to a new object.  In this case, we have to rebind all methods in
-        # the lexstatere and lexstateerrorf tables.
+        # the lexstatere, lexstateerrorf and lexstateeoff tables.
 
         if object:
             newtab = {}
@@ -137,22 +143,80 @@ class Lexer:
                             newfindex.append(f)
                             continue
                         newfindex.append((getattr(object, f[0].__name__), f[1]))
-                newre.append((cre, newfindex))
+                    newre.append((cre, newfindex))
                 newtab[key] = newre
             c.lexstatere = newtab
+            c.lexstatebytesre = {}
             c.lexstateerrorf = {}
             for key, ef in self.lexstateerrorf.items():
                 c.lexstateerrorf[key] = getattr(object, ef.__name__)
+            c.lexstateeoff = {}
+            for key, ef in self.lexstateeoff.items():
+                c.lexstateeoff[key] = getattr(object, ef.__name__)
             c.lexmodule = object
+
+            # Pick up the rebound rules for the current state
+            c.begin(c.lexstate)
+
+        # The clone must not push and pop states on the original's stack
+        c.lexstatestack = list(self.lexstatestack)
         return c
 
     # ------------------------------------------------------------
     # input() - Push a new string into the lexer
     # ------------------------------------------------------------
     def input(self, s):
+        self.lexstream = None
+        self.lexoffset = 0
+        self.set_data(s)
+
+    # ------------------------------------------------------------
+    # input_stream() - Lex input from an iterable of strings
+    #
+    # The source (a file object, or any iterable of str or bytes)
+    # is consumed lazily and regrouped into chunks of roughly
+    # chunksize characters that always end on a line boundary, so a
+    # token never spans two chunks.  lexdata only holds the current
+    # chunk; token lexpos values are offsets into the whole input
+    # and lexoffset is the position of lexdata[0].
+    # ------------------------------------------------------------
+    def input_stream(self, source, chunksize=8192):
+        self.lexstream = _line_chunks(source, chunksize)
+        self.lexoffset = 0
+        self.set_data(next(self.lexstream, ''))
+
+    # ------------------------------------------------------------
+    # next_chunk() - Advance a streaming lexer to its next chunk
+    # ------------------------------------------------------------
+    def next_chunk(self):
+        chunk = next(self.lexstream, None)
+        if chunk is None:
+            self.lexstream = None
+            return False
+        self.lexoffset += self.lexlen
+        self.set_data(chunk)
+        return True
+
+    # ------------------------------------------------------------
+    # set_data() - Replace the text being scanned
+    #
+    # Besides str, any bytes-like object supported by the re module
+    # (bytes, bytearray, mmap) may be given.  In that case the master
+    # regular expressions are matched as bytes patterns and token
+    # values are bytes, which lets large files be scanned in place
+    # without decoding them first.
+    # ------------------------------------------------------------
+    def set_data(self, s):
         self.lexdata = s
         self.lexpos = 0
         self.lexlen = len(s)
+        binary = not isinstance(s, str)
+        if binary != self.lexbytes:
+            self.lexbytes = binary
+            if isinstance(self.lexliterals, str) == binary:
+                self.lexliterals = self.lexliterals.encode() if binary else self.lexliterals.decode()
+            if self.lexre is not None:
+                self.begin(self.lexstate)
 
     # ------------------------------------------------------------
     # begin() - Changes the lexing state
@@ -160,13 +224,28 @@ class Lexer:
     def begin(self, state):
         if state not in self.lexstatere:
             raise ValueError(f'Undefined state {state!r}')
-        self.lexre = self.lexstatere[state]
+        if self.lexbytes:
+            self.lexre = self.bytes_re(state)
+            self.lexignore = self.lexstateignore.get(state, '').encode()
+        else:
+            self.lexre = self.lexstatere[state]
+            self.lexignore = self.lexstateignore.get(state, '')
         self.lexretext = self.lexstateretext[state]
-        self.lexignore = self.lexstateignore.get(state, '')
         self.lexerrorf = self.lexstateerrorf.get(state, None)
         self.lexeoff = self.lexstateeoff.get(state, None)
         self.lexstate = state
 
+    # ------------------------------------------------------------
+    # bytes_re() - Returns the master regexs of a state as bytes patterns
+    # ------------------------------------------------------------
+    def bytes_re(self, state):
+        lexre = self.lexstatebytesre.get(state)
+        if lexre is None:
+            lexre = [(re.compile(cre.pattern.encode('utf-8'), cre.flags & ~re.UNICODE), findex)
+                     for cre, findex in self.lexstatere[state]]
+            self.lexstatebytesre[state] = lexre
+        return lexre
+
     # ------------------------------------------------------------
     # push_state() - Changes the lexing state and saves old on stack
     # ------------------------------------------------------------
@@ -205,94 +284,104 @@ class Lexer:
         lexlen    = self.lexlen
         lexignore = self.lexignore
         lexdata   = self.lexdata
+        lexoffset = self.lexoffset
 
-        while lexpos < lexlen:
-            # This code provides some short-circuit code for whitespace, tabs, and other ignored characters
-            if lexdata[lexpos] in lexignore:
-                lexpos += 1
-                continue
-
-            # Look for a regular expression match
-            for lexre, lexindexfunc in self.lexre:
-                m = lexre.match(lexdata, lexpos)
-                if not m:
+        while True:
+            while lexpos < lexlen:
+                # This code provides some short-circuit code for whitespace, tabs, and other ignored characters
+                if lexdata[lexpos] in lexignore:
+                    lexpos += 1
                     continue
 
-                # Create a token for return
-                tok = LexToken()
-                tok.value = m.group()
-                tok.lineno = self.lineno
-                tok.lexpos = lexpos
-
-                i = m.lastindex
-                func, tok.type = lexindexfunc[i]
+                # Look for a regular expression match
+                for lexre, lexindexfunc in self.lexre:
+                    m = lexre.match(lexdata, lexpos)
+                    if not m:
+                        continue
 
-                if not func:
-                    # If no token type was set, it's an ignored token
-                    if tok.type:
-                        self.lexpos = m.end()
-                        return tok
-                    else:
-                        lexpos = m.end()
-                        break
+                    # Create a token for return
+                    tok = LexToken()
+                    tok.value = m.group()
+                    tok.lineno = self.lineno
+                    tok.lexpos = lexpos + lexoffset
 
-                lexpos = m.end()
+                    i = m.lastindex
+                    func, tok.type = lexindexfunc[i]
 
-                # If token is processed by a function, call it
+                    if not func:
+                        # If no token type was set, it's an ignored token
+                        if tok.type:
+                            self.lexpos = m.end()
+                            return tok
+                        else:
+                            lexpos = m.end()
+                            break
 
-                tok.lexer = self      # Set additional attributes useful in token rules
-                self.lexmatch = m
-                self.lexpos = lexpos
-                newtok = func(tok)
-                del tok.lexer
-                del self.lexmatch
+                    lexpos = m.end()
 
-                # Every function must return a token, if nothing, we just move to next token
-                if not newtok:
-                    lexpos    = self.lexpos         # This is here in case user has updated lexpos.
-                    lexignore = self.lexignore      # This is here in case there was a state change
-                    break
-                return newtok
-            else:
-                # No match, see if in literals
-                if lexdata[lexpos] in self.lexliterals:
-                    tok = LexToken()
-                    tok.value = lexdata[lexpos]
-                    tok.lineno = self.lineno
-                    tok.type = tok.value
-                    tok.lexpos = lexpos
-                    self.lexpos = lexpos + 1
-                    return tok
+                    # If token is processed by a function, call it
 
-                # No match. Call t_error() if defined.
-                if self.lexerrorf:
-                    tok = LexToken()
-                    tok.value = self.lexdata[lexpos:]
-                    tok.lineno = self.lineno
-                    tok.type = 'error'
-                    tok.lexer = self
-                    tok.lexpos = lexpos
+                    tok.lexer = self      # Set additional attributes useful in token rules
+                    self.lexmatch = m
                     self.lexpos = lexpos
-                    newtok = self.lexerrorf(tok)
-                    if lexpos == self.lexpos:
-                        # Error method didn't change text position at all. This is an error.
-                        raise LexError(f"Scanning error. Illegal character {lexdata[lexpos]!r}",
-                                       lexdata[lexpos:])
-                    lexpos = self.lexpos
+                    newtok = func(tok)
+                    del tok.lexer
+                    del self.lexmatch
+
+                    # Every function must return a token, if nothing, we just move to next token
                     if not newtok:
-                        continue
+                        lexpos    = self.lexpos         # This is here in case user has updated lexpos.
+                        lexignore = self.lexignore      # This is here in case there was a state change
+                        break
                     return newtok
+                else:
+                    # No match, see if in literals
+                    if lexdata[lexpos] in self.lexliterals:
+                        tok = LexToken()
+                        tok.value = lexdata[lexpos:lexpos+1]
+                        tok.lineno = self.lineno
+                        tok.type = tok.value if not self.lexbytes else tok.value.decode()
+                        tok.lexpos = lexpos + lexoffset
+                        self.lexpos = lexpos + 1
+                        return tok
+
+                    # No match. Call t_error() if defined.
+                    if self.lexerrorf:
+                        tok = LexToken()
+                        tok.value = self.lexdata[lexpos:]
+                        tok.lineno = self.lineno
+                        tok.type = 'error'
+                        tok.lexer = self
+                        tok.lexpos = lexpos + lexoffset
+                        self.lexpos = lexpos
+                        newtok = self.lexerrorf(tok)
+                        if lexpos == self.lexpos:
+                            # Error method didn't change text position at all. This is an error.
+                            raise LexError(f"Scanning error. Illegal character {lexdata[lexpos]!r}",
+                                           lexdata[lexpos:])
+                        lexpos = self.lexpos
+                        if not newtok:
+                            continue
+                        return newtok
+
+                    self.lexpos = lexpos
+                    raise LexError(f"Illegal character {lexdata[lexpos]!r} at index {lexpos + lexoffset}",
+                                   lexdata[lexpos:])
 
-                self.lexpos = lexpos
-                raise LexError(f"Illegal character {lexdata[lexpos]!r} at index {lexpos}",
-                               lexdata[lexpos:])
+            # Out of data.  If input is being streamed, move on to the next chunk
+            if self.lexstream is None or not self.next_chunk():
+                break
+            lexpos    = 0
+            lexlen    = self.lexlen
+            lexdata   = self.lexdata
+            lexoffset = self.lexoffset
 
         if self.lexeoff:
             tok = LexToken()
             tok.type = 'eof'
             tok.value = ''
             tok.lineno = self.lineno
-            tok.lexpos = lexpos
+            tok.lexpos = lexpos + lexoffset
             tok.lexer = self
             self.lexpos = lexpos
             newtok = self.lexeoff(tok)
@@ -313,6 +402,30 @@ class Lexer:
             raise StopIteration
         return t
 
+# -----------------------------------------------------------------------------
+# _line_chunks()
+#
+# Regroups an iterable of text pieces into chunks of at least size characters
+# that end with a newline (except possibly the last one).
+# -----------------------------------------------------------------------------
+def _line_chunks(source, size):
+    pending = []
+    length = 0
+    for piece in source:
+        pending.append(piece)
+        length += len(piece)
+        if length < size:
+            continue
+        data = piece[:0].join(pending)
+        cut = data.rfind('\n' if isinstance(data, str) else b'\n') + 1
+        if cut:
+            yield data[:cut]
+            data = data[cut:]
+        pending = [data] if data else []
+        length = len(data)
+    if pending:
+        yield pending[0][:0].join(pending)
+
 # -----------------------------------------------------------------------------
 #                           ==== Lex Builder ===
 #
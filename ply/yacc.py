@@ -61,6 +61,7 @@
 # own risk!
 # ----------------------------------------------------------------------------
 
+import copy
 import re
 import types
 import sys
@@ -230,6 +231,7 @@ class LRParser:
         self.action = lrtab.lr_action
         self.goto = lrtab.lr_goto
         self.errorfunc = errorf
+        self.build_dense_tables()
         self.set_defaulted_states()
         self.errorok = True
 
@@ -244,6 +246,46 @@ class LRParser:
         self.symstack.append(sym)
         self.statestack.append(0)
 
+    # Cloning.
+    # parse() keeps its stacks and error state on the parser object, so one
+    # LRParser can only run one parse at a time.  clone() returns a parser that
+    # shares the (read-only) tables with this one and can parse at the same
+    # time, optionally reporting syntax errors to a different function.
+    def clone(self, errorfunc=None):
+        c = copy.copy(self)
+        if errorfunc:
+            c.errorfunc = errorfunc
+        c.errorok = True
+        return c
+
+    # Dense tables.
+    # The action and goto dictionaries are keyed by symbol names, so each parsing
+    # step hashes a string.  This method numbers the terminals and nonterminals
+    # and converts both tables into one list per state indexed by symbol number,
+    # with None for missing entries.  Action rows have one more column, noterm,
+    # which is always empty, for lookaheads that are not terminals.  For each
+    # production, prodgoto gives the goto column of its left hand side.  The
+    # dictionaries are kept for parsedebug() and for introspection.
+    def build_dense_tables(self):
+        terminals = sorted({a for row in self.action.values() for a in row})
+        nonterminals = sorted({n for row in self.goto.values() for n in row})
+        self.termids = {a: i for i, a in enumerate(terminals)}
+        self.noterm = len(terminals)
+        self.nontermids = {n: i for i, n in enumerate(nonterminals)}
+
+        self.dense_action = []
+        self.dense_goto = []
+        for state in range(len(self.action)):
+            row = [None] * (len(terminals) + 1)
+            for a, t in self.action[state].items():
+                row[self.termids[a]] = t
+            self.dense_action.append(row)
+            row = [None] * len(nonterminals)
+            for n, j in self.goto.get(state, {}).items():
+                row[self.nontermids[n]] = j
+            self.dense_goto.append(row)
+        self.prodgoto = [self.nontermids.get(p.name) for p in self.productions]
+
     # Defaulted state support.
     # This method identifies parser states where there is only one possible reduction action.
     # For such states, the parser can make a choose to make a rule reduction without consuming
@@ -254,13 +296,16 @@ class LRParser:
     # See:  http://www.gnu.org/software/bison/manual/html_node/Default-Reductions.html#Default-Reductions
     def set_defaulted_states(self):
         self.defaulted_states = {}
+        self.dense_defaulted = [None] * len(self.action)
         for state, actions in self.action.items():
             rules = list(actions.values())
             if len(rules) == 1 and rules[0] < 0:
                 self.defaulted_states[state] = rules[0]
+                self.dense_defaulted[state] = rules[0]
 
     def disable_defaulted_states(self):
         self.defaulted_states = {}
+        self.dense_defaulted = [None] * len(self.action)
 
     # parse().
     #
@@ -269,8 +314,20 @@ class LRParser:
     # see the various rule reductions and parsing steps.  tracking turns on position
     # tracking.  In this mode, symbols will record the starting/ending line number and
     # character index.
+    #
+    # The work is done by one of two variants of the engine: parsedebug() handles
+    # debugging and tracking, parseopt_notrack() is used when neither is enabled.
 
     def parse(self, input=None, lexer=None, debug=False, tracking=False):
+        if debug or tracking:
+            return self.parsedebug(input, lexer, debug, tracking)
+        return self.parseopt_notrack(input, lexer)
+
+    # parsedebug().
+    #
+    # General version of the parsing engine supporting debugging and tracking.
+
+    def parsedebug(self, input=None, lexer=None, debug=False, tracking=False):
         # If debugging has been specified as a flag, turn it into a logging object
         if isinstance(debug, int) and debug:
             debug = PlyLogger(sys.stderr)
@@ -580,6 +637,295 @@ class LRParser:
             # If we'r here, something really bad happened
             raise RuntimeError('yacc: internal parser error!!!\n')
 
+    # parseopt_notrack().
+    #
+    # Optimized version of parsedebug() used when neither debugging nor position
+    # tracking is requested.  All of the debug and tracking branches have been
+    # removed from the inner loop and it runs on the dense integer-indexed tables
+    # built by build_dense_tables().  The semantics are otherwise identical, so
+    # changes to the parsing engine must be made in both methods.
+    #
+    # resume, if given, is (statestack, symstack, lookahead, targ) from a parser
+    # that has run the same automaton up to a syntax error, such as the one
+    # generated by ply.codegen.  Parsing continues from those stacks with the
+    # error handling below, so no grammar rule runs twice.  targ is the slice
+    # of the rule that raised SyntaxError, or None if lookahead is the
+    # offending token.
+
+    def parseopt_notrack(self, input=None, lexer=None, resume=None):
+        lookahead = None                         # Current lookahead symbol
+        lookaheadstack = []                      # Stack of lookahead symbols
+        actions = self.dense_action              # Local reference to action table (to avoid lookup on self.)
+        goto    = self.dense_goto                # Local reference to goto table (to avoid lookup on self.)
+        prod    = self.productions               # Local reference to production list (to avoid lookup on self.)
+        prodgoto = self.prodgoto                 # Goto table column of each production
+        termids = self.termids                   # Column of each terminal in the action table
+        noterm  = self.noterm                    # Empty column for any other symbol
+        column  = None                           # Column of the lookahead symbol
+        defaulted_states = self.dense_defaulted  # Local reference to defaulted states
+        pslice  = YaccProduction(None)           # Production object passed to grammar rules
+        errorcount = 0                           # Used during error recovery
+
+        # If no lexer was given, we will try to use the lex module
+        if not lexer:
+            from . import lex
+            lexer = lex.lexer
+
+        # Set up the lexer and parser objects on pslice
+        pslice.lexer = lexer
+        pslice.parser = self
+
+        # If input was supplied, pass to lexer
+        if input is not None:
+            lexer.input(input)
+
+        # Set the token function
+        get_token = self.token = lexer.token
+
+        # Set up the state and symbol stacks
+        statestack = self.statestack = []   # Stack of parsing states
+        symstack = self.symstack = []       # Stack of grammar symbols
+        pslice.stack = symstack             # Put in the production
+        errtoken   = None                   # Err token
+
+        if resume is None:
+            # The start state is assumed to be (0,$end)
+
+            statestack.append(0)
+            sym = YaccSymbol()
+            sym.type = '$end'
+            symstack.append(sym)
+            state = 0
+        else:
+            statestack[:], symstack[:], lookahead, targ = resume
+            if targ is None:
+                column = termids.get(lookahead.type, noterm)
+            else:
+                # Same as a grammar rule raising SyntaxError below
+                lookaheadstack.append(lookahead)
+                symstack.extend(targ[1:-1])
+                statestack.pop()
+                sym = targ[0]
+                sym.type = 'error'
+                sym.value = 'error'
+                lookahead = sym
+                column = termids.get('error', noterm)
+                errorcount = error_count
+                self.errorok = False
+            state = statestack[-1]
+
+        while True:
+            # Get the next symbol on the input.  If a lookahead symbol
+            # is already set, we just use that. Otherwise, we'll pull
+            # the next token off of the lookaheadstack or from the lexer
+
+            t = defaulted_states[state]
+            if t is None:
+                if not lookahead:
+                    if not lookaheadstack:
+                        lookahead = get_token()     # Get the next token
+                    else:
+                        lookahead = lookaheadstack.pop()
+                    if not lookahead:
+                        lookahead = YaccSymbol()
+                        lookahead.type = '$end'
+                    # Once per token.  Token types are interned strings with
+                    # cached hashes, and rules such as t_ID pick the type after
+                    # matching, so a type code set by the lexer would cost the
+                    # same lookup there.
+                    column = termids.get(lookahead.type, noterm)
+
+                # Check the action table
+                t = actions[state][column]
+
+            if t is not None:
+                if t > 0:
+                    # shift a symbol on the stack
+                    statestack.append(t)
+                    state = t
+
+                    symstack.append(lookahead)
+                    lookahead = None
+
+                    # Decrease error count on successful shift
+                    if errorcount:
+                        errorcount -= 1
+                    continue
+
+                if t < 0:
+                    # reduce a symbol on the stack, emit a production
+                    p = prod[-t]
+                    pname = p.name
+                    plen  = p.len
+                    pgoto = prodgoto[-t]
+
+                    # Get production function
+                    sym = YaccSymbol()
+                    sym.type = pname       # Production name
+                    sym.value = None
+
+                    if plen:
+                        targ = symstack[-plen-1:]
+                        targ[0] = sym
+
+                        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+                        # The code enclosed in this section is duplicated
+                        # below as a performance optimization.  Make sure
+                        # changes get made in both locations.
+
+                        pslice.slice = targ
+
+                        try:
+                            # Call the grammar rule with our special slice object
+                            del symstack[-plen:]
+                            self.state = state
+                            p.callable(pslice)
+                            del statestack[-plen:]
+                            symstack.append(sym)
+                            state = goto[statestack[-1]][pgoto]
+                            statestack.append(state)
+                        except SyntaxError:
+                            # If an error was set. Enter error recovery state
+                            lookaheadstack.append(lookahead)    # Save the current lookahead token
+                            symstack.extend(targ[1:-1])         # Put the production slice back on the stack
+                            statestack.pop()                    # Pop back one state (before the reduce)
+                            state = statestack[-1]
+                            sym.type = 'error'
+                            sym.value = 'error'
+                            lookahead = sym
+                            column = termids.get('error', noterm)
+                            errorcount = error_count
+                            self.errorok = False
+
+                        continue
+
+                    else:
+
+                        targ = [sym]
+
+                        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+                        # The code enclosed in this section is duplicated
+                        # above as a performance optimization.  Make sure
+                        # changes get made in both locations.
+
+                        pslice.slice = targ
+
+                        try:
+                            # Call the grammar rule with our special slice object
+                            self.state = state
+                            p.callable(pslice)
+                            symstack.append(sym)
+                            state = goto[statestack[-1]][pgoto]
+                            statestack.append(state)
+                        except SyntaxError:
+                            # If an error was set. Enter error recovery state
+                            lookaheadstack.append(lookahead)    # Save the current lookahead token
+                            statestack.pop()                    # Pop back one state (before the reduce)
+                            state = statestack[-1]
+                            sym.type = 'error'
+                            sym.value = 'error'
+                            lookahead = sym
+                            column = termids.get('error', noterm)
+                            errorcount = error_count
+                            self.errorok = False
+
+                        continue
+
+                if t == 0:
+                    n = symstack[-1]
+                    return getattr(n, 'value', None)
+
+            if t is None:
+
+                # We have some kind of parsing error here.  See parsedebug()
+                # for a description of the recovery procedure.
+                if errorcount == 0 or self.errorok:
+                    errorcount = error_count
+                    self.errorok = False
+                    errtoken = lookahead
+                    if errtoken.type == '$end':
+                        errtoken = None               # End of file!
+                    if self.errorfunc:
+                        if errtoken and not hasattr(errtoken, 'lexer'):
+                            errtoken.lexer = lexer
+                        self.state = state
+                        tok = self.errorfunc(errtoken)
+                        if self.errorok:
+                            # User must have done some kind of panic
+                            # mode recovery on their own.  The
+                            # returned token is the next lookahead
+                            lookahead = tok
+                            if tok:
+                                column = termids.get(tok.type, noterm)
+                            errtoken = None
+                            continue
+                    else:
+                        if errtoken:
+                            if hasattr(errtoken, 'lineno'):
+                                lineno = lookahead.lineno
+                            else:
+                                lineno = 0
+                            if lineno:
+                                sys.stderr.write('yacc: Syntax error at line %d, token=%s\n' % (lineno, errtoken.type))
+                            else:
+                                sys.stderr.write('yacc: Syntax error, token=%s' % errtoken.type)
+                        else:
+                            sys.stderr.write('yacc: Parse error in input. EOF\n')
+                            return
+
+                else:
+                    errorcount = error_count
+
+                # case 1:  the statestack only has 1 entry on it.  If we're in this state, the
+                # entire parse has been rolled back and we're completely hosed.   The token is
+                # discarded and we just keep going.
+
+                if len(statestack) <= 1 and lookahead.type != '$end':
+                    lookahead = None
+                    errtoken = None
+                    state = 0
+                    # Nuke the pushback stack
+                    del lookaheadstack[:]
+                    continue
+
+                # case 2: the statestack has a couple of entries on it, but we're
+                # at the end of the file. nuke the top entry and generate an error token
+
+                # Start nuking entries on the stack
+                if lookahead.type == '$end':
+                    # Whoa. We're really hosed here. Bail out
+                    return
+
+                if lookahead.type != 'error':
+                    sym = symstack[-1]
+                    if sym.type == 'error':
+                        # Hmmm. Error is on top of stack, we'll just nuke input
+                        # symbol and continue
+                        lookahead = None
+                        continue
+
+                    # Create the error symbol for the first time and make it the new lookahead symbol
+                    t = YaccSymbol()
+                    t.type = 'error'
+
+                    if hasattr(lookahead, 'lineno'):
+                        t.lineno = t.endlineno = lookahead.lineno
+                    if hasattr(lookahead, 'lexpos'):
+                        t.lexpos = t.endlexpos = lookahead.lexpos
+                    t.value = lookahead
+                    lookaheadstack.append(lookahead)
+                    lookahead = t
+                    column = termids.get('error', noterm)
+                else:
+                    symstack.pop()
+                    statestack.pop()
+                    state = statestack[-1]
+
+                continue
+
+            # If we'r here, something really bad happened
+            raise RuntimeError('yacc: internal parser error!!!\n')
+
 # -----------------------------------------------------------------------------
 #                          === Grammar Representation ===
 #
@@ -779,6 +1125,12 @@ class Grammar(object):
 
         self.Follow       = {}      # A dictionary of precomputed FOLLOW(x) symbols
 
+        self.Termbits     = {}      # A dictionary mapping terminals (plus '$end' and '<empty>')
+                                    # to the bit that stands for them in a set of terminals
+
+        self.FirstBits    = {}      # FIRST(x) and FOLLOW(x) as sets of terminal bits
+        self.FollowBits   = {}
+
         self.Precedence   = {}      # Precedence rules for each terminal. Contains tuples of the
                                     # form ('right',level) or ('nonassoc', level) or ('left',level)
 
@@ -1072,44 +1424,57 @@ class Grammar(object):
 
         return unused
 
+    # -------------------------------------------------------------------------
+    # set_termbits()
+    #
+    # Numbers the terminals so that sets of terminals can be represented as
+    # integers with one bit per terminal.  Sets are converted back to lists of
+    # names (in terminal order) once they are complete.
+    # -------------------------------------------------------------------------
+    def set_termbits(self):
+        for t in list(self.Terminals) + ['$end', '<empty>']:
+            self.Termbits[t] = 1 << len(self.Termbits)
+        self.Termnames = list(self.Termbits)
+
+    def bits_to_symbols(self, bits):
+        symbols = []
+        while bits:
+            low = bits & -bits
+            symbols.append(self.Termnames[low.bit_length() - 1])
+            bits ^= low
+        return symbols
+
     # -------------------------------------------------------------------------
     # _first()
     #
     # Compute the value of FIRST1(beta) where beta is a tuple of symbols.
+    # _first_bits() returns it as a set of terminal bits.
     #
     # During execution of compute_first1, the result may be incomplete.
     # Afterward (e.g., when called from compute_follow()), it will be complete.
     # -------------------------------------------------------------------------
-    def _first(self, beta):
-
+    def _first_bits(self, beta):
         # We are computing First(x1,x2,x3,...,xn)
-        result = []
+        empty = self.Termbits['<empty>']
+        result = 0
         for x in beta:
-            x_produces_empty = False
+            f = self.FirstBits[x]
 
             # Add all the non-<empty> symbols of First[x] to the result.
-            for f in self.First[x]:
-                if f == '<empty>':
-                    x_produces_empty = True
-                else:
-                    if f not in result:
-                        result.append(f)
+            result |= f & ~empty
 
-            if x_produces_empty:
-                # We have to consider the next x in beta,
-                # i.e. stay in the loop.
-                pass
-            else:
-                # We don't have to consider any further symbols in beta.
+            # Only if x produces empty do we have to consider the next x
+            if not f & empty:
                 break
         else:
-            # There was no 'break' from the loop,
-            # so x_produces_empty was true for all x in beta,
-            # so beta produces empty as well.
-            result.append('<empty>')
+            # x produces empty for all x in beta, so beta produces empty as well.
+            result |= empty
 
         return result
 
+    def _first(self, beta):
+        return self.bits_to_symbols(self._first_bits(beta))
+
     # -------------------------------------------------------------------------
     # compute_first()
     #
@@ -1119,30 +1484,37 @@ class Grammar(object):
         if self.First:
             return self.First
 
+        if not self.Termbits:
+            self.set_termbits()
+        First = self.FirstBits
+
         # Terminals:
         for t in self.Terminals:
-            self.First[t] = [t]
+            First[t] = self.Termbits[t]
 
-        self.First['$end'] = ['$end']
+        First['$end'] = self.Termbits['$end']
 
         # Nonterminals:
 
         # Initialize to the empty set:
         for n in self.Nonterminals:
-            self.First[n] = []
+            First[n] = 0
 
         # Then propagate symbols until no change:
         while True:
             some_change = False
             for n in self.Nonterminals:
                 for p in self.Prodnames[n]:
-                    for f in self._first(p.prod):
-                        if f not in self.First[n]:
-                            self.First[n].append(f)
-                            some_change = True
+                    f = self._first_bits(p.prod)
+                    if f & ~First[n]:
+                        First[n] |= f
+                        some_change = True
             if not some_change:
                 break
 
+        for x, bits in First.items():
+            self.First[x] = self.bits_to_symbols(bits)
+
         return self.First
 
     # ---------------------------------------------------------------------
@@ -1161,14 +1533,17 @@ class Grammar(object):
         if not self.First:
             self.compute_first()
 
+        Follow = self.FollowBits
+        empty = self.Termbits['<empty>']
+
         # Add '$end' to the follow list of the start symbol
         for k in self.Nonterminals:
-            self.Follow[k] = []
+            Follow[k] = 0
 
         if not start:
             start = self.Productions[1].name
 
-        self.Follow[start] = ['$end']
+        Follow[start] = self.Termbits['$end']
 
         while True:
             didadd = False
@@ -1177,22 +1552,19 @@ class Grammar(object):
                 for i, B in enumerate(p.prod):
                     if B in self.Nonterminals:
                         # Okay. We got a non-terminal in a production
-                        fst = self._first(p.prod[i+1:])
-                        hasempty = False
-                        for f in fst:
-                            if f != '<empty>' and f not in self.Follow[B]:
-                                self.Follow[B].append(f)
-                                didadd = True
-                            if f == '<empty>':
-                                hasempty = True
-                        if hasempty or i == (len(p.prod)-1):
+                        fst = self._first_bits(p.prod[i+1:])
+                        add = fst & ~empty
+                        if fst & empty:
                             # Add elements of follow(a) to follow(b)
-                            for f in self.Follow[p.name]:
-                                if f not in self.Follow[B]:
-                                    self.Follow[B].append(f)
-                                    didadd = True
+                            add |= Follow[p.name]
+                        if add & ~Follow[B]:
+                            Follow[B] |= add
+                            didadd = True
             if not didadd:
                 break
+
+        for k, bits in Follow.items():
+            self.Follow[k] = self.bits_to_symbols(bits)
         return self.Follow
 
 
@@ -1261,6 +1633,9 @@ class Grammar(object):
 # Inputs:  X    - An input set
 #          R    - A relation
 #          FP   - Set-valued function
+#
+# The sets are terminal bitsets (see Grammar.set_termbits()), so that the
+# union is a single integer or.
 # ------------------------------------------------------------------------------
 
 def digraph(X, R, FP):
@@ -1285,9 +1660,7 @@ def traverse(x, N, stack, F, X, R, FP):
         if N[y] == 0:
             traverse(y, N, stack, F, X, R, FP)
         N[x] = min(N[x], N[y])
-        for a in F.get(y, []):
-            if a not in F[x]:
-                F[x].append(a)
+        F[x] |= F.get(y, 0)
     if N[x] == d:
         N[stack[-1]] = MAXINT
         F[stack[-1]] = F[x]
@@ -1322,7 +1695,8 @@ class LRTable:
         self.lr_goto       = {}        # Goto table
         self.lr_productions  = grammar.Productions    # Copy of grammar Production array
         self.lr_goto_cache = {}        # Cache of computed gotos
-        self.lr0_cidhash   = {}        # Cache of closures
+        self.lr0_closures  = {}        # Cache of closures, keyed by their kernel items
+        self.lr0_cidhash   = {}        # Map of closures to state numbers
 
         self._add_count    = 0         # Internal counter used to detect cycles
 
@@ -1346,8 +1720,15 @@ class LRTable:
             p.bind(pdict)
 
     # Compute the LR(0) closure operation on I, where I is a set of LR(0) items.
+    # The closure of a given set of items is only computed once, so the same
+    # closure is always the same Python object.
 
     def lr0_closure(self, I):
+        key = tuple(I)
+        J = self.lr0_closures.get(key)
+        if J is not None:
+            return J
+
         self._add_count += 1
 
         # Add everything in I to J
@@ -1364,14 +1745,14 @@ class LRTable:
                     x.lr0_added = self._add_count
                     didadd = True
 
+        self.lr0_closures[key] = J
         return J
 
-    # Compute the LR(0) goto function goto(I,X) where I is a set
-    # of LR(0) items and X is a grammar symbol.   This function is written
-    # in a way that guarantees uniqueness of the generated goto sets
-    # (i.e. the same goto set will never be returned as two different Python
-    # objects).  With uniqueness, we can later do fast set comparisons using
-    # id(obj) instead of element-wise comparison.
+    # Compute the LR(0) goto function goto(I,X) where I is a set of LR(0) items
+    # and X is a grammar symbol.  Since lr0_closure() returns the same object
+    # for the same kernel, the same goto set is never returned as two different
+    # Python objects.  With uniqueness, we can later do fast set comparisons
+    # using id(obj) instead of element-wise comparison.
 
     def lr0_goto(self, I, x):
         # First we look for a previously cached entry
@@ -1379,31 +1760,15 @@ class LRTable:
         if g:
             return g
 
-        # Now we generate the goto set in a way that guarantees uniqueness
-        # of the result
-
-        s = self.lr_goto_cache.get(x)
-        if not s:
-            s = {}
-            self.lr_goto_cache[x] = s
-
         gs = []
         for p in I:
             n = p.lr_next
             if n and n.lr_before == x:
-                s1 = s.get(id(n))
-                if not s1:
-                    s1 = {}
-                    s[id(n)] = s1
                 gs.append(n)
-                s = s1
-        g = s.get('$end')
-        if not g:
-            if gs:
-                g = self.lr0_closure(gs)
-                s['$end'] = g
-            else:
-                s['$end'] = gs
+        if gs:
+            g = self.lr0_closure(gs)
+        else:
+            g = gs
         self.lr_goto_cache[(id(I), x)] = g
         return g
 
@@ -1495,12 +1860,14 @@ class LRTable:
 
     def find_nonterminal_transitions(self, C):
         trans = []
+        seen = set()
         for stateno, state in enumerate(C):
             for p in state:
                 if p.lr_index < p.len - 1:
                     t = (stateno, p.prod[p.lr_index+1])
                     if t[1] in self.grammar.Nonterminals:
-                        if t not in trans:
+                        if t not in seen:
+                            seen.add(t)
                             trans.append(t)
         return trans
 
@@ -1510,24 +1877,24 @@ class LRTable:
     # Computes the DR(p,A) relationships for non-terminal transitions.  The input
     # is a tuple (state,N) where state is a number and N is a nonterminal symbol.
     #
-    # Returns a list of terminals.
+    # Returns a set of terminal bits.
     # -----------------------------------------------------------------------------
 
     def dr_relation(self, C, trans, nullable):
         state, N = trans
-        terms = []
+        termbits = self.grammar.Termbits
+        terms = 0
 
         g = self.lr0_goto(C[state], N)
         for p in g:
             if p.lr_index < p.len - 1:
                 a = p.prod[p.lr_index+1]
                 if a in self.grammar.Terminals:
-                    if a not in terms:
-                        terms.append(a)
+                    terms |= termbits[a]
 
         # This extra bit is to handle the start state
         if state == 0 and N == self.grammar.Productions[0].prod[0]:
-            terms.append('$end')
+            terms |= termbits['$end']
 
         return terms
 
@@ -1701,15 +2068,16 @@ class LRTable:
     # -----------------------------------------------------------------------------
 
     def add_lookaheads(self, lookbacks, followset):
+        lookaheads = {}
         for trans, lb in lookbacks.items():
+            f = followset.get(trans, 0)
             # Loop over productions in lookback
             for state, p in lb:
-                if state not in p.lookaheads:
-                    p.lookaheads[state] = []
-                f = followset.get(trans, [])
-                for a in f:
-                    if a not in p.lookaheads[state]:
-                        p.lookaheads[state].append(a)
+                key = (state, p)
+                lookaheads[key] = lookaheads.get(key, 0) | f
+
+        for (state, p), bits in lookaheads.items():
+            p.lookaheads[state] = self.grammar.bits_to_symbols(bits)
 
     # -----------------------------------------------------------------------------
     # add_lalr_lookaheads()
@@ -1781,8 +2149,9 @@ class LRTable:
                         else:
                             # We are at the end of a production.  Reduce!
                             laheads = p.lookaheads[st]
+                            m = 'reduce using rule %d (%s)' % (p.number, p)
                             for a in laheads:
-                                actlist.append((a, p, 'reduce using rule %d (%s)' % (p.number, p)))
+                                actlist.append((a, p, m))
                                 r = st_action.get(a)
                                 if r is not None:
                                     # Whoa. Have a shift/reduce or reduce/reduce conflict
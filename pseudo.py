@@ -0,0 +1,145 @@
+import functools
+import heapq
+from isa import cycle_costs
+
+# Pseudo-instructions and the real instructions they expand into:
+#
+#   mov Dd, Ds          Dd = Ds
+#   clr Dd              Dd = 0
+#   inc Dd[, Dt]        Dd = Dd + 1
+#   dec Dd[, Dt]        Dd = Dd - 1
+#   ldi Dd, N[, Dt]     Dd = N, for any 11-bit N from -1024 to 2047
+#   call label          jal label
+#   ret                 jr
+#
+# Dt is a register the expansion may overwrite. Without it, a register that
+# is needed is saved with push and restored with pop around the expansion.
+#
+# Most have more than one expansion, and the one taking the fewest cycles
+# under the cycle costs (isa.cycle_costs, or as.py --cycles) is used, with
+# fewer words breaking ties. The choice only depends on the pattern of the
+# operands (which registers are the same, whether Dt is given, the value of
+# N), so it is made once per pattern and cost table. Expansions are written
+# with "d", "s" and "t" standing for Dd, Ds and Dt.
+
+# Largest value li can load
+LI_MAX = 31
+
+WORD_VALUES = 2048
+
+aliases = {"call": "jal", "ret": "jr"}
+
+# Number of register operands each one takes before the optional Dt
+registers = {"mov": 2, "clr": 1, "inc": 1, "dec": 1, "ldi": 1}
+
+
+def cost(code, costs):
+    return (sum(costs[instr[0]] for instr in code), len(code))
+
+
+def cheapest(candidates, costs):
+    return min(candidates, key=lambda code: cost(code, costs))
+
+
+def saved(code, scratch):
+    # Saves t around code if it uses t and t is not free to overwrite
+    if scratch or not any("t" in instr[1:] for instr in code):
+        return code
+    return [("push", "t")] + code + [("pop", "t")]
+
+
+@functools.lru_cache(maxsize=None)
+def constants(scratch, costs):
+    # Cheapest way to load every 11-bit value into d, found with Dijkstra's
+    # algorithm from "li d, a". With a scratch register t, a multiple of d
+    # plus or minus a loaded constant is one more step. Returns, by value,
+    # the previous value and the instructions from it.
+    costs = dict(costs)
+    li = (costs["li"], 1)
+    double = (costs["add"], 1)
+    steps = []
+    if scratch:
+        for b in range(1, LI_MAX + 1):
+            steps.append((b, [("li", "t", b), ("add", "d", "d", "t")]))
+            steps.append((-b, [("li", "t", b), ("sub", "d", "d", "t")]))
+
+    # Entries are (cost, value, order pushed, previous value, instructions)
+    best = {}
+    queue = [(li, a, a, None, [("li", "d", a)]) for a in range(LI_MAX + 1)]
+    pushed = len(queue)
+    while queue:
+        spent, value, _, previous, code = heapq.heappop(queue)
+        if value in best:
+            continue
+        best[value] = (previous, code)
+        candidates = [((value * 2) % WORD_VALUES, double, [("add", "d", "d", "d")])]
+        for delta, step in steps:
+            candidates.append(((value + delta) % WORD_VALUES, cost(step, costs), step))
+        for following, extra, step in candidates:
+            if following not in best:
+                total = (spent[0] + extra[0], spent[1] + extra[1])
+                heapq.heappush(queue, (total, following, pushed, value, step))
+                pushed += 1
+    return best
+
+
+def load(value, scratch, costs):
+    # Instructions loading value into d, or None if it cannot be done
+    table = constants(scratch, costs)
+    if value not in table:
+        return None
+    code = []
+    while value is not None:
+        value, step = table[value]
+        code[:0] = step
+    return code
+
+
+@functools.lru_cache(maxsize=None)
+def pattern(op, same, scratch, value, costs):
+    # Expansion of op with placeholder registers. same says Dd and Ds are
+    # the same register, scratch that Dt is given.
+    table = dict(costs)
+    if op == "mov":
+        if same:
+            return []
+        return cheapest([[("li", "d", 0), ("add", "d", "d", "s")], [("push", "s"), ("pop", "d")]], table)
+    if op == "clr":
+        return cheapest([[("li", "d", 0)], [("sub", "d", "d", "d")]], table)
+    if op in ("inc", "dec"):
+        arith = "add" if op == "inc" else "sub"
+        return saved([("li", "t", 1), (arith, "d", "d", "t")], scratch)
+    if op == "ldi":
+        # Either in d alone, or with t
+        candidates = [saved(load(value, True, costs), scratch)]
+        if load(value, False, costs) is not None:
+            candidates.append(load(value, False, costs))
+        return cheapest(candidates, table)
+    raise ValueError(f"unknown pseudo-instruction '{op}'")
+
+
+def expand(instr, costs=None):
+    # Real instructions for a pseudo-instruction tuple such as
+    # ("mov", "D1", "D2") or ("ldi", "D0", 100, "D3"). The value of ldi must
+    # already be an 11-bit word.
+    op = instr[0]
+    if op in aliases:
+        return [(aliases[op],) + instr[1:]]
+
+    costs = tuple(sorted((cycle_costs if costs is None else costs).items()))
+    count = registers[op]
+    names = {"d": instr[1]}
+    if count == 2:
+        names["s"] = instr[2]
+    operands = instr[1 + count :]
+    value = None
+    if op == "ldi":
+        value, operands = operands[0], operands[1:]
+    if operands:
+        names["t"] = operands[0]
+    else:
+        # Any register other than d can be saved and restored
+        names["t"] = next(f"D{r}" for r in range(4) if f"D{r}" != instr[1])
+
+    code = pattern(op, names.get("s") == names["d"], bool(operands), value, costs)
+    return [tuple(names.get(part, part) if isinstance(part, str) else part for part in step) for step in code]
@@ -0,0 +1,573 @@
+from array import array
+from isa import (
+    ADD,
+    BEQ,
+    BNE,
+    DSEL_MASK,
+    DSEL_SHIFT,
+    J,
+    JAL,
+    JR,
+    LI,
+    LW,
+    NOP,
+    OPCODE_SHIFT,
+    OPERAND_MASK,
+    POP,
+    PUSH,
+    SLT,
+    STACK_DEPTH,
+    SUB,
+    SW,
+    control,
+    opcode_names,
+)
+import mmap
+import struct
+import sys
+
+# Simulator for the ISA in isa.py.
+#
+# The machine has four 11-bit registers D0-D3, one memory for both the program
+# and its data, and a hardware stack of STACK_DEPTH words shared by push/pop
+# and jal/jr. Execution starts at address 0 and the program counter wraps
+# around at the end of memory.
+#
+#   add/sub   Dsel = Ds1 + Ds2 / Ds1 - Ds2, modulo 2^11
+#   slt       Dsel = 1 if Ds1 < Ds2 as signed 11-bit numbers, else 0
+#   li        Dsel = imm
+#   lw/sw     Dsel = memory[addr] / memory[addr] = Dsel
+#   beq/bne   go to addr if Dsel == 0 / Dsel != 0
+#   push/pop  push Dsel / pop into Dsel
+#   j/jal     go to addr / push the return address and go to addr
+#   jr        pop an address and go there
+#
+# Opcodes 14 and 15 are illegal. Illegal instructions and stack overflow or
+# underflow stop the simulation with a SimulationError.
+#
+# Machine.step() decodes and executes a single instruction. Machine.run()
+# executes the program a basic block at a time instead: each block is compiled
+# once into a Python function that keeps the registers in locals, and a block
+# that branches back to its own start loops inside the function. Memory is
+# shared by code and data, so a sw into a compiled block throws it away.
+#
+# run() also stops early once the machine has halted, meaning it can never get
+# out of the state it is in:
+#
+#   - a block with no effect but branching back to its own start, such as
+#     "end: j end", has just done so; or
+#   - the state (pc, registers, stack and memory) is one the machine was in
+#     before. States are sampled every CHECK_INTERVAL instructions and
+#     compared with Brent's cycle detection, so such loops are found within
+#     a few times their length.
+#
+# run() can also be given an address to stop at, which it does as soon as
+# the machine gets there. Machine.snapshot() packs the state of the machine
+# into bytes that Machine.restore() loads back into it, or into another
+# machine with the same memory size, so that many runs can start from the
+# state a shared prefix of the program leaves behind without running it
+# again.
+#
+# A Machine created with profile=True counts the instructions executed at
+# each address, and how often each beq/bne was taken, in a Profile. Given a
+# Trace, it writes a record of every instruction it executes into it.
+
+MASK = 0b11111111111
+SIGN = 0b10000000000
+
+# Addresses are 5 bits wide
+ADDRESSABLE = 32
+
+# Longest basic block compiled into one function
+MAX_BLOCK = 64
+
+# Instructions between the samples of the state for halt detection
+CHECK_INTERVAL = 4096
+
+# Instructions that write Dsel
+writes = (ADD, SUB, SLT, LI, LW, POP)
+
+
+class SimulationError(Exception):
+    pass
+
+
+# Trace file layout (little-endian): a header followed by a ring buffer of
+# fixed-size records, one per instruction executed:
+#
+#   header  magic, capacity in records, number of records written
+#   record  pc, word, register written (or NO_REGISTER), stack depth after
+#           the instruction, value written to the register, address written
+#           by sw (or NO_ADDRESS), value written to memory
+#
+# Once more than capacity records are written the oldest are overwritten, so
+# the buffer holds the last capacity instructions.
+TRACE_MAGIC = b"AST1"
+TRACE_HEADER = struct.Struct("<4sIQ")
+TRACE_RECORD = struct.Struct("<HHBBHHH")
+NO_REGISTER = 0xFF
+NO_ADDRESS = 0xFFFF
+
+
+class Trace:
+    def __init__(self, capacity, path=None):
+        # The buffer is allocated up front, in memory or as a memory-mapped
+        # file at path
+        size = TRACE_HEADER.size + capacity * TRACE_RECORD.size
+        if path is None:
+            self.buffer = bytearray(size)
+        else:
+            with open(path, "w+b") as f:
+                f.truncate(size)
+                self.buffer = mmap.mmap(f.fileno(), size)
+        self.capacity = capacity
+        # Offset of the next record, and how many times the buffer has been
+        # filled. A list so that compiled blocks can update it.
+        self.position = [TRACE_HEADER.size, 0]
+
+    @classmethod
+    def open(cls, path):
+        # Maps a trace file written earlier, read-only
+        trace = cls.__new__(cls)
+        with open(path, "rb") as f:
+            f.seek(0, 2)
+            if f.tell() < TRACE_HEADER.size:
+                raise ValueError(f"{path}: not a trace file")
+            trace.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, trace.capacity, count = TRACE_HEADER.unpack_from(trace.buffer)
+        if magic != TRACE_MAGIC or len(trace.buffer) != TRACE_HEADER.size + trace.capacity * TRACE_RECORD.size:
+            raise ValueError(f"{path}: not a trace file")
+        wraps, index = divmod(count, trace.capacity)
+        trace.position = [TRACE_HEADER.size + index * TRACE_RECORD.size, wraps]
+        return trace
+
+    def count(self):
+        offset, wraps = self.position
+        return wraps * self.capacity + (offset - TRACE_HEADER.size) // TRACE_RECORD.size
+
+    def flush(self):
+        TRACE_HEADER.pack_into(self.buffer, 0, TRACE_MAGIC, self.capacity, self.count())
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.flush()
+
+    def records(self, start=0):
+        # Yields (index, record) for the records from index start on that are
+        # still in the buffer, oldest first
+        count = self.count()
+        first = max(start, count - self.capacity)
+        for index in range(first, count):
+            offset = TRACE_HEADER.size + (index % self.capacity) * TRACE_RECORD.size
+            yield index, TRACE_RECORD.unpack_from(self.buffer, offset)
+
+
+# Snapshot layout (little-endian): a header followed by the registers, the
+# stack from the bottom up and the memory as arrays of 16-bit words
+#
+#   header  magic, memory size in words, pc, stack depth, instructions run
+SNAPSHOT_MAGIC = b"ASS1"
+SNAPSHOT_HEADER = struct.Struct("<4sIIBQ")
+
+
+def pack_words(words):
+    words = array("H", words)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words.tobytes()
+
+
+def unpack_words(data):
+    words = array("H")
+    words.frombytes(data)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+
+class Profile:
+    def __init__(self, size):
+        self.counts = array("Q", [0]) * size
+        self.taken = array("Q", [0]) * size
+        self.not_taken = array("Q", [0]) * size
+
+
+class Machine:
+    def __init__(self, words, depth=32, profile=False, trace=None):
+        # words is the encoded image, e.g. Program.encode()
+        self.memory = list(words)
+        self.memory.extend([0] * (max(depth, ADDRESSABLE) - len(self.memory)))
+        self.regs = [0, 0, 0, 0]
+        self.stack = []
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+        # Address run() stops at, which compiled blocks end before
+        self.until = None
+        self.profile = Profile(len(self.memory)) if profile else None
+        self.trace = trace
+        # Compiled blocks by start address, as (function, length, addresses,
+        # halts), and the starts of the blocks covering each address
+        self.blocks = {}
+        self.code = {}
+        # Sampled state that later samples are compared with, and the number
+        # of samples since it was taken (Brent's power and lambda)
+        self.saved = None
+        self.saved_memory = None
+        self.power = 1
+        self.age = 0
+
+    def snapshot(self):
+        # The registers, pc, stack, memory and instruction count as bytes.
+        # The profile and trace are not part of it.
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(self.memory), self.pc, len(self.stack), self.steps)
+        return header + pack_words(self.regs) + pack_words(self.stack) + pack_words(self.memory)
+
+    def restore(self, data):
+        # Loads a snapshot in place. Compiled blocks hold on to the
+        # registers, stack and memory, so their contents are replaced rather
+        # than the lists themselves, and blocks are only thrown away if the
+        # code under them differs.
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("not a snapshot")
+        magic, size, pc, depth, steps = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or len(data) != SNAPSHOT_HEADER.size + 2 * (4 + depth + size):
+            raise ValueError("not a snapshot")
+        if size != len(self.memory):
+            raise ValueError(f"snapshot of {size} words of memory, the machine has {len(self.memory)}")
+        if pc >= size or depth > STACK_DEPTH:
+            raise ValueError("invalid snapshot")
+        words = unpack_words(data[SNAPSHOT_HEADER.size :])
+
+        memory = self.memory
+        image = words[4 + depth :]
+        for address in [address for address in self.code if memory[address] != image[address]]:
+            if address in self.code:
+                self.invalidate(address)
+        memory[:] = image
+        self.regs[:] = words[:4]
+        self.stack[:] = words[4 : 4 + depth]
+        self.pc = pc
+        self.steps = steps
+        self.halted = False
+        self.saved = self.saved_memory = None
+        self.power = 1
+        self.age = 0
+
+    def step(self):
+        memory = self.memory
+        regs = self.regs
+        stack = self.stack
+        pc = self.pc
+        word = memory[pc]
+        op = word >> OPCODE_SHIFT
+        sel = (word >> DSEL_SHIFT) & DSEL_MASK
+        operand = word & OPERAND_MASK
+        next_pc = (pc + 1) % len(memory)
+
+        if op == ADD:
+            regs[sel] = (regs[(operand >> 2) & 0b11] + regs[operand & 0b11]) & MASK
+        elif op == SUB:
+            regs[sel] = (regs[(operand >> 2) & 0b11] - regs[operand & 0b11]) & MASK
+        elif op == SLT:
+            regs[sel] = 1 if (regs[(operand >> 2) & 0b11] ^ SIGN) < (regs[operand & 0b11] ^ SIGN) else 0
+        elif op == LI:
+            regs[sel] = operand
+        elif op == LW:
+            regs[sel] = memory[operand]
+        elif op == SW:
+            memory[operand] = regs[sel]
+            if operand in self.code:
+                self.invalidate(operand)
+        elif op == BEQ or op == BNE:
+            taken = (regs[sel] == 0) == (op == BEQ)
+            if taken:
+                next_pc = operand
+            if self.profile is not None:
+                (self.profile.taken if taken else self.profile.not_taken)[pc] += 1
+        elif op == PUSH or op == JAL:
+            if len(stack) == STACK_DEPTH:
+                raise SimulationError(f"stack overflow at address {pc}")
+            if op == PUSH:
+                stack.append(regs[sel])
+            else:
+                stack.append(next_pc)
+                next_pc = operand
+        elif op == POP or op == JR:
+            if not stack:
+                raise SimulationError(f"stack underflow at address {pc}")
+            if op == POP:
+                regs[sel] = stack.pop()
+            else:
+                next_pc = stack.pop() % len(memory)
+        elif op == J:
+            next_pc = operand
+        elif op != NOP:
+            raise SimulationError(f"illegal instruction {word:011b} at address {pc}")
+
+        if self.profile is not None:
+            self.profile.counts[pc] += 1
+        if self.trace is not None:
+            self.record(pc, word, op, sel, operand)
+        self.pc = next_pc
+        self.steps += 1
+
+    def record(self, pc, word, op, sel, operand):
+        trace = self.trace
+        position = trace.position
+        reg, value = (sel, self.regs[sel]) if op in writes else (NO_REGISTER, 0)
+        address, data = (operand, self.memory[operand]) if op == SW else (NO_ADDRESS, 0)
+        TRACE_RECORD.pack_into(trace.buffer, position[0], pc, word, reg, len(self.stack), value, address, data)
+        position[0] += TRACE_RECORD.size
+        if position[0] == len(trace.buffer):
+            position[0] = TRACE_HEADER.size
+            position[1] += 1
+
+    def interpret(self, limit):
+        # Runs at most limit instructions with step()
+        for _ in range(limit):
+            self.step()
+        return limit
+
+    def run(self, limit, until=None):
+        # Runs until the machine halts, limit instructions have run or, given
+        # an address until, it has run at least one instruction and arrived
+        # at that address. Returns the number of instructions run. Samples
+        # are taken whenever steps is a multiple of CHECK_INTERVAL, so that
+        # each one follows from the last however run() is called.
+        if until is not None and until != self.until:
+            # Blocks may run past the new address
+            self.until = until
+            self.blocks.clear()
+            self.code.clear()
+        done = 0
+        while done < limit and not self.halted:
+            chunk = min(limit - done, CHECK_INTERVAL - self.steps % CHECK_INTERVAL)
+            done += self._run_blocks(chunk, until)
+            if self.steps % CHECK_INTERVAL == 0 and not self.halted:
+                self._check_state()
+            if done and self.pc == until:
+                break
+        return done
+
+    def _run_blocks(self, limit, until=None):
+        # Runs at most limit instructions with compiled blocks, stopping
+        # early at until. Blocks longer than what is left of the limit, and
+        # instructions that stop the simulation, are left to step().
+        blocks = self.blocks
+        pc = self.pc
+        left = limit
+        while left:
+            block = blocks.get(pc)
+            if block is None:
+                block = self.compile(pc)
+            function, length, _, halts = block
+            if length <= left:
+                start = pc
+                pc, steps = function(left)
+                if steps:
+                    self.steps += steps
+                    left -= steps
+                    if halts and pc == start:
+                        self.halted = True
+                        break
+                    if pc == until:
+                        break
+                    continue
+            self.pc = pc
+            self.step()
+            pc = self.pc
+            left -= 1
+            if pc == until:
+                break
+        self.pc = pc
+        return limit - left
+
+    def _check_state(self):
+        # Cheapest comparisons first; memory is only compared when everything
+        # else matches
+        state = (self.pc, tuple(self.regs), tuple(self.stack))
+        if state == self.saved and self.memory == self.saved_memory:
+            self.halted = True
+            return
+        self.age += 1
+        if self.age == self.power:
+            self.saved = state
+            self.saved_memory = list(self.memory)
+            self.power *= 2
+            self.age = 0
+
+    def invalidate(self, address):
+        for start in self.code.pop(address, ()):
+            _, _, addresses, _ = self.blocks.pop(start)
+            for other in addresses:
+                if other != address:
+                    self.code[other].discard(start)
+                    if not self.code[other]:
+                        del self.code[other]
+
+    def compile(self, start):
+        memory = self.memory
+        size = len(memory)
+
+        instructions = []
+        end = start
+        while len(instructions) < min(MAX_BLOCK, size):
+            if instructions and end == self.until:
+                break
+            word = memory[end]
+            op = word >> OPCODE_SHIFT
+            if op not in opcode_names:
+                break
+            instructions.append((end, op, (word >> DSEL_SHIFT) & DSEL_MASK, word & OPERAND_MASK))
+            end = (end + 1) % size
+            if op in control:
+                break
+        length = len(instructions)
+        addresses = {pc for pc, _, _, _ in instructions}
+
+        # Addresses the block can continue at; end is the one after it
+        exits = set()
+        last = instructions[-1][1] if instructions else None
+        if last not in control:
+            exits.add(end)
+        elif last in (BEQ, BNE):
+            exits.update((instructions[-1][3], end))
+        elif last != JR:
+            exits.add(instructions[-1][3])
+        loops = length > 0 and start in exits
+        # A loop that changes nothing runs forever once it is taken. Its
+        # function returns after one pass so that run() can stop, as does a
+        # loop starting at the address run() stops at.
+        halts = loops and all(op in (BEQ, BNE, J, NOP) for _, op, _, _ in instructions)
+        if halts or start == self.until:
+            loops = False
+
+        written = sorted({sel for _, op, sel, _ in instructions if op in writes})
+        params = ["regs", "memory", "stack", "code", "invalidate"]
+        if self.profile is not None:
+            params += ["counts", "taken", "not_taken"]
+        if self.trace is not None:
+            params += ["pack", "buffer", "position"]
+        lines = [
+            f"def block_{start}(budget, {', '.join(f'{name}={name}' for name in params)}):",
+            "    d0, d1, d2, d3 = regs",
+            "    steps = 0",
+        ]
+        if self.trace is not None:
+            lines.append("    pos = position[0]")
+        if loops:
+            lines.append("    while True:")
+        pad = " " * (8 if loops else 4)
+
+        def leave(pc, done, indent=0):
+            # Stores the registers and returns the next address and the
+            # number of instructions executed
+            inner = pad + " " * indent
+            for r in written:
+                lines.append(f"{inner}regs[{r}] = d{r}")
+            if self.trace is not None:
+                lines.append(f"{inner}position[0] = pos")
+            lines.append(f"{inner}return {pc}, steps + {done}")
+
+        def go(target, indent=0):
+            inner = pad + " " * indent
+            if target == start and loops:
+                lines.append(f"{inner}steps += {length}")
+                lines.append(f"{inner}if steps + {length} <= budget:")
+                lines.append(f"{inner}    continue")
+                leave(start, 0, indent)
+            else:
+                leave(target, length, indent)
+
+        for i, (pc, op, sel, operand) in enumerate(instructions):
+            rd = f"d{sel}"
+            next_pc = (pc + 1) % size
+            lines.append(f"{pad}# {pc}: {opcode_names[op]}")
+            # Instructions that stop the simulation are left to step()
+            if op in (PUSH, JAL):
+                lines.append(f"{pad}if len(stack) == {STACK_DEPTH}:")
+                leave(pc, i, 4)
+            elif op in (POP, JR):
+                lines.append(f"{pad}if not stack:")
+                leave(pc, i, 4)
+            if self.profile is not None:
+                lines.append(f"{pad}counts[{pc}] += 1")
+
+            if op in (ADD, SUB, SLT):
+                a, b = f"d{(operand >> 2) & 0b11}", f"d{operand & 0b11}"
+                if op == ADD:
+                    lines.append(f"{pad}{rd} = ({a} + {b}) & {MASK}")
+                elif op == SUB:
+                    lines.append(f"{pad}{rd} = ({a} - {b}) & {MASK}")
+                else:
+                    lines.append(f"{pad}{rd} = 1 if ({a} ^ {SIGN}) < ({b} ^ {SIGN}) else 0")
+            elif op == LI:
+                lines.append(f"{pad}{rd} = {operand}")
+            elif op == LW:
+                lines.append(f"{pad}{rd} = memory[{operand}]")
+            elif op == SW:
+                lines.append(f"{pad}memory[{operand}] = {rd}")
+            elif op in (PUSH, JAL):
+                lines.append(f"{pad}stack.append({rd if op == PUSH else next_pc})")
+            elif op == POP:
+                lines.append(f"{pad}{rd} = stack.pop()")
+            elif op == JR:
+                lines.append(f"{pad}pc = stack.pop() % {size}")
+
+            if self.trace is not None:
+                reg, value = (sel, rd) if op in writes else (NO_REGISTER, 0)
+                address, data = (operand, rd) if op == SW else (NO_ADDRESS, 0)
+                lines.append(
+                    f"{pad}pack(buffer, pos, {pc}, {memory[pc]}, {reg}, len(stack), {value}, {address}, {data})"
+                )
+                lines.append(f"{pad}pos += {TRACE_RECORD.size}")
+                lines.append(f"{pad}if pos == {len(self.trace.buffer)}:")
+                lines.append(f"{pad}    pos = {TRACE_HEADER.size}")
+                lines.append(f"{pad}    position[1] += 1")
+
+            if op == SW:
+                if operand in addresses:
+                    # The block just overwrote itself
+                    lines.append(f"{pad}invalidate({operand})")
+                    leave(next_pc, i + 1)
+                    break
+                lines.append(f"{pad}if {operand} in code:")
+                lines.append(f"{pad}    invalidate({operand})")
+            elif op == JAL:
+                go(operand)
+            elif op == JR:
+                leave("pc", length)
+            elif op in (BEQ, BNE):
+                lines.append(f"{pad}if {rd} {'==' if op == BEQ else '!='} 0:")
+                if self.profile is not None:
+                    lines.append(f"{pad}    taken[{pc}] += 1")
+                go(operand, 4)
+                if self.profile is not None:
+                    lines.append(f"{pad}not_taken[{pc}] += 1")
+                go(next_pc)
+            elif op == J:
+                go(operand)
+        else:
+            if last not in control:
+                go(end)
+
+        # The machine's state is bound to the parameters' defaults, so that
+        # the function only takes the budget
+        namespace = {
+            "regs": self.regs,
+            "memory": memory,
+            "stack": self.stack,
+            "code": self.code,
+            "invalidate": self.invalidate,
+        }
+        if self.profile is not None:
+            namespace.update(
+                counts=self.profile.counts, taken=self.profile.taken, not_taken=self.profile.not_taken
+            )
+        if self.trace is not None:
+            namespace.update(pack=TRACE_RECORD.pack_into, buffer=self.trace.buffer, position=self.trace.position)
+        exec(compile("\n".join(lines), f"<block {start}>", "exec"), namespace)
+        block = (namespace[f"block_{start}"], length, addresses, halts)
+        self.blocks[start] = block
+        for address in addresses:
+            self.code.setdefault(address, set()).add(start)
+        return block
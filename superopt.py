@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+# Superoptimizer for straight-line add/sub/slt/li code. Regions of a source
+# file are marked with comments:
+#
+#   # superopt live D1
+#           li  D2, 3
+#           add D1, D1, D2
+#           sub D1, D1, D2
+#   # superopt end
+#
+# "live" names the registers that must hold the same values after the
+# region; without it all four must. For every region the shortest sequence
+# of add/sub/slt/li over the registers the region uses that is equivalent
+# to it is printed, if one is shorter than the region.
+#
+# Candidates are enumerated shortest first and run on test vectors: many
+# register values packed into one big integer, 16 bits per value, so that
+# each instruction is one or two integer operations for all of them at once.
+# Candidates that agree with the region on every vector are then proven
+# equivalent, by comparing them as affine functions of the inputs modulo
+# 2^11 when neither uses slt, or else by running them on every possible
+# input when at most two registers are inputs. Candidates that cannot be
+# proven either way are not offered, but the shortest of them is reported.
+
+import argparse
+import functools
+from isa import r_type, regnum
+from mif import comment
+from parser import Parser
+import random
+from sim import MASK, SIGN, pack_words
+
+# The bit above each 11-bit value
+GUARD_BIT = MASK.bit_length()
+
+# Corner cases every test vector set starts with
+CORNERS = (0, 1, 2, 3, 31, 32, SIGN - 1, SIGN, SIGN + 1, MASK - 1, MASK)
+
+# Longest sequence main() searches for unless told otherwise
+MAX_LENGTH = 4
+
+
+class Counterexample(Exception):
+    pass
+
+
+class Vectors:
+    # Integers holding one 11-bit value in each 16-bit lane, and the
+    # instructions on them. The bit above a value absorbs the borrow of a
+    # subtraction so that lanes never affect each other.
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self.ones = int.from_bytes(b"\x01\x00" * lanes, "little")
+        self.mask = MASK * self.ones
+        self.sign = SIGN * self.ones
+        self.guard = (1 << GUARD_BIT) * self.ones
+
+    def pack(self, values):
+        return int.from_bytes(pack_words(values), "little")
+
+    def constant(self, value):
+        return value * self.ones
+
+    def add(self, a, b):
+        return (a + b) & self.mask
+
+    def sub(self, a, b):
+        return ((a | self.guard) - b) & self.mask
+
+    def slt(self, a, b):
+        # The guard bit of (a | guard) - b stays set where a >= b
+        difference = ((a ^ self.sign) | self.guard) - (b ^ self.sign)
+        return ((difference & self.guard) ^ self.guard) >> GUARD_BIT
+
+    def run(self, code, state):
+        state = list(state)
+        for instr in code:
+            if instr[0] == "li":
+                state[regnum(instr[1])] = self.constant(instr[2])
+            else:
+                a, b = state[regnum(instr[2])], state[regnum(instr[3])]
+                state[regnum(instr[1])] = getattr(self, instr[0])(a, b)
+        return state
+
+
+def inputs(code, live):
+    # Registers whose values before the code matter: the ones read before
+    # being written, and the live ones it does not write
+    read = set()
+    written = set()
+    for instr in code:
+        sources = {regnum(r) for r in instr[2:]} if instr[0] in r_type else set()
+        read |= sources - written
+        written.add(regnum(instr[1]))
+    return read | (set(live) - written)
+
+
+def affine(code):
+    # Every register after the code as (constant, coefficients of the four
+    # registers before it) modulo 2^11, or None if the code uses slt
+    state = [(0,) + tuple(int(i == r) for i in range(4)) for r in range(4)]
+    for instr in code:
+        if instr[0] == "li":
+            value = (instr[2], 0, 0, 0, 0)
+        elif instr[0] == "slt":
+            return None
+        else:
+            a, b = state[regnum(instr[2])], state[regnum(instr[3])]
+            sign = 1 if instr[0] == "add" else -1
+            value = tuple((x + sign * y) & MASK for x, y in zip(a, b))
+        state[regnum(instr[1])] = value
+    return state
+
+
+@functools.cache
+def exhaustive(registers):
+    # Vectors holding every combination of values of up to two registers.
+    # Lane i holds i % 2^11 in the first register and i // 2^11 in the
+    # second.
+    values = list(range(MASK + 1))
+    if not registers:
+        return Vectors(1), {}
+    if len(registers) == 1:
+        vectors = Vectors(len(values))
+        return vectors, {registers[0]: vectors.pack(values)}
+    vectors = Vectors(len(values) ** 2)
+    low = vectors.pack(values * len(values))
+    high = vectors.pack([value for value in values for _ in values])
+    return vectors, {registers[0]: low, registers[1]: high}
+
+
+def equivalent(original, candidate, live):
+    # True if both leave the live registers with the same values whatever
+    # the registers hold before, the register values of an input they
+    # differ on if not, or None if neither can be shown
+    a, b = affine(original), affine(candidate)
+    if a is not None and b is not None:
+        for r in live:
+            if a[r] != b[r]:
+                # Inputs with one register set to 1 tell the coefficients
+                # apart, all zeros the constants
+                differs = [i for i in range(4) if a[r][i + 1] != b[r][i + 1]]
+                return tuple(int(i == differs[0]) for i in range(4)) if differs else (0, 0, 0, 0)
+        return True
+
+    registers = tuple(sorted(inputs(original, live) | inputs(candidate, live)))
+    if len(registers) > 2:
+        return None
+    vectors, values = exhaustive(registers)
+    state = [values.get(r, 0) for r in range(4)]
+    a, b = vectors.run(original, state), vectors.run(candidate, state)
+    for r in live:
+        if a[r] != b[r]:
+            difference = a[r] ^ b[r]
+            lane = ((difference & -difference).bit_length() - 1) // 16
+            lane_values = (lane % (MASK + 1), lane // (MASK + 1))
+            return tuple(lane_values[registers.index(i)] if i in registers else 0 for i in range(4))
+    return True
+
+
+def test_inputs(count, rng):
+    # Register values for the test vectors: corner cases, random values and
+    # registers equal to or next to each other, where slt changes
+    result = [(value,) * 4 for value in CORNERS]
+    while len(result) < count:
+        lane = [rng.choice(CORNERS) if rng.random() < 0.25 else rng.randrange(MASK + 1) for _ in range(4)]
+        if rng.random() < 0.5:
+            a, b = rng.sample(range(4), 2)
+            lane[a] = (lane[b] + rng.choice((-1, 0, 0, 1))) & MASK
+        result.append(tuple(lane))
+    return result
+
+
+def superoptimize(original, live=range(4), lanes=64, seed=0, max_length=None):
+    # Returns the shortest sequence proven equivalent to original on the
+    # live registers, or None if there is none shorter, along with the
+    # first candidate shorter than that which passed every test but could
+    # not be proven, or None. Candidates are at most max_length
+    # instructions long, since the search grows exponentially with length.
+    live = sorted(live)
+    original = [instr for instr in original if instr[0] != "nop"]
+    registers = sorted(
+        {regnum(r) for instr in original for r in instr[1:] if isinstance(r, str)} | set(live)
+    )
+    names = [f"D{r}" for r in registers]
+
+    tests = test_inputs(lanes, random.Random(seed))
+
+    # Instructions to choose from; add is commutative, and sub and slt of a
+    # register with itself are li 0
+    choices = [("li", rd, imm) for rd in names for imm in range(32)]
+    for rd in names:
+        for a in names:
+            for b in names:
+                if a <= b:
+                    choices.append(("add", rd, a, b))
+                if a != b:
+                    choices.append(("sub", rd, a, b))
+                    choices.append(("slt", rd, a, b))
+
+    # Instructions by the register they write
+    writing = {regnum(rd): [instr for instr in choices if instr[1] == rd] for rd in names}
+
+    def last(state, target, r):
+        # Instructions that leave register r with its target value. The
+        # second source of add and sub follows from the first.
+        value = target[r]
+        rd = f"D{r}"
+        imm = value & MASK
+        if imm < 32 and value == vectors.constant(imm):
+            yield ("li", rd, imm)
+        holding = {}
+        for b in registers:
+            holding.setdefault(state[b], b)
+        for a in registers:
+            b = holding.get(vectors.sub(value, state[a]))
+            if b is not None:
+                yield ("add", rd) + tuple(f"D{x}" for x in sorted((a, b)))
+            b = holding.get(vectors.sub(state[a], value))
+            if b is not None and b != a:
+                yield ("sub", rd, f"D{a}", f"D{b}")
+        for instr in writing[r]:
+            if instr[0] == "slt" and vectors.slt(state[regnum(instr[2])], state[regnum(instr[3])]) == value:
+                yield instr
+
+    def search(state, target, code, left, seen):
+        # Tries every way to complete code with left more instructions.
+        # seen holds the states already tried with as many left.
+        wrong = [r for r in live if state[r] != target[r]]
+        if len(wrong) > left:
+            return None
+        if not left:
+            return prove(list(code))
+        key = (tuple(state), left)
+        if key in seen:
+            return None
+        seen.add(key)
+        if left == 1 and wrong:
+            # The last instruction has to fix the one register still wrong
+            for instr in last(state, target, wrong[0]):
+                found = prove(code + [instr])
+                if found is not None:
+                    return found
+            return None
+        for instr in choices:
+            code.append(instr)
+            found = search(vectors.run([instr], state), target, code, left - 1, seen)
+            code.pop()
+            if found is not None:
+                return found
+        return None
+
+    unproven = []
+
+    def prove(code):
+        result = equivalent(original, code, live)
+        if result is True:
+            return code
+        if result is not None:
+            # Passed the tests but is wrong; the input it is wrong on
+            # becomes a test and the search starts again
+            raise Counterexample(result)
+        if not unproven:
+            unproven.append(code)
+        return None
+
+    def shorter(found):
+        if unproven and (found is None or len(unproven[0]) < len(found)):
+            return unproven[0]
+        return None
+
+    longest = len(original) - 1 if max_length is None else min(max_length, len(original) - 1)
+    length = 0
+    while length <= longest:
+        vectors = Vectors(len(tests))
+        start = [vectors.pack([lane[r] for lane in tests]) for r in range(4)]
+        target = vectors.run(original, start)
+        try:
+            found = search(start, target, [], length, set())
+        except Counterexample as e:
+            tests.append(e.args[0])
+            continue
+        if found is not None:
+            return found, shorter(found)
+        length += 1
+    return None, shorter(None)
+
+
+def regions(lines):
+    # (first line, last line, live registers) of every marked region, with
+    # 1-based line numbers of the instructions inside the markers
+    result = []
+    begin = None
+    for number, line in enumerate(lines, 1):
+        text = line.partition("#")[2].split()
+        if text[:1] != ["superopt"]:
+            continue
+        if text[1:] == ["end"] and begin is not None:
+            result.append((begin[0], number - 1, begin[1]))
+            begin = None
+        elif text[1:2] == ["live"]:
+            begin = (number + 1, [regnum(r.strip(",")) for r in text[2:]])
+        elif len(text) == 1:
+            begin = (number + 1, list(range(4)))
+    return result
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("files", nargs="+", metavar="FILE")
+    argparser.add_argument(
+        "--lanes", type=int, default=64, help="Number of test vectors candidates are run on first (default: 64)"
+    )
+    argparser.add_argument(
+        "--max-length",
+        type=int,
+        default=MAX_LENGTH,
+        help=f"Longest sequence to search for (default: {MAX_LENGTH})",
+    )
+    args = argparser.parse_args()
+
+    parser = Parser()
+    for name in args.files:
+        with open(name) as f:
+            lines = f.readlines()
+        for first, last, live in regions(lines):
+            # Parsed on its own, with the line numbers of the file
+            code = "\n" * (first - 1) + "".join(lines[first - 1 : last])
+            program = parser.parse(code, file_name=name)
+            original = program.instructions()
+            other = [instr for instr in original if instr[0] not in r_type + ("li", "nop")]
+            if other or program.labels:
+                print(f"{name}:{first}: only add, sub, slt, li and nop without labels can be superoptimized")
+                continue
+            found, unproven = superoptimize(original, live, args.lanes, max_length=args.max_length)
+            if unproven is not None:
+                print(
+                    f"{name}:{first}: {len(original)} instructions may be {len(unproven)},"
+                    " but this could not be proven:"
+                )
+                for instr in unproven:
+                    print(f"        {comment(instr)[3:].rstrip()}")
+            if found is None:
+                if unproven is None and args.max_length < len(original) - 1:
+                    print(f"{name}:{first}: no sequence of up to {args.max_length} instructions found")
+                elif unproven is None:
+                    print(f"{name}:{first}: no shorter sequence found")
+                continue
+            if not found:
+                print(f"{name}:{first}: {len(original)} instructions can be removed")
+                continue
+            print(f"{name}:{first}: {len(original)} instructions can be {len(found)}:")
+            for instr in found:
+                print(f"        {comment(instr)[3:].rstrip()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+from cfg import Graph, StackCheck
+from parser import Parser
+
+
+def analyze(source):
+    program = Parser().parse(source, file_name="test.s")
+    analysis = StackCheck(Graph(program))
+    # Entries turned into source lines
+    errors = [(program.line[entry], message) for entry, message in analysis.errors]
+    warnings = [(program.line[entry], message) for entry, message in analysis.warnings]
+    unreachable = [(program.line[first], program.line[last]) for first, last in analysis.unreachable]
+    return analysis, errors, warnings, unreachable
+
+
+def test_depth_adds_up_calls():
+    analysis, errors, warnings, unreachable = analyze(
+        """\
+        push D0
+        push D1
+        jal f
+        pop D1
+        pop D0
+end:    j end
+f:      push D0
+        push D1
+        push D2
+        pop D2
+        pop D1
+        pop D0
+        jr
+"""
+    )
+    # Two words, the return address and three words in f, the last pushed
+    # on line 9
+    assert analysis.depth == 6 and analysis.graph.program.line[analysis.deepest] == 9
+    assert errors == warnings == unreachable == []
+
+
+def test_overflow_and_underflow():
+    _, errors, _, _ = analyze("".join(f"push D{i % 4}\n" for i in range(9)) + "end: j end\n")
+    assert errors == [(9, "stack overflow: the stack can be 9 words deep here, it holds 8")]
+    _, errors, _, _ = analyze("li D1, 1\npop D1\nend: j end\n")
+    assert errors == [(2, "stack underflow: pop with nothing on the stack")]
+    _, errors, _, _ = analyze("li D1, 1\njr\n")
+    assert errors == [(2, "stack underflow: jr with nothing on the stack")]
+
+
+def test_unbounded_depth_is_a_warning():
+    _, errors, warnings, _ = analyze("jal f\nend: j end\nf: push D0\n jal f\n pop D0\n jr\n")
+    assert errors == [] and warnings == [(4, "recursive call, the stack depth is not bounded")]
+    _, errors, warnings, _ = analyze("beq D0, skip\npush D0\nskip: j skip\n")
+    assert errors == [] and warnings == [(3, "stack depth is 0 or 1 here depending on the path")]
+
+
+def test_unreachable_code():
+    # data is only read by lw, so it is not code that cannot run
+    _, _, _, unreachable = analyze("lw D1, data\nend: j end\n li D1, 1\n add D1, D1, D1\ndata: li D0, 0\n")
+    assert unreachable == [(3, 4)]
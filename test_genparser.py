@@ -0,0 +1,100 @@
+import copy
+from genparser import run, variants
+from parser import Parser
+from ply import codegen
+import pytest
+
+# Every kind of statement the grammar has, each source also being checked
+# with every prefix of its lines and with each line left out
+SOURCES = {
+    "instructions": """\
+start:  li   D1, 5
+        add  D3, D1, D2
+        sub  D2, D1, D3
+        slt  D0, D1, D2
+        jal  func
+        lw   D3, data
+        beq  D1, end
+        bne  D1, start
+        j    end
+func:   push D1
+        pop  D1
+        nop
+        jr
+data:   .word 1, -2, 3
+buffer: .fill 4, 7
+end:    j    end
+""",
+    "expressions": """\
+start:  li   D0, (end-1)&31
+        li   D1, data+1
+        lw   D2, table+2
+        li   D3, 3*4-2 % 5 / 2
+        li   D0, ~0 & 31 ^ 1
+        li   D1, 1<<4 | 3
+        li   D2, 100>>3
+        li   D3, -(+5)
+table:  .word 1, 2, 3
+data:   .word 7
+end:    j    end-0
+""",
+    "pseudo": """\
+start:  ldi D0, 1000
+        ldi D1, -3, D2
+        mov D3, D0
+        inc D3
+        dec D1, D2
+        clr D2
+        call f
+        j mov
+f:      inc D2
+        ret
+mov:    j ret
+ret:    j ret
+""",
+    "errors": """\
+start:  li D1, 3 3
+        add D1, D2
+        .foo 3
+        li D1, (1 + 
+        j
+        .word
+        push 5
+end:    j end
+""",
+}
+
+
+@pytest.fixture(scope="module")
+def parsers():
+    parser = Parser()
+    parser._file_name = "test.s"
+    tables = parser._parser
+    return parser, tables, codegen.load(tables)
+
+
+@pytest.mark.parametrize("name", SOURCES)
+def test_generated_parser_matches_tables(parsers, name):
+    parser, tables, generated = parsers
+    for code in variants(SOURCES[name]):
+        assert run(parser, generated, code) == run(parser, tables, code), code
+
+
+def test_rules_run_once_on_errors(parsers):
+    # The generated parser hands over to the table-driven one at a syntax
+    # error instead of parsing again, so both run the same rules
+    parser, tables, _ = parsers
+    calls = []
+    counted = copy.copy(tables)
+    counted.productions = [copy.copy(p) for p in tables.productions]
+    for p in counted.productions:
+        if p.callable is not None:
+            p.callable = lambda p, rule=p.callable, name=p.str: calls.append(name) or rule(p)
+    generated = codegen.load(counted)
+    for code in variants(SOURCES["errors"]):
+        del calls[:]
+        run(parser, counted, code)
+        expected = list(calls)
+        del calls[:]
+        run(parser, generated, code)
+        assert calls == expected, code
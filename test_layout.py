@@ -0,0 +1,126 @@
+from layout import layout
+from parser import Parser
+import random
+from sim import NO_ADDRESS, NO_REGISTER, Machine, SimulationError, Trace
+
+PARSER = Parser()
+
+
+def writes(program, limit=3000):
+    # Values written to registers and by sw, in order, whether the program
+    # halted and the error that stopped it. Addresses are left out, they
+    # move with the layout.
+    trace = Trace(limit + 1)
+    machine = Machine(program.encode(), 64, trace=trace)
+    try:
+        machine.run(limit)
+        stopped = None
+    except SimulationError as e:
+        stopped = str(e).split(" at ")[0]
+    result = [
+        (reg, value) if reg != NO_REGISTER else ("sw", data)
+        for _, (_, _, reg, _, value, address, data) in trace.records()
+        if reg != NO_REGISTER or address != NO_ADDRESS
+    ]
+    return result, machine.halted, stopped
+
+
+def random_source(rng):
+    # A main part that calls three functions, and two data words
+    def body(count, labels):
+        lines = []
+        for _ in range(count):
+            op = rng.choice(["add", "sub", "slt", "li", "li", "lw", "sw", "beq", "bne", "j", "nop"])
+            register = f"D{rng.randrange(4)}"
+            if op in ("add", "sub", "slt"):
+                lines.append(f"{op} {register}, D{rng.randrange(4)}, D{rng.randrange(4)}")
+            elif op == "li":
+                lines.append(f"li {register}, {rng.randrange(32)}")
+            elif op in ("lw", "sw"):
+                lines.append(f"{op} {register}, d{rng.randrange(2)}")
+            elif op in ("beq", "bne"):
+                lines.append(f"{op} {register}, {rng.choice(labels)}")
+            elif op == "j":
+                lines.append(f"j {rng.choice(labels)}")
+            else:
+                lines.append("nop")
+        return lines
+
+    count = rng.randint(3, 8)
+    lines = []
+    for i, line in enumerate(body(count, [f"m{i}" for i in range(count)] + ["end"])):
+        if rng.random() < 0.15:
+            line = f"jal f{rng.randrange(3)}"
+        lines.append(f"m{i}: {line}")
+    lines.append("end: j end")
+    for f in range(3):
+        labels = [f"f{f}l{i}" for i in range(3)] + [f"f{f}x"]
+        lines.append(f"f{f}: push D{rng.randrange(4)}")
+        lines += [f"f{f}l{i}: {line}" for i, line in enumerate(body(3, labels))]
+        lines += [f"f{f}x: pop D{rng.randrange(4)}", "jr"]
+    lines += [f"d{d}: .word {rng.randrange(2048)}" for d in range(2)]
+    return "\n".join(lines) + "\n"
+
+
+def test_units_follow_their_jumps():
+    program = PARSER.parse(
+        """\
+        beq D0, other
+        li D1, 1
+        j join
+other:  li D1, 2
+        j join
+end:    j end
+join:   li D2, 2
+        add D3, D1, D2
+        sw D3, data
+        j end
+data:   .word 0
+""",
+        file_name="test.s",
+    )
+    laid_out, saved = layout(program)
+    # join follows the first branch and end follows join, so their j's go
+    assert saved == 2 and laid_out.size == program.size - 2
+    assert writes(laid_out) == writes(program)
+    assert laid_out.labels["data"] == laid_out.size - 1
+
+
+def test_random_programs_keep_their_writes():
+    rng = random.Random(0)
+    for _ in range(300):
+        source = random_source(rng)
+        program = PARSER.parse(source, file_name="test.s")
+        laid_out, _ = layout(program)
+        before, halted_before, stopped_before = writes(program)
+        after, halted_after, stopped_after = writes(laid_out)
+        length = min(len(before), len(after))
+        assert before[:length] == after[:length], source
+        assert (stopped_before is None) == (stopped_after is None), source
+        if halted_before and halted_after:
+            assert before == after, source
+
+
+def test_shared_tails():
+    program = PARSER.parse(
+        """\
+        beq D0, other
+        li D1, 1
+        add D2, D1, D1
+        sw D2, data
+        j end
+other:  li D1, 2
+        add D2, D1, D1
+        sw D2, data
+        j end
+end:    j end
+data:   .word 0
+""",
+        file_name="test.s",
+    )
+    laid_out, saved = layout(program)
+    # The second "add / sw / j end" becomes a j to the first, and end
+    # follows the first
+    assert saved == 3
+    assert laid_out.instructions()[5:7] == [("li", "D1", 2), ("j", 2)]
+    assert writes(laid_out) == writes(program)
@@ -0,0 +1,101 @@
+import io
+import json
+from lsp import Server
+from parser import Parser
+
+
+def request(server, method, params):
+    server.output = io.BytesIO()
+    server.handle({"jsonrpc": "2.0", "id": 1, "method": method, "params": params})
+    body = server.output.getvalue().split(b"\r\n\r\n", 1)[1]
+    return json.loads(body)["result"]
+
+
+def notify(server, method, params):
+    server.handle({"jsonrpc": "2.0", "method": method, "params": params})
+
+
+def test_unknown_directive_keeps_positions(tmp_path):
+    source = tmp_path / "a.s"
+    source.write_text("start:  jal func\nfunc:   jr\n")
+    uri = source.as_uri()
+    server = Server(Parser(), str(tmp_path / "index.json"))
+    request(server, "initialize", {"rootUri": tmp_path.as_uri()})
+    notify(server, "textDocument/didOpen", {"textDocument": {"uri": uri, "text": source.read_text()}})
+    start = {"line": 0, "character": 0}
+    notify(
+        server,
+        "textDocument/didChange",
+        {"textDocument": {"uri": uri}, "contentChanges": [{"range": {"start": start, "end": start}, "text": ".w\n"}]},
+    )
+
+    references = request(
+        server,
+        "textDocument/references",
+        {"textDocument": {"uri": uri}, "position": {"line": 2, "character": 1}, "context": {"includeDeclaration": False}},
+    )
+    assert [r["range"]["start"] for r in references] == [{"line": 1, "character": 12}]
+
+    definitions = request(
+        server, "textDocument/definition", {"textDocument": {"uri": uri}, "position": {"line": 1, "character": 13}}
+    )
+    assert [d["range"]["start"] for d in definitions] == [{"line": 2, "character": 0}]
+
+
+def test_cache_is_reused(tmp_path):
+    (tmp_path / "a.s").write_text("loop: j loop\n")
+    cache = str(tmp_path / "index.json")
+    server = Server(Parser(), cache)
+    request(server, "initialize", {"rootUri": tmp_path.as_uri()})
+    request(server, "shutdown", None)
+
+    parser = Parser()
+    parser.symbols = None  # lexing again would fail
+    server = Server(parser, cache)
+    request(server, "initialize", {"rootUri": tmp_path.as_uri()})
+    assert [item["label"] for item in request(server, "textDocument/completion", {})] == ["loop"]
+
+
+def test_failing_request_gets_error(tmp_path):
+    server = Server(Parser(), str(tmp_path / "index.json"))
+    server.output = io.BytesIO()
+    server.handle({"jsonrpc": "2.0", "id": 7, "method": "textDocument/definition", "params": {}})
+    response = json.loads(server.output.getvalue().split(b"\r\n\r\n", 1)[1])
+    assert response["id"] == 7 and response["error"]["code"] == -32603
+    notify(server, "textDocument/didChange", {})
+    assert server.running
+
+
+def test_columns_are_utf16(tmp_path):
+    source = tmp_path / "a.s"
+    uri = source.as_uri()
+    server = Server(Parser(), str(tmp_path / "index.json"))
+    request(server, "initialize", {"rootUri": tmp_path.as_uri()})
+    # The emoji is two UTF-16 code units, so "end" starts at character 5
+    notify(server, "textDocument/didOpen", {"textDocument": {"uri": uri, "text": "\U0001f600 j end\nend: j end\n"}})
+    params = {"textDocument": {"uri": uri}, "position": {"line": 0, "character": 8}}
+    assert [d["range"]["start"] for d in request(server, "textDocument/definition", params)] == [
+        {"line": 1, "character": 0}
+    ]
+    start = {"line": 0, "character": 5}
+    notify(
+        server,
+        "textDocument/didChange",
+        {"textDocument": {"uri": uri}, "contentChanges": [{"range": {"start": start, "end": start}, "text": "x"}]},
+    )
+    assert server.documents[str(source)].startswith("\U0001f600 j xend\n")
+
+
+def test_watched_files_are_registered(tmp_path):
+    server = Server(Parser(), str(tmp_path / "index.json"))
+    capabilities = {"workspace": {"didChangeWatchedFiles": {"dynamicRegistration": True}}}
+    request(server, "initialize", {"rootUri": tmp_path.as_uri(), "capabilities": capabilities})
+    server.output = io.BytesIO()
+    notify(server, "initialized", {})
+    message = json.loads(server.output.getvalue().split(b"\r\n\r\n", 1)[1])
+    assert message["method"] == "client/registerCapability"
+    assert message["params"]["registrations"][0]["method"] == "workspace/didChangeWatchedFiles"
+    # The client's response is not a request
+    server.output = io.BytesIO()
+    server.handle({"jsonrpc": "2.0", "id": message["id"], "result": None})
+    assert server.output.getvalue() == b""
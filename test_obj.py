@@ -0,0 +1,54 @@
+import importlib
+from obj import LinkError, link, read_object, write_object
+from parser import Parser
+import pytest
+
+# as.py, which cannot be imported by name
+assembler = importlib.import_module("as")
+
+PARSER = Parser()
+
+MAIN = "start:  jal f\n        lw D2, slot\nend:    j end\n"
+LIB = "f:      li D1, 5\n        sw D1, slot\n        jr\nslot:   .word 0\n"
+
+
+def assemble(tmp_path, name, source):
+    path = str(tmp_path / name)
+    assembler.to_object(PARSER.parse(source, file_name=name, relocatable=True), path)
+    return path
+
+
+def test_link_matches_one_source(tmp_path):
+    paths = [assemble(tmp_path, "main.o", MAIN), assemble(tmp_path, "lib.o", LIB)]
+    assert link(paths) == list(PARSER.parse(MAIN + LIB, file_name="all.s").encode())
+
+
+def test_objects_round_trip(tmp_path):
+    path = str(tmp_path / "a.o")
+    write_object(path, [1, 2, 3], {"a": 0, "é": 3}, [(1, "b"), (2, "a")])
+    words, symbols, relocations = read_object(path)
+    assert list(words) == [1, 2, 3]
+    assert symbols == {"a": 0, "é": 3}
+    assert relocations == [(1, "b"), (2, "a")]
+
+
+def test_link_errors(tmp_path):
+    main = assemble(tmp_path, "main.o", MAIN)
+    with pytest.raises(LinkError, match="Unknown label: 'f'"):
+        link([main])
+    with pytest.raises(LinkError, match="duplicate label 'start'"):
+        link([main, assemble(tmp_path, "again.o", MAIN)])
+    with pytest.raises(LinkError, match="out of RAM"):
+        link([main, assemble(tmp_path, "lib.o", LIB)], depth=6)
+
+
+def test_corrupt_objects(tmp_path):
+    path = tmp_path / "a.o"
+    write_object(str(path), [1, 2, 3], {"a": 0}, [(1, "b")])
+    data = path.read_bytes()
+    for size in range(len(data)):
+        path.write_bytes(data[:size])
+        with pytest.raises(LinkError):
+            read_object(str(path))
+    with pytest.raises(LinkError, match="at most 255"):
+        write_object(str(path), [], {"x" * 256: 0}, [])
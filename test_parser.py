@@ -0,0 +1,49 @@
+from ir import Program
+from parser import Parser
+from pseudo import expand
+import pytest
+from sim import Machine
+
+PARSER = Parser()
+
+
+def parse(code):
+    return PARSER.parse(code, file_name="test.s")
+
+
+def test_unknown_directive_is_one_error(capsys):
+    with pytest.raises(SystemExit):
+        parse("start:  .bogus 5, x\n        j start\n")
+    output = capsys.readouterr().out
+    assert output.count("error:") == 1
+    assert "unknown directive '.bogus'" in output
+
+
+def test_ldi_loads_every_value():
+    # With and without a scratch register, ldi leaves every other register
+    # and the stack as they were
+    for value in range(-1024, 2048):
+        for scratch in ((), ("D3",)):
+            code = [("li", "D0", 7), ("li", "D2", 9), ("li", "D3", 11)] + expand(("ldi", "D1", value & 2047) + scratch)
+            program = Program()
+            for instr in code:
+                program.append(instr)
+            # Straight-line code, stepped rather than compiled
+            machine = Machine(program.encode())
+            machine.interpret(len(code))
+            assert machine.regs[:3] == [7, value & 2047, 9] and machine.stack == [], (value, scratch)
+            assert scratch or machine.regs[3] == 11, value
+
+
+def test_ldi_range(capsys):
+    assert parse("ldi D1, -1024\nldi D1, 2047\n").size > 0
+    for value in (-1025, 2048):
+        with pytest.raises(SystemExit):
+            parse(f"ldi D1, {value}\n")
+        assert f"value of '{value}' is out of range." in capsys.readouterr().out
+
+
+def test_labels_named_like_instructions():
+    program = parse("mov:    li D1, 3\n        j mov\n        call clr\nclr:    jr\n")
+    assert program.labels == {"mov": 0, "clr": 3}
+    assert program.instructions() == [("li", "D1", 3), ("j", 0), ("jal", 3), ("jr",)]
@@ -0,0 +1,64 @@
+from parser import Parser
+from peephole import optimize
+import random
+from sim import Machine, SimulationError
+from test_layout import random_source
+
+PARSER = Parser()
+
+
+def optimized(program):
+    instructions, saved, (origins, addresses) = optimize(program.instructions())
+    return program.moved(instructions, origins, addresses), saved
+
+
+def final(program, limit=3000):
+    # Registers and data words once the program halts, or None
+    machine = Machine(program.encode(), 64)
+    try:
+        machine.run(limit)
+    except SimulationError:
+        return None
+    if not machine.halted:
+        return None
+    return machine.regs, [machine.memory[program.labels[name]] for name in ("d0", "d1")]
+
+
+def test_rewrites():
+    program = PARSER.parse(
+        """\
+        li D1, 1
+        nop
+        li D1, 1
+        push D2
+        pop D2
+        j next
+next:   beq D1, hop
+        sw D1, data
+hop:    j end
+        li D2, 3
+end:    j end
+data:   .word 0
+""",
+        file_name="test.s",
+    )
+    result, saved = optimized(program)
+    assert result.instructions() == [("li", "D1", 1), ("beq", "D1", 3), ("sw", "D1", 4), ("j", 3), (".word", 0)]
+    # nop, the second li, push/pop, j next, the dead li and then hop's j,
+    # which jumps to the next word; beq threaded past hop saves a cycle
+    assert saved == (7, 8)
+    assert result.labels == {"next": 1, "hop": 3, "end": 3, "data": 4}
+
+
+def test_random_programs_end_the_same():
+    rng = random.Random(0)
+    ended = 0
+    for _ in range(300):
+        source = random_source(rng)
+        program = PARSER.parse(source, file_name="test.s")
+        result, _ = optimized(program)
+        before, after = final(program), final(result)
+        if before is not None and after is not None:
+            assert before == after, source
+            ended += 1
+    assert ended > 50
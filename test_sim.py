@@ -0,0 +1,149 @@
+from ir import encode
+from isa import LI, OPERAND_MASK, opcode_names, r_type
+from parser import Parser
+import pytest
+import random
+from sim import NO_ADDRESS, NO_REGISTER, Machine, SimulationError, Trace
+
+
+def random_program(rng, size):
+    # Words of random instructions whose addresses stay inside the program
+    words = []
+    for _ in range(size):
+        op = rng.choice(sorted(opcode_names))
+        if op == LI or opcode_names[op] in r_type:
+            operand = rng.randrange(OPERAND_MASK + 1)
+        else:
+            operand = rng.randrange(size)
+        words.append(encode(op, rng.randrange(4), 0, 0, operand))
+    return words
+
+
+def machine(source, **kwargs):
+    return Machine(Parser().parse(source, file_name="test.s").encode(), **kwargs)
+
+
+def state(machine):
+    return machine.pc, machine.steps, machine.regs, machine.stack, machine.memory
+
+
+def attempt(run, limit):
+    # Instructions run, or the error that stopped the machine
+    try:
+        return run(limit)
+    except SimulationError as e:
+        return str(e)
+
+
+def test_blocks_match_step():
+    # The compiled blocks run the same instructions as step(), however the
+    # run is cut into pieces. The programs store into their own code too.
+    rng = random.Random(0)
+    for _ in range(500):
+        words = random_program(rng, rng.randint(2, 32))
+        blocks = Machine(words)
+        reference = Machine(words)
+        for limit in (rng.choice((1, 5, 30, 300)) for _ in range(10)):
+            done = attempt(blocks.run, limit)
+            if blocks.halted:
+                break
+            assert attempt(reference.interpret, limit if isinstance(done, int) else 10**6) == done, words
+            assert state(blocks) == state(reference), words
+            if not isinstance(done, int):
+                break
+
+
+
+def test_halts_at_jump_to_itself():
+    m = machine("li D1, 5\nend: j end\n")
+    assert m.run(10**6) < 10
+    assert m.halted and m.pc == 1 and m.regs[1] == 5
+
+
+def test_halts_when_state_repeats():
+    # The loop writes D1 but always comes back to the same state
+    m = machine("loop: li D1, 1\n li D1, 2\n j loop\n")
+    assert m.run(10**6) < 10**5
+    assert m.halted
+
+
+def test_runs_on_while_state_changes():
+    # D1 counts up to 2048 and wraps to 0, past the first samples of the state
+    m = machine("li D2, 1\nloop: add D1, D1, D2\n bne D1, loop\nend: j end\n")
+    m.run(10**6)
+    assert m.halted and m.pc == 3 and m.regs[1] == 0 and m.steps > 4096
+
+
+def test_profile_counts():
+    source = "li D1, 3\nli D2, 1\nloop: sub D1, D1, D2\n bne D1, loop\nend: j end\n"
+    for run in ("run", "interpret"):
+        m = machine(source, profile=True)
+        getattr(m, run)(20)
+        assert list(m.profile.counts[:4]) == [1, 1, 3, 3], run
+        assert (m.profile.taken[3], m.profile.not_taken[3]) == (2, 1), run
+
+
+TRACED = "li D1, 5\nsw D1, data\npush D1\npop D2\nend: j end\ndata: .word 0\n"
+
+
+def test_trace_records():
+    for run in ("run", "interpret"):
+        m = machine(TRACED, trace=Trace(16))
+        getattr(m, run)(5)
+        # The word is left out, it is checked below
+        records = [record[:1] + record[2:] for _, record in m.trace.records()]
+        assert records == [
+            (0, 1, 0, 5, NO_ADDRESS, 0),
+            (1, NO_REGISTER, 0, 0, 5, 5),
+            (2, NO_REGISTER, 1, 0, NO_ADDRESS, 0),
+            (3, 2, 0, 5, NO_ADDRESS, 0),
+            (4, NO_REGISTER, 0, 0, NO_ADDRESS, 0),
+        ], run
+        assert [word for _, (_, word, *_) in m.trace.records()] == m.memory[:5]
+
+
+def test_trace_keeps_the_last_records(tmp_path):
+    path = str(tmp_path / "trace")
+    m = machine(TRACED, trace=Trace(3, path))
+    m.run(5)
+    m.trace.flush()
+    assert [index for index, _ in m.trace.records()] == [2, 3, 4]
+    saved = Trace.open(path)
+    assert list(saved.records()) == list(m.trace.records())
+    assert [record[0] for _, record in saved.records(3)] == [3, 4]
+
+
+def test_snapshot_resumes_the_same_run():
+    rng = random.Random(1)
+    for _ in range(200):
+        words = random_program(rng, rng.randint(2, 32))
+        first = Machine(words)
+        if not isinstance(attempt(first.run, rng.choice((3, 50, 500))), int) or first.halted:
+            continue
+        snapshot = first.snapshot()
+        done = attempt(first.run, 300)
+        # On the machine it was taken from, after running on, and on another
+        # one that had compiled blocks for a different program
+        first.restore(snapshot)
+        assert attempt(first.run, 300) == done
+        expected = state(first)
+        second = Machine(random_program(rng, len(words)))
+        attempt(second.run, 50)
+        second.restore(snapshot)
+        assert attempt(second.run, 300) == done
+        assert state(second)[2:] == expected[2:] and (first.halted or state(second) == expected), words
+
+
+def test_run_until():
+    m = machine("li D2, 1\nloop: add D1, D1, D2\n j loop\n")
+    assert m.run(1000, until=1) == 1
+    assert m.run(1000, until=1) == 2
+    assert m.pc == 1 and m.regs[1] == 1
+
+
+def test_restore_rejects_bad_snapshots():
+    m = machine("end: j end\n")
+    snapshot = m.snapshot()
+    for data in (b"", snapshot[:-1], b"x" + snapshot[1:], Machine([], depth=64).snapshot()):
+        with pytest.raises(ValueError):
+            m.restore(data)
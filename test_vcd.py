@@ -0,0 +1,65 @@
+import io
+from isa import cycle_costs
+from parser import Parser
+from sim import Machine, Trace
+from vcd import VcdWriter
+
+SOURCE = "li D1, 5\nsw D1, data\npush D1\npop D2\nend: j end\ndata: .word 0\n"
+
+
+def changes(text):
+    # {time: {signal: value}} from a dump
+    names = {}
+    times = {}
+    for line in text.splitlines():
+        if line.startswith("$var"):
+            _, _, _, code, name, _ = line.split()
+            names[code] = name
+        elif line.startswith("#"):
+            now = times.setdefault(int(line[1:]), {})
+        elif line.startswith("b"):
+            value, code = line[1:].split()
+            now[names[code]] = int(value, 2)
+        elif line[:1] in ("0", "1"):
+            now[names[line[1:]]] = int(line[0])
+    return times
+
+
+def dump(chunk):
+    words = Parser().parse(SOURCE, file_name="test.s").encode()
+    trace = Trace(16)
+    machine = Machine(words, trace=trace)
+    out = io.StringIO()
+    writer = VcdWriter(out, costs=dict(cycle_costs, li=2))
+    for _ in range(0, 5, chunk):
+        machine.run(chunk)
+        writer.write(trace.records(writer.next))
+    writer.close()
+    return words, out.getvalue()
+
+
+def test_waveform():
+    words, text = dump(5)
+    times = changes(text)
+    assert times[0] == {
+        "pc": 0,
+        "instr": words[0],
+        "D0": 0,
+        "D1": 0,
+        "D2": 0,
+        "D3": 0,
+        "sp": 0,
+        "mem_we": 0,
+        "mem_addr": 0,
+        "mem_data": 0,
+    }
+    # li takes two cycles; results show when an instruction ends
+    assert times[2] == {"pc": 1, "instr": words[1], "D1": 5, "mem_we": 1, "mem_addr": 5, "mem_data": 5}
+    assert times[3] == {"pc": 2, "instr": words[2], "mem_we": 0}
+    assert times[4] == {"pc": 3, "instr": words[3], "sp": 1}
+    assert times[5] == {"pc": 4, "instr": words[4], "D2": 5, "sp": 0}
+    assert sorted(times) == [0, 2, 3, 4, 5]
+
+
+def test_streamed_in_pieces():
+    assert dump(1) == dump(5)
@@ -0,0 +1,103 @@
+from isa import OPCODE_SHIFT, OPERAND_BITS, WORD_BITS, opcode_names
+from sim import NO_ADDRESS, NO_REGISTER, STACK_DEPTH
+
+# Value Change Dump output of a simulation for comparison with RTL waveforms.
+# It is written from the records of a sim.Trace as the simulation produces
+# them, and only value changes are written, so nothing grows with the length
+# of the run.
+#
+# Time is counted in cycles (see isa.cycle_costs). pc and instr show the
+# instruction being executed, along with mem_we, mem_addr and mem_data while
+# it is a sw. The registers and sp (the stack depth) change when it ends.
+
+# Signals by index
+PC, INSTR, D0, D1, D2, D3, SP, MEM_WE, MEM_ADDR, MEM_DATA = range(10)
+
+
+class VcdWriter:
+    def __init__(self, file, memory_size=32, costs=None):
+        # file is a text file open for writing; memory_size sets the width
+        # of pc when more than the addressable 32 words are simulated
+        self.file = file
+        self.time = 0
+        # Index of the next trace record to write
+        self.next = 0
+        # Cycles by opcode
+        self.cycles = {opcode: 1 if costs is None else costs[op] for opcode, op in opcode_names.items()}
+
+        signals = [
+            ("pc", max(OPERAND_BITS, (memory_size - 1).bit_length())),
+            ("instr", WORD_BITS),
+            ("D0", WORD_BITS),
+            ("D1", WORD_BITS),
+            ("D2", WORD_BITS),
+            ("D3", WORD_BITS),
+            ("sp", STACK_DEPTH.bit_length()),
+            ("mem_we", 1),
+            ("mem_addr", OPERAND_BITS),
+            ("mem_data", WORD_BITS),
+        ]
+        # Identifier codes are the printable characters from "!" on
+        self.codes = [chr(33 + i) for i in range(len(signals))]
+        self.values = [0] * len(signals)
+        self.dumped = False
+        # Changes due when the last instruction ends, as (signal, value)
+        self.pending = []
+
+        out = ["$version as.py $end", "$timescale 1ns $end", "$scope module cpu $end"]
+        for (name, width), code in zip(signals, self.codes):
+            out.append(f"$var wire {width} {code} {name} $end")
+        out += ["$upscope $end", "$enddefinitions $end"]
+        file.write("\n".join(out) + "\n")
+
+    def write(self, records):
+        # records are (index, record) pairs from Trace.records(self.next)
+        cycles = self.cycles
+        emit = self.emit
+        for index, (pc, word, reg, depth, result, address, data) in records:
+            changes = self.pending
+            changes.append((PC, pc))
+            changes.append((INSTR, word))
+            if address != NO_ADDRESS:
+                changes += ((MEM_WE, 1), (MEM_ADDR, address), (MEM_DATA, data))
+            else:
+                changes.append((MEM_WE, 0))
+            emit(changes)
+
+            self.pending = [(SP, depth)]
+            if reg != NO_REGISTER:
+                self.pending.append((D0 + reg, result))
+            self.time += cycles[word >> OPCODE_SHIFT]
+            self.next = index + 1
+
+    def close(self):
+        # Writes the results of the last instruction at the time it ends
+        self.pending.append((MEM_WE, 0))
+        self.emit(self.pending)
+        self.pending = []
+
+    def emit(self, changes):
+        # Writes the changes at the current time. The first values written
+        # are the initial ones of every signal.
+        values = self.values
+        codes = self.codes
+        if not self.dumped:
+            for signal, value in changes:
+                values[signal] = value
+            out = [self.format(signal, value) for signal, value in enumerate(values)]
+            self.file.write(f"#{self.time}\n$dumpvars\n" + "\n".join(out) + "\n$end\n")
+            self.dumped = True
+            return
+
+        out = []
+        for signal, value in changes:
+            if values[signal] != value:
+                values[signal] = value
+                out.append(f"{value}{codes[signal]}" if signal == MEM_WE else f"b{value:b} {codes[signal]}")
+        if out:
+            self.file.write(f"#{self.time}\n" + "\n".join(out) + "\n")
+
+    def format(self, signal, value):
+        if signal == MEM_WE:
+            return f"{value}{self.codes[signal]}"
+        return f"b{value:b} {self.codes[signal]}"